@@ -0,0 +1,47 @@
+import json
+import os
+import tempfile
+
+
+def fsync_directory(path):
+    """Make the creation, rename or removal of files in the directory durable."""
+    try:
+        descriptor = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Directories can't be opened on Windows
+        return
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+def write_atomic(file, data):
+    """Replace the file with the bytes so that a crash leaves either the old or the new content.
+
+    The data goes to a temporary file in the same directory that is fsynced and
+    renamed over the file.
+    """
+    directory = os.path.dirname(os.path.abspath(file))
+    descriptor, temp_file = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(file) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, file)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+    fsync_directory(directory)
+
+def write_json_atomic(file, data, **kwargs):
+    write_atomic(file, json.dumps(data, **kwargs).encode('utf-8'))
+
+def file_version(file):
+    """Return a value that changes when the file is replaced by write_atomic or removed, None for a missing file."""
+    try:
+        stat = os.stat(file)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns
@@ -0,0 +1,1184 @@
+"""Local benchmarks of the bot internals.
+
+Run all of them with `python benchmarks.py` or only some with
+`python benchmarks.py storage`.
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from chat_storage import SegmentedChatLog
+from compact_history import CompactHistory
+from fake_openai import FakeOpenAIServer
+from fake_telegram import FakeBot
+
+
+make_record = lambda number: {
+    "chat_id": -100,
+    "user_id": number % 50,
+    "username": f'user_{number % 50}',
+    "message_text": f'message number {number} with some ordinary chat text in it',
+}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def legacy_save_message(path, chat_name, message_id, message_data, max_len):
+    """The old full-file rewrite of save_message, kept here for comparison."""
+    file = os.path.join(path, chat_name + '.json')
+    chat_history = {}
+    if os.path.isfile(file):
+        with open(file, 'r') as f:
+            chat_history = json.load(f)
+    if len(chat_history) >= max_len:
+        del chat_history[list(chat_history.keys())[0]]
+    chat_history.update({message_id: message_data})
+    with open(file, 'w') as f:
+        json.dump(chat_history, f)
+    with open(file, 'r') as f:
+        json.load(f)
+
+
+def bench_storage(sizes=(100, 1000, 10000), writes=200):
+    """Per-message write cost of the legacy JSON file and the segmented log by history size."""
+    print('history size | legacy json, ms/msg | segmented log, ms/msg')
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as path:
+            with open(os.path.join(path, 'legacy.json'), 'w') as f:
+                json.dump({str(i): make_record(i) for i in range(size)}, f)
+            chat_log = SegmentedChatLog(path, max_len=size)
+            chat_log.append('segmented', ((i, make_record(i)) for i in range(size)))
+
+            start = time.perf_counter()
+            for i in range(size, size + writes):
+                legacy_save_message(path, 'legacy', str(i), make_record(i), size)
+            legacy_time = (time.perf_counter() - start) / writes
+
+            start = time.perf_counter()
+            for i in range(size, size + writes):
+                chat_log.append('segmented', [(i, make_record(i))])
+            segmented_time = (time.perf_counter() - start) / writes
+
+        print(f'{size:>12} | {legacy_time * 1000:>19.3f} | {segmented_time * 1000:>21.3f}')
+
+
+def bench_compression(messages=10000, last_n=(100, 1000, 10000), repeat=5):
+    """Disk size and load latency of a chat log with cold segments compressed by every available codec."""
+    import random
+    from chat_storage import zstandard
+    from load_test import GROUP_TEXTS
+
+    rng = random.Random(1)
+    records = [(i, {'chat_id': -1001234567890, 'user_id': 100000 + rng.randrange(50), 'username': f'user_{rng.randrange(50)}',
+                    'message_text': rng.choice(GROUP_TEXTS), 'tokens': 10}) for i in range(messages)]
+    codecs = [None, 'gzip', 'lzma'] + (['zstd'] if zstandard is not None else [])
+
+    print(f'{messages} messages' + ('' if zstandard is not None else ', zstd skipped: zstandard is not installed'))
+    print('codec | disk, KB | ratio | ' + ' | '.join(f'load last {n}, ms' for n in last_n))
+    plain_size = None
+    for compression in codecs:
+        with tempfile.TemporaryDirectory() as path:
+            chat_log = SegmentedChatLog(path, messages, fsync=False, compression=compression)
+            for start in range(0, messages, 100):
+                chat_log.append('Bench', records[start:start + 100])
+            size = sum(os.path.getsize(os.path.join(chat_log.chat_path('Bench'), name))
+                       for name in os.listdir(chat_log.chat_path('Bench')))
+            plain_size = plain_size or size
+
+            timings = []
+            reader = SegmentedChatLog(path, messages, compression=compression)
+            for n in last_n:
+                assert list(reader.load('Bench', n).keys()) == [str(i) for i in range(messages - n, messages)]
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    reader.load('Bench', n)
+                timings.append((time.perf_counter() - start) / repeat)
+        print(f'{str(compression):<5} | {size / 1024:>8.0f} | {plain_size / size:>5.1f} | '
+              + ' | '.join(f'{timing * 1000:>{len(f"load last {n}, ms")}.1f}' for n, timing in zip(last_n, timings)))
+
+
+def start_fake_openai(**kwargs):
+    """Start the fake OpenAI server on its own event loop thread, so blocking clients can use it too."""
+    import openai
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    server = FakeOpenAIServer(**kwargs)
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+    openai.api_base = server.api_base
+    openai.api_key = 'fake'
+    return server
+
+async def _completion_latency(chats, requests_per_chat, blocking):
+    import openai
+    from llm_client import CompletionClient
+
+    client = CompletionClient()
+    latencies = []
+
+    async def chat(user_id, arrival):
+        # Every chat sends the next request as soon as the previous one is answered
+        for number in range(requests_per_chat):
+            messages = [{'role': 'user', 'content': f'sum up {user_id} {number}'}]
+            if blocking:
+                openai.ChatCompletion.create(model='gpt-3.5-turbo', messages=messages, timeout=10)
+            else:
+                await client.complete(messages, model='gpt-3.5-turbo', user_id=user_id)
+            answered = time.perf_counter()
+            latencies.append(answered - arrival)
+            arrival = answered
+            await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(chat(user_id, start) for user_id in range(chats)))
+    total = time.perf_counter() - start
+
+    return latencies, total
+
+def bench_completion(chats=(1, 8, 32), requests_per_chat=3, latency=0.2):
+    """Handler latency of blocking and async completion calls with N chats at once."""
+    start_fake_openai(latency=latency)
+    print('mode     | chats | p50, ms | p99, ms | total, s')
+    for blocking in (True, False):
+        for number in chats:
+            latencies, total = asyncio.run(_completion_latency(number, requests_per_chat, blocking))
+            mode = 'blocking' if blocking else 'async'
+            print(f'{mode:<8} | {number:>5} | {percentile(latencies, 0.5) * 1000:>7.0f} | '
+                  f'{percentile(latencies, 0.99) * 1000:>7.0f} | {total:>8.2f}')
+
+
+async def _rate_limited_run(client, interactive, sum_ups, prompt_words):
+    """Send the sum_up chunks and the questions at once, return the latencies by priority and the failures."""
+    from llm_client import PRIORITY_INTERACTIVE, PRIORITY_SUM_UP
+
+    latencies = {PRIORITY_INTERACTIVE: [], PRIORITY_SUM_UP: []}
+    failures = 0
+
+    async def request(number, priority, words, max_tokens):
+        nonlocal failures
+        messages = [{'role': 'user', 'content': f'request {number} ' + 'word ' * words}]
+        start = time.perf_counter()
+        try:
+            await client.complete(messages, model='gpt-3.5-turbo', priority=priority, max_tokens=max_tokens)
+            latencies[priority].append(time.perf_counter() - start)
+        except Exception:
+            failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[request(number, PRIORITY_SUM_UP, prompt_words, 500) for number in range(sum_ups)],
+                         *[request(sum_ups + number, PRIORITY_INTERACTIVE, 20, 100) for number in range(interactive)])
+    return latencies, failures, time.perf_counter() - start
+
+async def _outage_run(client, server, requests):
+    """Send two batches of requests while the API is down and one after it's back.
+    Returns:
+        list: (failed requests, requests that reached the API, seconds, circuit state) of both batches and the state at the end.
+    """
+    server.down = True
+    batches = []
+    for batch in range(2):
+        before = len(server.requests)
+        start = time.perf_counter()
+        results = await asyncio.gather(*[client.complete([{'role': 'user', 'content': f'outage {batch} {number}'}], model='gpt-3.5-turbo')
+                                         for number in range(requests)], return_exceptions=True)
+        batches.append((sum(isinstance(result, Exception) for result in results), len(server.requests) - before,
+                        time.perf_counter() - start, client.circuit_breaker.state))
+
+    server.down = False
+    await asyncio.sleep(client.circuit_breaker.reset_timeout)
+    await client.complete([{'role': 'user', 'content': 'after the outage'}], model='gpt-3.5-turbo')
+    return batches, client.circuit_breaker.state
+
+def bench_openai_limits(interactive=40, sum_ups=40, prompt_words=600, requests_per_second=20, tokens_per_second=12000,
+                        error_rate=0.05, outage_requests=50):
+    """Completions against a fake API with rate limits and 500s: no retries, retries only and the rate limiter.
+
+    The budgets of the fake and of the limiter are per second here to keep the run short.
+    """
+    from llm_client import CompletionClient, RateLimiter, CircuitBreaker, PRIORITY_INTERACTIVE, PRIORITY_SUM_UP
+
+    count_words = lambda messages: sum(len(message['content'].split()) for message in messages)
+    modes = {
+        'no retries': lambda: CompletionClient(rate_limiter=RateLimiter(None, None), retries=0),
+        'retries only': lambda: CompletionClient(rate_limiter=RateLimiter(None, None)),
+        'rate limiter': lambda: CompletionClient(rate_limiter=RateLimiter(requests_per_second, tokens_per_second, period=1),
+                                                 count_prompt_tokens=count_words),
+    }
+
+    print('mode         | failed | 429s | 5xx | question p50/p95, s | sum_up p50/p95, s | total, s')
+    for mode, make_client in modes.items():
+        server = start_fake_openai(latency=0.05, requests_per_minute=requests_per_second, tokens_per_minute=tokens_per_second,
+                                   period=1, error_rate=error_rate)
+        latencies, failures, total = asyncio.run(_rate_limited_run(make_client(), interactive, sum_ups, prompt_words))
+        summary = lambda values: f'{percentile(values, 0.5):.2f}/{percentile(values, 0.95):.2f}' if values else '-'
+        print(f'{mode:<12} | {failures:>6} | {server.statuses[429]:>4} | {server.statuses[500] + server.statuses[503]:>3} | '
+              f'{summary(latencies[PRIORITY_INTERACTIVE]):>19} | {summary(latencies[PRIORITY_SUM_UP]):>17} | {total:>8.2f}')
+
+    server = start_fake_openai(latency=0.05)
+    client = CompletionClient(circuit_breaker=CircuitBreaker(failure_threshold=5, reset_timeout=0.5))
+    batches, state_after = asyncio.run(_outage_run(client, server, outage_requests))
+    assert all(failed == outage_requests for failed, _, _, _ in batches) and batches[1][1] == 0 and state_after == 'closed'
+    print('API down        | failed | reached the API | time, s | circuit')
+    for name, (failed, reached, seconds, state) in zip(('first requests', 'while open'), batches):
+        print(f'{name:<15} | {failed:>6} | {reached:>15} | {seconds:>7.3f} | {state}')
+    print(f'circuit {state_after} after the API came back')
+
+
+def legacy_make_chatbot_history(main_gpt, chat_history):
+    """The old make_chatbot_history that recounts all messages after every deleted one."""
+    messages = [{'role': 'system', 'content': main_gpt.SYSTEM_MESSAGE}]
+    for chat_element in chat_history.values():
+        if chat_element['username'] == main_gpt.BOT_USERNAME:
+            messages.append({'role': 'assistant', 'content': chat_element['message_text']})
+        else:
+            messages.append({'role': 'user', 'content': chat_element['message_text']})
+    messages = messages[-main_gpt.MAX_CHAT_MEMORY_LEN:]
+    while main_gpt.num_tokens_from_messages(messages, model=main_gpt.AI_MODEL_NAME) > main_gpt.MAX_TOKENS:
+        del messages[0]
+    return messages
+
+def make_dialog_history(main_gpt, size):
+    """History of alternating questions to the bot and its long answers."""
+    chat_history = {}
+    for i in range(size):
+        if i % 2:
+            text = main_gpt.ANSWEAR_FLAG + f'answer {i} ' + 'with a rather long explanation ' * 20
+            username = main_gpt.BOT_USERNAME
+        else:
+            text = main_gpt.ASK_START_FLAG + f'question {i} about something'
+            username = 'user'
+        chat_history[str(i)] = {'chat_id': 1, 'user_id': 1, 'username': username,
+                                'message_text': text, 'tokens': main_gpt.count_tokens(text)}
+    return chat_history
+
+def bench_chatbot_history(sizes=(100, 10000), repeat=5):
+    """make_chatbot_history with the old per-deletion recount and with cached token counts."""
+    import main_gpt
+
+    print('history size | before, ms | after, ms')
+    for size in sizes:
+        chat_history = make_dialog_history(main_gpt, size)
+        dialog = [(main_gpt.classify_message(message_data), message_data) for message_data in chat_history.values()]
+        timings = []
+        for function in (lambda: legacy_make_chatbot_history(main_gpt, chat_history),
+                         lambda: main_gpt.make_chatbot_history(dialog)):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                function()
+            timings.append((time.perf_counter() - start) / repeat)
+        print(f'{size:>12} | {timings[0] * 1000:>10.1f} | {timings[1] * 1000:>9.1f}')
+
+
+def scan_make_chatbot_history(main_gpt, chat_history):
+    """The old make_chatbot_history that matches every message of the history with regular expressions."""
+    import re
+
+    dialog = []
+    for chat_element in chat_history.values():
+        if chat_element['username'] == main_gpt.BOT_USERNAME and re.match(f'^{main_gpt.ANSWEAR_FLAG}', chat_element['message_text']):
+            dialog.append((main_gpt.MESSAGE_ANSWER, chat_element))
+        elif chat_element['username'] != main_gpt.BOT_USERNAME and re.match(f'@{main_gpt.BOT_USERNAME}|{main_gpt.ASK_START_FLAG}', chat_element['message_text']):
+            dialog.append((main_gpt.MESSAGE_QUESTION, chat_element))
+    return main_gpt.make_chatbot_history(dialog)
+
+def bench_dialog_index(chatter=(0, 1000, 9000), dialog_messages=1000, repeat=20):
+    """Chatbot context build time with the regex scan of the history and with the dialog index."""
+    import main_gpt
+    from chat_storage import ChatHistoryCache
+
+    print('chatter messages | scan, ms | index, ms')
+    for number in chatter:
+        with tempfile.TemporaryDirectory() as path:
+            cache = ChatHistoryCache(SegmentedChatLog(path, main_gpt.MAX_CHAT_HISTORY_LEN), classify=main_gpt.classify_message)
+            dialog = iter(make_dialog_history(main_gpt, dialog_messages).values())
+            # The dialog is spread evenly over the ordinary group messages
+            every = max(1, (number + dialog_messages) // dialog_messages)
+            for message_id in range(number + dialog_messages):
+                message_data = next(dialog, None) if message_id % every == 0 else None
+                cache.append('Bench', message_id, message_data or make_record(message_id))
+            cache.flush()
+            chat_history = cache.get('Bench')
+
+            expected = scan_make_chatbot_history(main_gpt, chat_history)
+            assert main_gpt.make_chatbot_history(cache.get_dialog('Bench', main_gpt.MAX_CHAT_MEMORY_LEN)) == expected
+
+            timings = []
+            for function in (lambda: scan_make_chatbot_history(main_gpt, chat_history),
+                             lambda: main_gpt.make_chatbot_history(cache.get_dialog('Bench', main_gpt.MAX_CHAT_MEMORY_LEN))):
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    function()
+                timings.append((time.perf_counter() - start) / repeat)
+            print(f'{number:>16} | {timings[0] * 1000:>8.2f} | {timings[1] * 1000:>9.3f}')
+
+
+def bench_time_range(messages=10000, undated=500, ranges=('30m', '3h', '1d12h', '2w', 'yesterday 18:00', '12:00'), repeat=100):
+    """Resolving a /sum_up time range to a message count with a scan of the dates and with bisect, and reading it from the disk."""
+    import random
+    import main_gpt
+    from chat_storage import ChatHistoryCache
+
+    now = time.time()
+    day_start = time.mktime(time.localtime(now)[:3] + (0, 0, 0, 0, 0, -1))
+    assert main_gpt.parse_sum_up_range(' 250 ') == (250, None)
+    assert main_gpt.parse_sum_up_range('1d 12h', now) == (None, now - 36 * 3600)
+    assert main_gpt.parse_sum_up_range('today', now) == (None, day_start)
+    assert main_gpt.parse_sum_up_range('2024-05-01 18:00') == (None, time.mktime((2024, 5, 1, 18, 0, 0, 0, 0, -1)))
+    assert main_gpt.parse_sum_up_range('23:59', now)[1] <= now
+    for wrong in ('', '0', '000', 'abc', '3x', '25:00', '2024-13-01', 'yesterday at 18'):
+        assert main_gpt.parse_sum_up_range(wrong, now) is None, wrong
+
+    # A month of bursty chat, the oldest messages were saved before the dates were stored
+    random.seed(1)
+    gaps = [random.expovariate(1) * random.choice((0, 0.1, 1, 3)) for _ in range(messages - undated)]
+    date = now - 30 * 86400
+    with tempfile.TemporaryDirectory() as path:
+        cache = ChatHistoryCache(SegmentedChatLog(path, main_gpt.MAX_CHAT_HISTORY_LEN))
+        for message_id in range(messages):
+            message_data = make_record(message_id)
+            if message_id >= undated:
+                date += gaps[message_id - undated] * 30 * 86400 / sum(gaps)
+                message_data['date'] = int(date)
+            cache.append('Bench', message_id, message_data)
+        cache.flush()
+        chat_history = cache.chat_log.load('Bench')
+
+        scan = lambda since: sum(1 for message_data in chat_history.values() if message_data.get('date', 0) >= since)
+        chat_log = cache.chat_log
+        segments = chat_log._get_segments('Bench')
+        print('range           | messages | scan, ms | bisect, ms | segments read | full load, ms | range load, ms')
+        for text in ranges:
+            since = main_gpt.parse_sum_up_range(text, now)[1]
+            count = chat_history.count_since(since)
+            assert count == scan(since), text
+            assert chat_log.load('Bench', since=since).count_since(since) == count, text
+
+            timings = []
+            for function, times in ((scan, 1), (chat_history.count_since, repeat),
+                                    (lambda since: chat_log.load('Bench'), 3), (lambda since: chat_log.load('Bench', since=since), 3)):
+                start = time.perf_counter()
+                for _ in range(times):
+                    function(since)
+                timings.append((time.perf_counter() - start) / times)
+            read = len(segments) - chat_log._first_segment_since('Bench', segments, since)
+            print(f'{text:<15} | {count:>8} | {timings[0] * 1000:>8.2f} | {timings[1] * 1000:>10.4f} | '
+                  f'{read:>6} of {len(segments):>3} | {timings[2] * 1000:>13.1f} | {timings[3] * 1000:>14.1f}')
+
+
+def bench_related(messages=10000, appends=1000, queries=200, k=20):
+    """Search index of a group chat: build, update per message, query and the question prompt it feeds."""
+    import random
+    import main_gpt
+    from chat_storage import ChatHistoryCache
+    from text_index import TextIndex
+
+    random.seed(1)
+    words = [f'word{number}' for number in range(5000)]
+    # Zipf-like word frequencies, a few words are in every other message
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    common = ['the', 'and', 'to', 'is', 'we', 'it']
+    make_text = lambda: ' '.join(random.choices(common, k=4) + random.choices(words, weights, k=random.randint(3, 15)))
+    facts = {
+        'what did Anna decide about the release?': 'ok, the release moves to Friday, we ship after the QA sign-off',
+        'who fixed the payment timeout bug': 'pushed the fix for the payment timeout, retries are capped now',
+    }
+    senders = {facts['what did Anna decide about the release?']: 'Anna', facts['who fixed the payment timeout bug']: 'boris'}
+
+    with tempfile.TemporaryDirectory() as path:
+        cache = ChatHistoryCache(SegmentedChatLog(path, main_gpt.MAX_CHAT_HISTORY_LEN),
+                                 classify=main_gpt.classify_message, index_text=main_gpt.index_text)
+        planted = {random.randrange(messages // 2, messages): text for text in facts.values()}
+        for message_id in range(messages):
+            text = planted.get(message_id) or make_text()
+            message_data = dict(make_record(message_id), username=senders.get(text, f'user_{message_id % 50}'),
+                                message_text=text, date=int(time.time()) - messages + message_id)
+            cache.append('Bench', message_id, message_data)
+        chat_history = cache.get('Bench')
+
+        start = time.perf_counter()
+        cache.search('Bench', 'warm up', k)
+        build_time = time.perf_counter() - start
+
+        def scan(query):
+            # BM25 of every message without an index
+            index = TextIndex(chat_history.first_seq)
+            for seq, message_data in enumerate(chat_history.values(), chat_history.first_seq):
+                text = main_gpt.index_text(message_data)
+                if text is not None:
+                    index.add(seq, text)
+            return index.search(query, k)
+
+        for question, fact in facts.items():
+            found = cache.search('Bench', question, k)
+            assert found[0][1]['message_text'] == fact, question
+            assert [seq for seq, _ in found] == [seq for seq, _ in scan(question)], question
+        start = time.perf_counter()
+        scan('what did Anna decide about the release?')
+        scan_time = time.perf_counter() - start
+
+        query_list = [' '.join(random.choices(common, k=2) + random.choices(words, weights, k=random.randint(2, 6)))
+                      for _ in range(queries)]
+        timings = []
+        for query in query_list:
+            start = time.perf_counter()
+            cache.search('Bench', query, k)
+            timings.append(time.perf_counter() - start)
+
+        # New messages past MAX_CHAT_HISTORY_LEN, every one updates the index and trims the oldest one
+        append_timings = {}
+        for indexed in (False, True):
+            if not indexed:
+                cache._indexes.clear()
+            timings_append = []
+            for message_id in range(messages + indexed * appends, messages + (indexed + 1) * appends):
+                message_data = dict(make_record(message_id), message_text=make_text(), date=int(time.time()))
+                start = time.perf_counter()
+                cache.append('Bench', message_id, message_data)
+                timings_append.append(time.perf_counter() - start)
+            append_timings[indexed] = timings_append
+            if not indexed:
+                cache.search('Bench', 'warm up', k)
+        assert cache._indexes['Bench'].first_seq == chat_history.first_seq
+        question = 'what did Anna decide about the release?'
+        assert cache.search('Bench', question, k) == cache.search('Bench', question, k)
+
+        print(f'messages in the chat: {len(chat_history)}, indexed terms: {len(cache._indexes["Bench"]._postings)}')
+        print(f'index build on the first question: {build_time * 1000:.1f} ms')
+        print(f'append, us p50/p95: without index {percentile(append_timings[False], 0.5) * 1e6:.0f}/'
+              f'{percentile(append_timings[False], 0.95) * 1e6:.0f}, '
+              f'with index {percentile(append_timings[True], 0.5) * 1e6:.0f}/{percentile(append_timings[True], 0.95) * 1e6:.0f}')
+        print(f'query, ms p50/p95: {percentile(timings, 0.5) * 1000:.2f}/{percentile(timings, 0.95) * 1000:.2f}, '
+              f'scan of the history without index: {scan_time * 1000:.0f} ms')
+
+        related = cache.search('Bench', question, k)
+        dialog = [(main_gpt.MESSAGE_QUESTION, {'username': 'Anna', 'message_text': f'@{main_gpt.BOT_USERNAME} {question}'})]
+        chatbot_messages = main_gpt.make_chatbot_history(dialog, related)
+        prompt_tokens = main_gpt.num_tokens_from_messages(chatbot_messages, main_gpt.AI_MODEL_NAME)
+        assert prompt_tokens <= main_gpt.MAX_TOKENS
+        assert facts[question] in chatbot_messages[1]['content']
+        print(f'question prompt: {len(chatbot_messages[1]["content"].splitlines()) - 1} related messages, '
+              f'{prompt_tokens} of {main_gpt.MAX_TOKENS} tokens')
+
+
+def _traced_bytes(make):
+    """Return the object made by make() and the bytes it allocated."""
+    import gc
+    import tracemalloc
+
+    gc.collect()
+    tracemalloc.start()
+    result = make()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+def bench_history_memory(sizes=(1000, 10000), users=50):
+    """Memory per message of a resident chat history as a dict of dicts and as a CompactHistory."""
+    texts = ['good morning everyone', 'I will be late for the meeting today, start without me',
+             'can someone review my pull request please, it is a small one', 'ok', 'lol 😂']
+    print('messages | dict of dicts, bytes/msg | compact, bytes/msg | ratio')
+    for size in sizes:
+        # JSON lines like the ones of the chat log, every decoded record has its own key strings
+        lines = [json.dumps({'message_id': 1000 + i, 'chat_id': -1001234567890, 'user_id': 100000 + i % users,
+                             'username': f'user_{i % users}', 'message_text': texts[i % len(texts)] + f' {i}',
+                             'tokens': 5 + i % 10}, ensure_ascii=False) for i in range(size)]
+
+        def load_dict():
+            chat_history = {}
+            for line in lines:
+                record = json.loads(line)
+                chat_history[str(record.pop('message_id'))] = record
+            return chat_history
+
+        def load_compact():
+            chat_history = CompactHistory()
+            for line in lines:
+                record = json.loads(line)
+                chat_history[str(record.pop('message_id'))] = record
+            return chat_history
+
+        dict_history, dict_bytes = _traced_bytes(load_dict)
+        compact_history, compact_bytes = _traced_bytes(load_compact)
+        assert list(compact_history.items()) == list(dict_history.items())
+        print(f'{size:>8} | {dict_bytes / size:>24.0f} | {compact_bytes / size:>18.0f} | {dict_bytes / compact_bytes:>5.1f}')
+
+
+def bench_sum_up_truncation(sizes=(1000, 10000), text_lengths=(5, 50)):
+    """Check that the /sum_up prompt fits MAX_TOKENS and holds only whole messages, and time it."""
+    import main_gpt
+
+    print('messages | words/msg | tokens | whole messages | time, ms')
+    for size in sizes:
+        for words in text_lengths:
+            chat_history = CompactHistory((str(i), {'chat_id': 1, 'user_id': i % 7, 'username': f'user_{i % 7}',
+                                                    'message_text': ' '.join(f'word{(i + j) % 97}' for j in range(words))})
+                                          for i in range(size))
+            start = time.perf_counter()
+            chat_text = main_gpt.format_chat_from_json2text(chat_history, size)
+            elapsed = time.perf_counter() - start
+
+            tokens = main_gpt.count_tokens(main_gpt.make_prompt(chat_text)[0]['content'])
+            assert tokens <= main_gpt.MAX_TOKENS, tokens
+            lines = chat_text.splitlines()
+            kept = list(chat_history.values())[-len(lines):]
+            whole = all(line == f"@{m['username']} : {m['message_text']}" for line, m in zip(lines, kept))
+            assert whole
+            print(f'{size:>8} | {words:>9} | {tokens:>6} | {str(whole):>14} | {elapsed * 1000:>8.1f}')
+
+
+class RecordingCompletion:
+    """Stub completion backend that records the fan-out of map-reduce calls."""
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def __call__(self, prompt):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.calls.append(prompt[0]['content'])
+        await asyncio.sleep(self.latency)
+        self.in_flight -= 1
+        return f'summary {len(self.calls)}'
+
+def bench_map_reduce(sizes=(100, 1000, 5000), max_tokens=2000, concurrency=4):
+    """Calls, parallelism and latency of the map-reduce /sum_up with a stubbed completion backend and through CompletionClient."""
+    from summarizer import split_into_chunks, summarize_chunks
+
+    count_tokens = lambda text: len(text.split())
+    make_prompt = lambda text: [{'role': 'user', 'content': 'map ' + text}]
+    make_reduce_prompt = lambda text: [{'role': 'user', 'content': 'reduce ' + text}]
+
+    print('messages | chunks | calls | reduce calls | max parallel | time, s')
+    for size in sizes:
+        lines = [f"@{make_record(i)['username']} : {make_record(i)['message_text']}\n" for i in range(size)]
+        chunks = split_into_chunks(lines, [count_tokens(line) for line in lines], max_tokens)
+        complete = RecordingCompletion()
+
+        start = time.perf_counter()
+        asyncio.run(summarize_chunks(chunks, complete, make_prompt, make_reduce_prompt, count_tokens, max_tokens, concurrency))
+        elapsed = time.perf_counter() - start
+
+        reduce_calls = sum(call.startswith('reduce') for call in complete.calls)
+        assert complete.max_in_flight <= concurrency
+        print(f'{size:>8} | {len(chunks):>6} | {len(complete.calls):>5} | {reduce_calls:>12} | '
+              f'{complete.max_in_flight:>12} | {elapsed:>7.2f}')
+
+    # The same fan-out through the handlers and CompletionClient: a /sum_up holds one slot of the user
+    # and its chunks share the global slots
+    import openai
+    import main_gpt
+    import send_queue
+    from fake_telegram import private_message
+    from load_test import LoadTest, TrafficProfile
+
+    async def sum_up(path, messages, sum_up_concurrency):
+        test = LoadTest(TrafficProfile(groups=1, users=1, history_depth=0), path)
+        server = await FakeOpenAIServer(latency=0.2).start()
+        openai.api_base, openai.api_key = server.api_base, 'fake'
+        test.install()
+        await test.setup()
+        # Distinct messages, chunks with the same text would be answered once by the completion cache
+        main_gpt.chat_log.append(test.group(0)[1], ((i, make_record(i)) for i in range(messages)))
+        await main_gpt.send_queue.join()
+        main_gpt.SUM_UP_CONCURRENCY = sum_up_concurrency
+
+        client = main_gpt.completion_client
+        create = client._create
+        in_flight = max_in_flight = 0
+
+        async def counting_create(*args, **kwargs):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            try:
+                return await create(*args, **kwargs)
+            finally:
+                in_flight -= 1
+        client._create = counting_create
+
+        try:
+            await main_gpt.sum_up(test.make_update(private_message, 1, 1, '/sum_up'), None)
+            await main_gpt.send_queue.join()
+            # The send budget of the chat is refilled, so the time is the answer's and not the pacing of the chat list
+            await asyncio.sleep(send_queue.CHAT_BURST / send_queue.PRIVATE_CHAT_RATE)
+            start = time.perf_counter()
+            await main_gpt.text_message_parser(test.make_update(private_message, 1, 1, f'{test.group(0)[1]}\n{messages}'), None)
+            elapsed = time.perf_counter() - start
+            return len(server.requests), max_in_flight, elapsed
+        finally:
+            await server.stop()
+            main_gpt.registry.close()
+
+    print('\n/sum_up through CompletionClient, 0.2 s per request')
+    print('messages | SUM_UP_CONCURRENCY | openai requests | max parallel | time, s')
+    sum_up_concurrency = main_gpt.SUM_UP_CONCURRENCY
+    try:
+        for messages in sizes[1:]:
+            for limit in (1, sum_up_concurrency):
+                with tempfile.TemporaryDirectory() as path:
+                    requests, parallel, elapsed = asyncio.run(sum_up(path, messages, limit))
+                assert parallel <= limit and (requests < 3 or limit == 1 or parallel > 1)
+                print(f'{messages:>8} | {limit:>18} | {requests:>15} | {parallel:>12} | {elapsed:>7.2f}')
+    finally:
+        main_gpt.SUM_UP_CONCURRENCY = sum_up_concurrency
+
+
+def bench_registry(users=100000, chats=10000, chats_per_user=3, lookups=10000):
+    """Registration store at 100k users against a directory of per-user JSON files."""
+    import random
+    from registry import Registry
+
+    random.seed(1)
+    user_chats = {user_id: random.sample(range(chats), chats_per_user) for user_id in range(users)}
+
+    with tempfile.TemporaryDirectory() as path:
+        start = time.perf_counter()
+        for user_id, chat_ids in user_chats.items():
+            with open(os.path.join(path, f'user_{user_id}.json'), 'w') as f:
+                json.dump({f'Chat {chat_id}': chat_id for chat_id in chat_ids}, f)
+        print(f'write {users} access files: {time.perf_counter() - start:.2f} s')
+
+        registry = Registry(os.path.join(path, 'registry.sqlite3'))
+        start = time.perf_counter()
+        registry.migrate_json_access(path)
+        print(f'migrate them to sqlite: {time.perf_counter() - start:.2f} s')
+
+        user_ids = random.sample(range(users), lookups)
+        start = time.perf_counter()
+        for user_id in user_ids:
+            title = 'chat ' + str(user_chats[user_id][0])
+            assert registry.find_user_chat(user_id, title)[1] == user_chats[user_id][0]
+        print(f'case-insensitive lookup: {(time.perf_counter() - start) / lookups * 1e6:.1f} us')
+
+        start = time.perf_counter()
+        for user_id in user_ids:
+            registry.get_user_chats(user_id)
+        print(f'list user chats: {(time.perf_counter() - start) / lookups * 1e6:.1f} us')
+
+        start = time.perf_counter()
+        for chat_id in range(100):
+            registry.chat_users(chat_id)
+        print(f'users of a chat (sqlite index): {(time.perf_counter() - start) / 100 * 1e6:.1f} us')
+
+        start = time.perf_counter()
+        for user_id in range(users):
+            with open(os.path.join(path, f'user_{user_id}.json.migrated'), 'r') as f:
+                'Chat 0' in json.load(f)
+        print(f'users of a chat (scan of json files): {time.perf_counter() - start:.2f} s')
+
+        start = time.perf_counter()
+        for user_id in user_ids[:1000]:
+            registry.register_chat(user_id, chats + user_id, f'New chat {user_id}')
+        print(f'transactional register: {(time.perf_counter() - start) / 1000 * 1e6:.1f} us')
+        registry.close()
+
+
+make_update_json = lambda update_id, chat_id: {
+    'update_id': update_id,
+    'message': {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'Group {chat_id}'},
+        'from': {'id': update_id % 1000, 'is_bot': False, 'first_name': 'User', 'username': f'user_{update_id % 1000}'},
+        'text': f'message {update_id}',
+    },
+}
+
+async def _webhook_load(updates, chats, senders, processing_time, queue_size, workers):
+    import aiohttp
+    from webhook import WebhookServer
+
+    async def process_update(data):
+        await asyncio.sleep(processing_time)
+
+    server = await WebhookServer(process_update, host='127.0.0.1', port=0, queue_size=queue_size,
+                                 workers=workers).start(stats_interval=None)
+    url = f'http://127.0.0.1:{server.port}{server.path}'
+    statuses = {}
+    max_depth = 0
+
+    async def sender(number, session):
+        nonlocal max_depth
+        for update_id in range(number, updates, senders):
+            async with session.post(url, json=make_update_json(update_id, update_id % chats)) as response:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+            max_depth = max(max_depth, server.queue_depth())
+
+    start = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(sender(number, session) for number in range(senders)))
+    await server.stop()
+    elapsed = time.perf_counter() - start
+
+    return server.stats(), statuses, max_depth, elapsed
+
+def bench_webhook(updates=5000, chats=200, senders=50, processing_time=0.01, queue_size=1000, workers=(1, 16, 64)):
+    """POST synthetic updates to the local webhook server and report throughput, queue depth and shedding."""
+    print('workers | processed | shed | max queue depth | updates/s')
+    for number in workers:
+        stats, statuses, max_depth, elapsed = asyncio.run(
+            _webhook_load(updates, chats, senders, processing_time, queue_size, number))
+        print(f'{number:>7} | {stats["processed"]:>9} | {stats["shed"]:>4} | {max_depth:>15} | '
+              f'{stats["processed"] / elapsed:>9.0f}')
+
+
+async def _send_queue_load(chats_listed, progress_edits, retry_after_every):
+    from send_queue import SendQueue
+
+    bot = FakeBot(retry_after_every=retry_after_every)
+    send_queue = SendQueue(bot, private_chat_rate=10, chat_burst=3)
+    chat_id = 1
+
+    start = time.perf_counter()
+    # show_chats of a user with many groups
+    send_queue.send_nowait(chat_id, 'Chat that you registered:\n')
+    for number in range(chats_listed):
+        send_queue.send_nowait(chat_id, f'Group number {number} ' + 'x' * 100 + '\n')
+    # progress edits of one answer
+    progress_message = await send_queue.send(chat_id, '.', merge=False)
+    for number in range(progress_edits):
+        send_queue.edit(chat_id, progress_message.message_id, '. ' * (number % 3 + 1))
+    await send_queue.send(chat_id, 'answer', merge=False)
+    await send_queue.join()
+    elapsed = time.perf_counter() - start
+
+    assert all(len(text) <= 4096 for text in bot.messages.values())
+    return bot.calls, send_queue.stats(), elapsed
+
+def bench_send_queue(chats_listed=(10, 50, 200), progress_edits=20):
+    """Telegram API calls for a long /show_chats list and a burst of progress edits through the send queue."""
+    print('listed chats | naive calls | sends | edits | merged | superseded | retries | time, s')
+    for number in chats_listed:
+        for retry_after_every in (0, 7):
+            calls, stats, elapsed = asyncio.run(_send_queue_load(number, progress_edits, retry_after_every))
+            naive = number + 1 + 1 + progress_edits + 1
+            print(f'{number:>12} | {naive:>11} | {calls["send_message"]:>5} | {calls["edit_message_text"]:>5} | '
+                  f'{stats["merged"]:>6} | {stats["superseded"]:>10} | {stats["retries"]:>7} | {elapsed:>7.2f}')
+
+
+async def _streaming_latency(chats, stream):
+    from llm_client import CompletionClient
+
+    client = CompletionClient(max_concurrency=chats, timeout=30)
+    first_tokens, totals = [], []
+
+    async def chat(user_id):
+        start = time.perf_counter()
+        first_token = []
+        on_delta = lambda text: first_token or first_token.append(time.perf_counter() - start)
+        messages = [{'role': 'user', 'content': f'question {user_id}'}]
+        if stream:
+            await client.stream(messages, model='gpt-3.5-turbo', on_delta=on_delta, user_id=user_id)
+        else:
+            on_delta(await client.complete(messages, model='gpt-3.5-turbo', user_id=user_id))
+        first_tokens.append(first_token[0])
+        totals.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(chat(user_id) for user_id in range(chats)))
+    return first_tokens, totals
+
+def bench_streaming(chats=(1, 16), words=200, latency=0.3, token_delay=0.01):
+    """Time to the first answer text shown to the user with and without streamed completions."""
+    start_fake_openai(latency=latency, token_delay=token_delay, reply='<answear>\n' + ' '.join(['word'] * words))
+    print('mode       | chats | first text p50, ms | first text p99, ms | total p50, ms')
+    for stream in (False, True):
+        for number in chats:
+            first_tokens, totals = asyncio.run(_streaming_latency(number, stream))
+            mode = 'stream' if stream else 'complete'
+            print(f'{mode:<10} | {number:>5} | {percentile(first_tokens, 0.5) * 1000:>18.0f} | '
+                  f'{percentile(first_tokens, 0.99) * 1000:>18.0f} | {percentile(totals, 0.5) * 1000:>13.0f}')
+
+
+def bench_load(profile='smoke'):
+    """Replay a traffic profile of load_test.py through the handlers."""
+    from load_test import PROFILES, run_load_test, print_report
+
+    print_report(run_load_test(PROFILES[profile]))
+
+
+def bench_digests(groups=20, active=5, messages=50):
+    """Scheduled digest runs: work for changed and unchanged chats, the concurrency cap and /sum_up from a digest."""
+    import openai
+    import main_gpt
+    import send_queue
+    from fake_telegram import private_message, group_message
+    from llm_client import CompletionClient
+    from load_test import LoadTest, TrafficProfile
+
+    async def run(path):
+        test = LoadTest(TrafficProfile(groups=groups, users=groups, history_depth=0), path)
+        server = await FakeOpenAIServer(latency=0.2).start()
+        openai.api_base, openai.api_key = server.api_base, 'fake'
+        test.install()
+        await test.setup()
+        main_gpt.DIGEST_HOURS = {}
+
+        # Every group owner wants daily digests pushed to them
+        for number in range(groups):
+            owner = number + 1
+            await main_gpt.digest(test.make_update(private_message, owner, owner, '/digest'), None)
+            await main_gpt.text_message_parser(test.make_update(private_message, owner, owner, f'{test.group(number)[1]}\ndaily push'), None)
+
+        async def chatter(numbers):
+            for number in numbers:
+                chat_id, title = test.group(number)
+                for message in range(messages):
+                    update = test.make_update(group_message, chat_id, chat_id, title, message % groups + 1, f'message {message} of {title}')
+                    await main_gpt.text_message_parser(update, None)
+            await main_gpt.flush_chat_history(None)
+
+        in_flight = max_in_flight = 0
+        make_digest = main_gpt.make_digest
+
+        async def counted_make_digest(*args):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            try:
+                return await make_digest(*args)
+            finally:
+                in_flight -= 1
+
+        main_gpt.make_digest = counted_make_digest
+        print('run                    | made | unchanged | openai requests | max parallel | time, s')
+
+        async def digest_run(name):
+            nonlocal max_in_flight
+            max_in_flight = 0
+            before = {result: main_gpt.DIGESTS.value(result=result) for result in ('made', 'unchanged')}
+            requests = len(server.requests)
+            start = time.perf_counter()
+            await main_gpt.run_digests(None)
+            elapsed = time.perf_counter() - start
+            made, unchanged = (main_gpt.DIGESTS.value(result=result) - before[result] for result in ('made', 'unchanged'))
+            assert max_in_flight <= main_gpt.DIGEST_CONCURRENCY
+            print(f'{name:<22} | {made:>4} | {unchanged:>9} | {len(server.requests) - requests:>15} | {max_in_flight:>12} | {elapsed:>7.2f}')
+            return made, unchanged, len(server.requests) - requests
+
+        try:
+            await chatter(range(groups))
+            assert (await digest_run('first'))[0] == groups
+            assert (await digest_run('again, not due')) == (0, 0, 0)
+
+            # A day later only the active groups got new messages
+            for number in range(groups):
+                main_gpt.digest_store.last(test.group(number)[1], main_gpt.DIGEST_PERIODS['daily'])['until'] -= 86400
+            await chatter(range(active))
+            assert (await digest_run(f'next day, {active} active'))[:2] == (active, groups - active)
+
+            await main_gpt.send_queue.join()
+            pushed = sum(text.startswith('Your daily digest') for text in test.bot.messages.values())
+            print(f'digests pushed to the owners: {pushed}')
+
+            print('/sum_up 1d of group 0 | openai requests | answer time, ms')
+            for source in ('digest', 'newer messages', 'computed'):
+                if source == 'newer messages':
+                    # The digest misses a message sent after it, the cached summary of the digest is extended instead
+                    chat_id, title = test.group(0)
+                    await main_gpt.text_message_parser(test.make_update(group_message, chat_id, chat_id, title, 1, 'one more message'), None)
+                if source == 'computed':
+                    # The only subscriber turns the digests off, which drops the stored ones
+                    await main_gpt.digest(test.make_update(private_message, 1, 1, '/digest'), None)
+                    await main_gpt.text_message_parser(test.make_update(private_message, 1, 1, f'{test.group(0)[1]}\noff'), None)
+                    assert main_gpt.digest_store.last(test.group(0)[1], main_gpt.DIGEST_PERIODS['daily']) is None
+                    main_gpt.summary_cache.remove(test.group(0)[1])
+                    main_gpt.completion_client = CompletionClient()
+                await main_gpt.sum_up(test.make_update(private_message, 1, 1, '/sum_up'), None)
+                await main_gpt.send_queue.join()
+                # The send budget of the chat is refilled, so the time is the answer's and not the pacing of the chat list
+                await asyncio.sleep(send_queue.CHAT_BURST / send_queue.PRIVATE_CHAT_RATE)
+                requests = len(server.requests)
+                start = time.perf_counter()
+                await main_gpt.text_message_parser(test.make_update(private_message, 1, 1, f'{test.group(0)[1]}\n1d'), None)
+                elapsed = time.perf_counter() - start
+                assert (len(server.requests) > requests) == (source != 'digest')
+                print(f'{source:<21} | {len(server.requests) - requests:>15} | {elapsed * 1000:>16.1f}')
+        finally:
+            main_gpt.make_digest = make_digest
+            await server.stop()
+            main_gpt.registry.close()
+
+    with tempfile.TemporaryDirectory() as path:
+        asyncio.run(run(path))
+
+
+class BenchShardHandler:
+    """Shard worker that runs the group message handler of main_gpt on a temporary chat log."""
+
+    def __init__(self, shard):
+        self.shard = shard
+        self.path = None
+
+    async def start(self):
+        import main_gpt
+        from chat_storage import ChatHistoryCache
+
+        self.path = tempfile.mkdtemp()
+        main_gpt.chat_log = SegmentedChatLog(self.path, main_gpt.MAX_CHAT_HISTORY_LEN)
+        main_gpt.chat_history_cache = ChatHistoryCache(main_gpt.chat_log, classify=main_gpt.classify_message, index_text=main_gpt.index_text)
+        main_gpt.shard = self.shard
+
+    async def process_update(self, data):
+        import main_gpt
+        from telegram import Update
+
+        await main_gpt.text_message_parser(Update.de_json(data, None), None)
+
+    async def flush(self, chat_name):
+        import main_gpt
+
+        main_gpt.chat_history_cache.flush(chat_name)
+
+    async def stop(self):
+        import shutil
+        import main_gpt
+
+        main_gpt.chat_history_cache.flush()
+        shutil.rmtree(self.path)
+        return main_gpt.chat_history_cache.stats()
+
+def bench_sharding(workers=(1, 2, 4, 8), updates=20000, chats=500):
+    """Group message throughput of the multi-worker mode at 1, 2, 4 and 8 shard workers."""
+    from sharding import ShardRouter
+
+    print(f'{os.cpu_count()} CPUs')
+    print('workers | updates/s | speedup | min/max updates per worker')
+    first = None
+    for number in workers:
+        router = ShardRouter(number, BenchShardHandler).start(wait=True)
+        start = time.perf_counter()
+        for update_id in range(updates):
+            router.dispatch(make_update_json(update_id, -update_id % chats - 1))
+        stats = router.stop(timeout=600)
+        elapsed = time.perf_counter() - start
+
+        assert sum(worker['processed'] for worker in stats.values()) == updates, stats
+        throughput = updates / elapsed
+        first = first or throughput
+        print(f'{number:>7} | {throughput:>9.0f} | {throughput / first:>7.2f} | '
+              f'{min(router.dispatched)}/{max(router.dispatched)}')
+
+
+async def _stress_updates(processor, updates, chat_ids, path):
+    import random
+    import main_gpt
+    from chat_storage import ChatHistoryCache
+    from telegram import Update
+    from fake_telegram import group_message
+
+    main_gpt.chat_log = SegmentedChatLog(path, main_gpt.MAX_CHAT_HISTORY_LEN, segment_len=100)
+    main_gpt.chat_history_cache = ChatHistoryCache(main_gpt.chat_log, flush_threshold=50, classify=main_gpt.classify_message, index_text=main_gpt.index_text)
+    sent = {}
+    rng = random.Random(1)
+
+    async def handle(update):
+        # Random delays let the updates overtake each other unless the processor keeps them in order
+        await asyncio.sleep(rng.random() * 0.002)
+        await main_gpt.text_message_parser(update, None)
+
+    await processor.initialize()
+    tasks = []
+    for update_id, chat_id in enumerate(chat_ids(updates)):
+        number = sent.setdefault(chat_id, [])
+        number.append(update_id)
+        data = group_message(update_id, update_id, chat_id, f'Stress {-chat_id}', update_id % 50, f'number {len(number) - 1}')
+        update = Update.de_json(data, None)
+        tasks.append(asyncio.create_task(processor.process_update(update, handle(update))))
+        if update_id % 500 == 0:
+            tasks.append(asyncio.create_task(main_gpt.flush_chat_history(None)))
+            await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    await processor.shutdown()
+    await main_gpt.flush_chat_history(None)
+    return {chat_id: len(numbers) for chat_id, numbers in sent.items()}
+
+def _check_chat_logs(path, sent):
+    """Reload the chat logs from the disk, return (lost messages, chats out of order, corrupt lines)."""
+    from chat_storage import open_segment, parse_segment_name
+
+    lost = unordered = corrupt = 0
+    chat_log = SegmentedChatLog(path, 10**9)
+    for chat_id, count in sent.items():
+        texts = [message['message_text'] for message in chat_log.load(f'Stress {-chat_id}').values()]
+        lost += count - len(texts)
+        unordered += texts != sorted(texts, key=lambda text: int(text.split()[1]))
+        chat_path = chat_log.chat_path(f'Stress {-chat_id}')
+        for name in os.listdir(chat_path):
+            with open_segment(os.path.join(chat_path, name), parse_segment_name(name)[2]) as f:
+                for line in f:
+                    try:
+                        json.loads(line)
+                    except ValueError:
+                        corrupt += 1
+    return lost, unordered, corrupt
+
+def _stress_torn_line(path):
+    """Append a half written line like a crash would and check that the chat log recovers."""
+    chat_log = SegmentedChatLog(path, 10**9)
+    chat_log.append('Torn', [(number, make_record(number)) for number in range(10)])
+    with open(os.path.join(chat_log.chat_path('Torn'), os.listdir(chat_log.chat_path('Torn'))[0]), 'ab') as f:
+        f.write(b'{"message_id": 10, "chat_id": -1')
+
+    chat_log = SegmentedChatLog(path, 10**9)
+    assert list(chat_log.load('Torn')) == [str(number) for number in range(10)]
+    chat_log.append('Torn', [(10, make_record(10))])
+    assert list(SegmentedChatLog(path, 10**9).load('Torn')) == [str(number) for number in range(11)]
+
+def _stress_summary_cache(path, writers=4, writes=200):
+    """Write summaries from several threads while reading the file, return the failed reads."""
+    from summarizer import SummaryCache
+
+    caches = [SummaryCache(path) for _ in range(writers)]
+    file = caches[0]._file('Stress')
+    done = threading.Event()
+    failed_reads = 0
+
+    def write(cache):
+        for number in range(writes):
+            cache.put('Stress', number, number + 1, 'summary text ' * 200, 100, 1, 2)
+
+    def read():
+        nonlocal failed_reads
+        while not done.is_set():
+            try:
+                with open(file, 'r') as f:
+                    json.load(f)
+            except FileNotFoundError:
+                pass
+            except ValueError:
+                failed_reads += 1
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    threads = [threading.Thread(target=write, args=(cache,)) for cache in caches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    reader.join()
+    assert not [name for name in os.listdir(path) if name.endswith('.tmp')]
+    return failed_reads
+
+def bench_stress(updates=5000, chats=200):
+    """Concurrent group updates to one hot chat and many chats, then a check of the chat logs on the disk."""
+    from telegram.ext import SimpleUpdateProcessor
+    from update_processor import ChatOrderedUpdateProcessor
+
+    workloads = {
+        'one chat': lambda count: [-1] * count,
+        'many chats': lambda count: [-(number % chats) - 1 for number in range(count)],
+        'mixed': lambda count: [-1 if number % 2 else -(number % chats) - 1 for number in range(count)],
+    }
+    print('processor    | workload   | updates/s | lost | chats out of order | corrupt lines')
+    for processor_name, make_processor in (('chat ordered', lambda: ChatOrderedUpdateProcessor(64)),
+                                           ('simple', lambda: SimpleUpdateProcessor(64))):
+        for workload, chat_ids in workloads.items():
+            with tempfile.TemporaryDirectory() as path:
+                start = time.perf_counter()
+                sent = asyncio.run(_stress_updates(make_processor(), updates, chat_ids, path))
+                elapsed = time.perf_counter() - start
+                lost, unordered, corrupt = _check_chat_logs(path, sent)
+            print(f'{processor_name:<12} | {workload:<10} | {updates / elapsed:>9.0f} | {lost:>4} | {unordered:>18} | {corrupt:>13}')
+            assert not lost and not corrupt
+            if processor_name == 'chat ordered':
+                assert not unordered
+
+    with tempfile.TemporaryDirectory() as path:
+        _stress_torn_line(path)
+    print('torn last line: skipped on load and cut off by the next append')
+    with tempfile.TemporaryDirectory() as path:
+        print(f'summary cache: {_stress_summary_cache(path)} unparseable reads during concurrent writes')
+
+
+STARTUP_SCRIPT = '''
+import asyncio, json, os, sys, time
+start = time.perf_counter()
+import main_gpt
+imported = time.perf_counter()
+
+from telegram import Update
+from fake_telegram import group_message
+
+warmup = sys.argv[1] == 'warmup'
+latencies = []
+
+async def run():
+    if warmup:
+        # Like on_startup, the tokenizer loads while the bot connects to Telegram
+        asyncio.ensure_future(main_gpt.executors.run_io(getattr, main_gpt.tokenizer, 'encoding'))
+    # The time to connect to Telegram before the first update comes
+    await asyncio.sleep(0.2)
+    for update_id in (1, 2):
+        update = Update.de_json(group_message(update_id, update_id, -1, 'Startup', 1, 'hello there'), None)
+        update_start = time.perf_counter()
+        await main_gpt.text_message_parser(update, None)
+        latencies.append(time.perf_counter() - update_start)
+
+asyncio.run(run())
+main_gpt.executors.shutdown()
+print(json.dumps({'import': imported - start, 'first_update': latencies[0], 'second_update': latencies[1],
+                  'time_to_first_update': time.perf_counter() - start - latencies[1],
+                  'tokenizer_load': main_gpt.tokenizer.load_seconds,
+                  'encoding': getattr(main_gpt.tokenizer.encoding, 'name', 'estimate')}))
+'''
+
+def bench_startup(cache_dir=None):
+    """Time to the first processed update of a fresh bot process with an empty and a shipped tokenizer cache."""
+    import subprocess
+
+    repo = os.path.dirname(os.path.abspath(__file__))
+    cache_dir = cache_dir or os.path.join(repo, 'tiktoken_cache')
+    print('tokenizer cache | startup | import, ms | first update, ms | second update, ms | time to first update, ms | encoding')
+    with tempfile.TemporaryDirectory() as empty_cache:
+        for cache_name, cache in (('empty', empty_cache), ('shipped', cache_dir)):
+            if not os.path.isdir(cache):
+                print(f'{cache_name:<15} | {cache} not found, fill it with `python tokenizer.py download {cache}`')
+                continue
+            for startup in ('lazy', 'warmup'):
+                with tempfile.TemporaryDirectory() as path:
+                    env = dict(os.environ, TIKTOKEN_CACHE_DIR=cache, PYTHONPATH=repo)
+                    output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, startup], cwd=path, env=env,
+                                            capture_output=True, text=True, timeout=300).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                print(f"{cache_name:<15} | {startup:<7} | {result['import'] * 1000:>10.0f} | {result['first_update'] * 1000:>16.1f} | "
+                      f"{result['second_update'] * 1000:>17.1f} | {result['time_to_first_update'] * 1000:>24.0f} | {result['encoding']}")
+
+
+BENCHMARKS = {
+    'storage': bench_storage,
+    'compression': bench_compression,
+    'completion': bench_completion,
+    'openai_limits': bench_openai_limits,
+    'chatbot_history': bench_chatbot_history,
+    'dialog_index': bench_dialog_index,
+    'time_range': bench_time_range,
+    'related': bench_related,
+    'history_memory': bench_history_memory,
+    'sum_up_truncation': bench_sum_up_truncation,
+    'map_reduce': bench_map_reduce,
+    'registry': bench_registry,
+    'webhook': bench_webhook,
+    'send_queue': bench_send_queue,
+    'streaming': bench_streaming,
+    'load': bench_load,
+    'digests': bench_digests,
+    'sharding': bench_sharding,
+    'startup': bench_startup,
+    'stress': bench_stress,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        print(f'\n== {name} ==')
+        BENCHMARKS[name]()
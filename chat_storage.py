@@ -0,0 +1,740 @@
+import gzip
+import io
+import itertools
+import json
+import lzma
+import os
+import threading
+from collections import OrderedDict, deque
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import metrics
+from atomic_file import fsync_directory, write_atomic
+from compact_history import CompactHistory
+from text_index import TextIndex
+
+
+SEGMENT_LEN = 1000
+SEGMENT_EXT = '.jsonl'
+# fsync every append, so a flushed message survives a power loss and not only a crash of the bot
+SEGMENT_FSYNC = True
+# Full segments before the newest one are compressed with 'gzip', 'lzma', 'zstd' (needs zstandard) or not at all with None
+SEGMENT_COMPRESSION = 'gzip'
+COMPRESSED_EXTS = {'gzip': '.gz', 'lzma': '.xz', 'zstd': '.zst'}
+MIGRATED_EXT = '.migrated'
+
+CACHE_MAX_CHATS = 256
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_FLUSH_THRESHOLD = 50
+# Cached chats that keep a search index, see ChatHistoryCache.search
+CACHE_MAX_INDEXES = 32
+
+make_segment_name = lambda index: f'{index:08d}{SEGMENT_EXT}'
+# The message count is in the name, so scanning the segments doesn't decompress them
+make_compressed_segment_name = lambda index, count, compression: f'{index:08d}.{count}{SEGMENT_EXT}{COMPRESSED_EXTS[compression]}'
+
+
+def parse_segment_name(file_name):
+    """Return (index, message count or None, compression or None) of a segment file name, None for other files."""
+    compression = next((name for name, ext in COMPRESSED_EXTS.items() if file_name.endswith(SEGMENT_EXT + ext)), None)
+    base = file_name[:-len(COMPRESSED_EXTS[compression])] if compression else file_name
+    if not base.endswith(SEGMENT_EXT):
+        return None
+    parts = base[:-len(SEGMENT_EXT)].split('.')
+    try:
+        if compression is None and len(parts) == 1:
+            return int(parts[0]), None, None
+        if compression is not None and len(parts) == 2:
+            return int(parts[0]), int(parts[1]), compression
+    except ValueError:
+        pass
+    return None
+
+def compress(data, compression):
+    if compression == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    if compression == 'lzma':
+        return lzma.compress(data)
+    return zstandard.ZstdCompressor(level=10).compress(data)
+
+def open_segment(file, compression):
+    """Open the segment for reading binary lines, compressed segments are decompressed while they are read."""
+    if compression is None:
+        return open(file, 'rb')
+    if compression == 'gzip':
+        return gzip.open(file, 'rb')
+    if compression == 'lzma':
+        return lzma.open(file, 'rb')
+    if zstandard is None:
+        raise RuntimeError(f'Reading "{file}" needs the zstandard package')
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(file, 'rb'), closefd=True))
+
+STORAGE_SECONDS = metrics.histogram('chat_log_operation_seconds', 'Time of chat log reads and writes.', ['operation'])
+STORAGE_BYTES = metrics.counter('chat_log_bytes_total', 'Bytes read from and written to the chat log.', ['operation'])
+
+
+class SegmentedChatLog:
+    """Append-only chat history split into rotating JSON Lines segments.
+
+    Every chat gets its own directory with numbered segment files, every message
+    is one line in the newest segment. Old messages are dropped by deleting whole
+    segments, so a write never has to parse or rewrite the rest of the history.
+
+    A crash in the middle of an append leaves at most one torn last line. Readers
+    skip it and the next append cuts it off before writing.
+
+    When the newest segment is full and a new one is started, the full one is
+    compressed. Loading the last n messages decompresses only the segments that
+    hold them, and loading the messages sent since a time finds the first segment
+    it needs by bisect over the dates of the first messages of the segments.
+    """
+
+    def __init__(self, root, max_len, segment_len=SEGMENT_LEN, fsync=SEGMENT_FSYNC, compression=SEGMENT_COMPRESSION):
+        if compression == 'zstd' and zstandard is None:
+            print('zstandard is not installed, chat log segments are compressed with gzip')
+            compression = 'gzip'
+        self.root = root
+        self.max_len = max_len
+        self.segment_len = segment_len
+        self.fsync = fsync
+        self.compression = compression
+        # chat_name -> list of [segment_index, number_of_records, file_name]
+        self._segments = {}
+        # (chat_name, segment_index) of the segments whose tail was checked before appending
+        self._checked_tails = set()
+        # (chat_name, segment_index) -> date of the first message of the segment, it never changes
+        self._first_dates = {}
+
+    def chat_path(self, chat_name):
+        return os.path.join(self.root, str(chat_name))
+
+    def _scan_segments(self, chat_name):
+        """Build the segment list of a chat from the files on disk."""
+        chat_path = self.chat_path(chat_name)
+        segments = {}
+
+        if os.path.isdir(chat_path):
+            for file_name in sorted(os.listdir(chat_path)):
+                parsed = parse_segment_name(file_name)
+                if parsed is None:
+                    continue
+                index, count, compression = parsed
+                if index in segments:
+                    # A crash after the segment was compressed and before the plain one was removed
+                    plain_name = file_name if compression is None else segments[index][2]
+                    try:
+                        os.remove(os.path.join(chat_path, plain_name))
+                    except FileNotFoundError:
+                        # Removed by another process that scanned the chat
+                        pass
+                    if compression is None:
+                        continue
+                if count is None:
+                    with open(os.path.join(chat_path, file_name), 'rb') as f:
+                        count = sum(1 for line in f if line.strip())
+                segments[index] = [index, count, file_name]
+
+        segments = [segments[index] for index in sorted(segments)]
+        self._segments[chat_name] = segments
+        return segments
+
+    def _get_segments(self, chat_name):
+        segments = self._segments.get(chat_name)
+        if segments is None:
+            segments = self._scan_segments(chat_name)
+        return segments
+
+    def exists(self, chat_name):
+        return len(self._get_segments(chat_name)) > 0
+
+    def count(self, chat_name):
+        """Return the number of stored messages of the chat."""
+        return sum(segment[1] for segment in self._get_segments(chat_name))
+
+    def appended(self, chat_name, rescan=False):
+        """Return the number of messages ever appended to the chat, trimming old segments doesn't lower it.
+        Args:
+            rescan (bool): Scan the segment files again, for chats written by another process.
+        """
+        segments = self._scan_segments(chat_name) if rescan else self._get_segments(chat_name)
+        return segments[-1][0] * self.segment_len + segments[-1][1] if segments else 0
+
+    def append(self, chat_name, records):
+        """Append (message_id, message_data) pairs to the chat log.
+        Args:
+            chat_name (str): The chat name used as directory name.
+            records (list): The list of (message_id, message_data) pairs.
+        Returns:
+            None
+        """
+        with STORAGE_SECONDS.time(operation='append'):
+            self._append(chat_name, records)
+
+    def _repair_tail(self, chat_name, segment):
+        """Cut off the torn last line that a crash during an append left in the segment."""
+        file = os.path.join(self.chat_path(chat_name), segment[2])
+        with open(file, 'rb+') as f:
+            size = f.seek(0, os.SEEK_END)
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b'\n':
+                return
+            f.seek(0)
+            data = f.read()
+            f.truncate(data.rfind(b'\n') + 1)
+        segment[1] -= 1
+        print(f'Torn last line of "{file}" removed')
+
+    def _append(self, chat_name, records):
+        segments = self._get_segments(chat_name)
+        chat_path = self.chat_path(chat_name)
+        if not os.path.isdir(chat_path):
+            os.makedirs(chat_path, exist_ok=True)
+            if self.fsync:
+                fsync_directory(self.root)
+
+        records = list(records)
+        while records:
+            new_segment = not segments or segments[-1][1] >= self.segment_len
+            if new_segment:
+                if segments and self.compression is not None:
+                    self._compress_segment(chat_name, segments[-1])
+                index = segments[-1][0] + 1 if segments else 0
+                segments.append([index, 0, make_segment_name(index)])
+            elif (chat_name, segments[-1][0]) not in self._checked_tails:
+                self._repair_tail(chat_name, segments[-1])
+            self._checked_tails.add((chat_name, segments[-1][0]))
+
+            index, count, file_name = segments[-1]
+            chunk = records[:self.segment_len - count]
+            records = records[len(chunk):]
+
+            data = ''.join(json.dumps(dict(message_id=message_id, **message_data), ensure_ascii=False) + '\n'
+                           for message_id, message_data in chunk).encode('utf-8')
+            with open(os.path.join(chat_path, file_name), 'ab') as f:
+                f.write(data)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            if new_segment and self.fsync:
+                fsync_directory(chat_path)
+            STORAGE_BYTES.inc(len(data), operation='write')
+            segments[-1][1] += len(chunk)
+
+        self._trim(chat_name)
+
+    def _compress_segment(self, chat_name, segment):
+        """Replace the full plain segment with a compressed one."""
+        index, count, file_name = segment
+        if parse_segment_name(file_name)[2] is not None:
+            return
+        chat_path = self.chat_path(chat_name)
+        with open(os.path.join(chat_path, file_name), 'rb') as f:
+            data = f.read()
+        compressed_name = make_compressed_segment_name(index, count, self.compression)
+        # The compressed file is complete before the plain one is removed, see _scan_segments
+        write_atomic(os.path.join(chat_path, compressed_name), compress(data, self.compression))
+        try:
+            os.remove(os.path.join(chat_path, file_name))
+        except FileNotFoundError:
+            # Removed by another process that scanned the chat in between
+            pass
+        segment[2] = compressed_name
+
+    def compress_cold_segments(self):
+        """Compress the full segments written before the compression was turned on.
+        Returns:
+            int: The number of compressed segments.
+        """
+        compressed = 0
+        if self.compression is None or not os.path.isdir(self.root):
+            return compressed
+
+        for chat_name in sorted(os.listdir(self.root)):
+            if not os.path.isdir(self.chat_path(chat_name)):
+                continue
+            for segment in self._get_segments(chat_name)[:-1]:
+                if parse_segment_name(segment[2])[2] is None:
+                    self._compress_segment(chat_name, segment)
+                    compressed += 1
+        return compressed
+
+    def _trim(self, chat_name):
+        """Drop the oldest whole segments while the rest still holds max_len messages."""
+        segments = self._get_segments(chat_name)
+        total = sum(segment[1] for segment in segments)
+
+        while len(segments) > 1 and total - segments[0][1] >= self.max_len:
+            index, count, file_name = segments.pop(0)
+            os.remove(os.path.join(self.chat_path(chat_name), file_name))
+            self._first_dates.pop((chat_name, index), None)
+            total -= count
+
+    def _find_segment_file(self, chat_name, index):
+        """Return the current file name of the segment, or None if it was trimmed."""
+        try:
+            file_names = os.listdir(self.chat_path(chat_name))
+        except FileNotFoundError:
+            return None
+        for file_name in file_names:
+            parsed = parse_segment_name(file_name)
+            if parsed is not None and parsed[0] == index and parsed[2] is not None:
+                return file_name
+        return None
+
+    def _segment_file(self, chat_name, segment):
+        """Return the path and the compression of the segment file, None if it was trimmed."""
+        index, _, file_name = segment
+        parsed = parse_segment_name(file_name)
+        if parsed[2] is None and not os.path.exists(os.path.join(self.chat_path(chat_name), file_name)):
+            # Compressed by the process that owns the chat since it was scanned here
+            file_name = self._find_segment_file(chat_name, index)
+            if file_name is None:
+                # The segment was trimmed by the process that owns the chat
+                return None
+            parsed = parse_segment_name(file_name)
+        return os.path.join(self.chat_path(chat_name), file_name), parsed[2]
+
+    def _first_date(self, chat_name, segment):
+        """Return the date of the first message of the segment, None for messages saved without one."""
+        key = (chat_name, segment[0])
+        if key not in self._first_dates:
+            date = None
+            segment_file = self._segment_file(chat_name, segment)
+            try:
+                if segment_file is not None:
+                    # Only the start of a compressed segment is decompressed
+                    with open_segment(*segment_file) as f:
+                        date = json.loads(f.readline()).get('date')
+            except (FileNotFoundError, json.JSONDecodeError, UnicodeDecodeError):
+                pass
+            self._first_dates[key] = date
+        return self._first_dates[key]
+
+    def _first_segment_since(self, chat_name, segments, since):
+        """Return the position of the newest segment that starts before the unix time, the older ones aren't needed."""
+        low, high = 0, len(segments)
+        while high - low > 1:
+            middle = (low + high) // 2
+            date = self._first_date(chat_name, segments[middle])
+            if date is None or date < since:
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def _read_segment(self, chat_name, segment, chat_history):
+        segment_file = self._segment_file(chat_name, segment)
+        if segment_file is None:
+            return
+        file, compression = segment_file
+        try:
+            with open_segment(file, compression) as f:
+                STORAGE_BYTES.inc(os.path.getsize(file), operation='read')
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except (json.JSONDecodeError, UnicodeDecodeError):
+                        # A line torn by a crash or by a write of another process
+                        continue
+                    chat_history[str(record.pop('message_id'))] = record
+        except FileNotFoundError:
+            # The segment was trimmed by the process that owns the chat
+            pass
+
+    def load(self, chat_name, last_n=None, rescan=False, since=None):
+        """Load the chat history as an ordered mapping of message_id -> message data.
+        Args:
+            chat_name (str): The chat name used as directory name.
+            last_n (int): Read only the segments needed for the last n messages.
+            rescan (bool): Scan the segment files again, for chats written by another process.
+            since (float): Read only the segments needed for the messages sent at the unix time or later,
+                the history may start with some older messages of the first segment.
+        Returns:
+            CompactHistory or False if the chat has no history.
+        """
+        segments = self._scan_segments(chat_name) if rescan else self._get_segments(chat_name)
+        if not segments:
+            return False
+
+        first = 0
+        if last_n is not None:
+            needed = 0
+            first = len(segments)
+            while first > 0 and needed < last_n:
+                first -= 1
+                needed += segments[first][1]
+        if since is not None:
+            first = max(first, self._first_segment_since(chat_name, segments, since))
+
+        chat_history = CompactHistory()
+        with STORAGE_SECONDS.time(operation='load'):
+            for segment in segments[first:]:
+                self._read_segment(chat_name, segment, chat_history)
+
+        chat_history.trim_head(len(chat_history) - min(self.max_len, last_n or self.max_len))
+
+        return chat_history
+
+    def remove(self, chat_name):
+        """Delete the whole history of the chat."""
+        for _, _, file_name in self._get_segments(chat_name):
+            os.remove(os.path.join(self.chat_path(chat_name), file_name))
+        self._segments[chat_name] = []
+        for key in [key for key in self._first_dates if key[0] == chat_name]:
+            del self._first_dates[key]
+
+    def migrate_json_histories(self):
+        """Convert legacy '<chat>.json' history files into segmented logs.
+
+        Every migrated file is renamed to '<chat>.json.migrated', so the migration
+        runs only once for every file.
+        Returns:
+            list: The names of migrated chats.
+        """
+        migrated = []
+        if not os.path.isdir(self.root):
+            return migrated
+
+        for file_name in sorted(os.listdir(self.root)):
+            file = os.path.join(self.root, file_name)
+            if not (file_name.endswith('.json') and os.path.isfile(file)):
+                continue
+
+            chat_name = file_name[:-len('.json')]
+            with open(file, 'r') as f:
+                chat_history = json.load(f)
+
+            self.remove(chat_name)
+            self.append(chat_name, chat_history.items())
+            os.rename(file, file + MIGRATED_EXT)
+            migrated.append(chat_name)
+            print(f'Chat history "{chat_name}" migrated to segmented log')
+
+        return migrated
+
+
+class ChatHistoryCache:
+    """Bounded LRU cache of chat histories in front of the chat log with write-behind flushing.
+
+    New messages go to the cached history at once and to a pending list that is
+    appended to the chat log by flush(). append() returns True once the number of
+    pending messages reaches flush_threshold. The cache is safe to use from the
+    event loop and from I/O threads at the same time.
+
+    With classify(message_data) -> kind or None, every message is classified once
+    when it's loaded or appended, and the sequence numbers of the messages with a
+    kind are kept in order per chat for get_dialog().
+
+    With index_text(message_data) -> text or None, search() finds messages by the
+    text in a TextIndex of the chat. The index is built on the first search and
+    updated by append() while the chat stays cached.
+    """
+
+    def __init__(self, chat_log, max_chats=CACHE_MAX_CHATS, max_bytes=CACHE_MAX_BYTES, flush_threshold=CACHE_FLUSH_THRESHOLD,
+                 classify=None, index_text=None, max_indexes=CACHE_MAX_INDEXES):
+        self.chat_log = chat_log
+        self.max_chats = max_chats
+        self.max_bytes = max_bytes
+        self.flush_threshold = flush_threshold
+        self.classify = classify
+        self.index_text = index_text
+        self.max_indexes = max_indexes
+
+        self._histories = OrderedDict()
+        self._sizes = {}
+        # chat_name -> deque of (sequence number, kind) of the classified messages
+        self._dialogs = {}
+        # chat_name -> TextIndex of a cached chat, least recently searched first
+        self._indexes = OrderedDict()
+        self._pending = {}
+        self._pending_count = 0
+        self.total_bytes = 0
+        # _lock guards the memory state, _disk_lock keeps chat log writes in order
+        self._lock = threading.RLock()
+        self._disk_lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+
+    def is_cached(self, chat_name):
+        return chat_name in self._histories
+
+    def is_indexed(self, chat_name):
+        return chat_name in self._indexes
+
+    def get(self, chat_name):
+        """Return the chat history from memory or load it from the chat log."""
+        with self._lock:
+            if chat_name in self._histories:
+                self.hits += 1
+                self._histories.move_to_end(chat_name)
+                return self._histories[chat_name]
+            self.misses += 1
+
+        # The disk lock is held until the pending messages are merged, a flush in
+        # between would write them after the load and take them out of the pending list
+        with self._disk_lock:
+            self._write_pending([chat_name])
+            chat_history = self.chat_log.load(chat_name)
+
+            with self._lock:
+                if chat_name in self._histories:
+                    return self._histories[chat_name]
+
+                # Messages appended while the history was read from the disk
+                for message_id, message_data in self._pending.get(chat_name, []):
+                    chat_history = chat_history or CompactHistory()
+                    chat_history[str(message_id)] = message_data
+
+                if chat_history:
+                    self._put(chat_name, chat_history)
+
+        return chat_history
+
+    def get_tail(self, chat_name, last_n):
+        """Return the last_n newest messages of the chat.
+
+        A chat that isn't cached is read only from the segments that hold these
+        messages and isn't added to the cache.
+        """
+        with self._lock:
+            if chat_name in self._histories:
+                self.hits += 1
+                self._histories.move_to_end(chat_name)
+                return self._histories[chat_name].tail(last_n)
+            self.misses += 1
+
+        with self._disk_lock:
+            self._write_pending([chat_name])
+            chat_history = self.chat_log.load(chat_name, last_n)
+
+            with self._lock:
+                # Messages appended while the history was read from the disk
+                for message_id, message_data in self._pending.get(chat_name, []):
+                    chat_history = chat_history or CompactHistory()
+                    chat_history[str(message_id)] = message_data
+
+        return chat_history.tail(last_n) if chat_history else chat_history
+
+    def get_since(self, chat_name, since):
+        """Return the messages of the chat sent at the unix time or later.
+
+        A chat that isn't cached is read only from the segments that hold these
+        messages and isn't added to the cache.
+        """
+        with self._lock:
+            if chat_name in self._histories:
+                self.hits += 1
+                self._histories.move_to_end(chat_name)
+                chat_history = self._histories[chat_name]
+                count = chat_history.count_since(since)
+                return chat_history.tail(count) if count else CompactHistory()
+            self.misses += 1
+
+        with self._disk_lock:
+            self._write_pending([chat_name])
+            chat_history = self.chat_log.load(chat_name, since=since)
+
+            with self._lock:
+                # Messages appended while the history was read from the disk
+                for message_id, message_data in self._pending.get(chat_name, []):
+                    chat_history = chat_history or CompactHistory()
+                    chat_history[str(message_id)] = message_data
+
+        return chat_history
+
+    def get_dialog(self, chat_name, last_n):
+        """Return the last last_n classified messages of the chat without scanning the history.
+        Returns:
+            list: (kind, message data) in chat order.
+        """
+        chat_history = self.get(chat_name) or CompactHistory()
+        with self._lock:
+            chat_history = self._histories.get(chat_name, chat_history)
+            dialog = self._dialogs.get(chat_name)
+            if dialog is None:
+                # The history was too large to stay in the cache
+                dialog = self._make_dialog(chat_history)
+            entries = list(itertools.islice(reversed(dialog), last_n))
+            return [(kind, chat_history.message_at_seq(seq)) for seq, kind in reversed(entries)]
+
+    def _make_dialog(self, chat_history):
+        dialog = deque()
+        for seq, message_data in enumerate(chat_history.values(), chat_history.first_seq):
+            kind = self.classify(message_data)
+            if kind is not None:
+                dialog.append((seq, kind))
+        return dialog
+
+    def _put(self, chat_name, chat_history):
+        size = chat_history.nbytes
+        self._histories[chat_name] = chat_history
+        self._sizes[chat_name] = size
+        self.total_bytes += size
+        if self.classify is not None:
+            self._dialogs[chat_name] = self._make_dialog(chat_history)
+        self._evict()
+
+    def _evict(self):
+        while self._histories and (len(self._histories) > self.max_chats or self.total_bytes > self.max_bytes):
+            chat_name, _ = self._histories.popitem(last=False)
+            self.total_bytes -= self._sizes.pop(chat_name)
+            self._dialogs.pop(chat_name, None)
+            self._indexes.pop(chat_name, None)
+            self.evictions += 1
+
+    def append(self, chat_name, message_id, message_data):
+        """Add the message to the cached history and queue it for the chat log.
+        Returns:
+            bool: True if the pending messages should be flushed.
+        """
+        with self._lock:
+            self._pending.setdefault(chat_name, []).append((message_id, message_data))
+            self._pending_count += 1
+
+            chat_history = self._histories.get(chat_name)
+            if chat_history is not None:
+                key = str(message_id)
+                replaced = key in chat_history
+                chat_history[key] = message_data
+                chat_history.trim_head(len(chat_history) - self.chat_log.max_len)
+
+                size = chat_history.nbytes
+                self.total_bytes += size - self._sizes[chat_name]
+                self._sizes[chat_name] = size
+
+                dialog = self._dialogs.get(chat_name)
+                if dialog is not None:
+                    if replaced:
+                        # The message keeps its place in the history, so its place in the dialog is found again
+                        self._dialogs[chat_name] = self._make_dialog(chat_history)
+                    else:
+                        kind = self.classify(message_data)
+                        if kind is not None:
+                            dialog.append((chat_history.first_seq + len(chat_history) - 1, kind))
+                        while dialog and dialog[0][0] < chat_history.first_seq:
+                            dialog.popleft()
+
+                index = self._indexes.get(chat_name)
+                if index is not None:
+                    if replaced:
+                        # Postings can't be taken back, the index is built again by the next search
+                        del self._indexes[chat_name]
+                    else:
+                        self._index_message(index, chat_history.first_seq + len(chat_history) - 1, message_data)
+                        index.trim(chat_history.first_seq)
+
+                self._histories.move_to_end(chat_name)
+                self._evict()
+
+            return self._pending_count >= self.flush_threshold
+
+    def _index_message(self, index, seq, message_data):
+        text = self.index_text(message_data)
+        if text is not None:
+            index.add(seq, text)
+
+    def search(self, chat_name, query, k):
+        """Return the k messages of the chat that match the query best.
+
+        The first search of a chat builds its index from the history outside the lock,
+        then adds the messages appended in the meantime.
+        Returns:
+            list: (sequence number, message data), best first, empty without index_text.
+        """
+        if self.index_text is None:
+            return []
+        with self._lock:
+            index = self._indexes.get(chat_name)
+            if index is not None:
+                self._indexes.move_to_end(chat_name)
+                return self._search(index, self._histories[chat_name], query, k)
+
+        chat_history = self.get(chat_name)
+        if not chat_history:
+            return []
+        with self._lock:
+            cached_history = self._histories.get(chat_name)
+            snapshot = (chat_history if cached_history is None else cached_history).tail(0)
+
+        index = TextIndex(snapshot.first_seq)
+        for seq, message_data in enumerate(snapshot.values(), snapshot.first_seq):
+            self._index_message(index, seq, message_data)
+
+        with self._lock:
+            if cached_history is None or self._histories.get(chat_name) is not cached_history:
+                # The history is too large to stay in the cache or was evicted, the index is used once
+                return self._search(index, snapshot, query, k)
+            if chat_name not in self._indexes:
+                for seq in range(index.next_seq, cached_history.first_seq + len(cached_history)):
+                    self._index_message(index, seq, cached_history.message_at_seq(seq))
+                index.trim(cached_history.first_seq)
+                self._indexes[chat_name] = index
+                while len(self._indexes) > self.max_indexes:
+                    self._indexes.popitem(last=False)
+            return self._search(self._indexes[chat_name], cached_history, query, k)
+
+    def _search(self, index, chat_history, query, k):
+        return [(seq, chat_history.message_at_seq(seq)) for seq, _ in index.search(query, k)]
+
+    def _write_pending(self, chat_names):
+        for name in chat_names:
+            with self._lock:
+                records = self._pending.pop(name, None)
+                if records:
+                    self._pending_count -= len(records)
+            if records:
+                try:
+                    self.chat_log.append(name, records)
+                except Exception:
+                    # Back to the front of the pending list, so the next flush writes them in order
+                    with self._lock:
+                        self._pending[name] = records + self._pending.get(name, [])
+                        self._pending_count += len(records)
+                    raise
+                self.flushes += 1
+
+    def appended(self, chat_name):
+        """Return the number of messages ever appended to the chat, a cheap check for new messages."""
+        with self._disk_lock, self._lock:
+            return self.chat_log.appended(chat_name) + len(self._pending.get(chat_name, ()))
+
+    def flush(self, chat_name=None):
+        """Write pending messages of one chat or of all chats to the chat log."""
+        with self._disk_lock:
+            with self._lock:
+                chat_names = [chat_name] if chat_name is not None else list(self._pending.keys())
+            self._write_pending(chat_names)
+
+    def remove(self, chat_name):
+        """Drop the chat from the cache and delete its history."""
+        with self._disk_lock:
+            with self._lock:
+                self._pending_count -= len(self._pending.pop(chat_name, []))
+                if chat_name in self._histories:
+                    del self._histories[chat_name]
+                    self.total_bytes -= self._sizes.pop(chat_name)
+                self._dialogs.pop(chat_name, None)
+                self._indexes.pop(chat_name, None)
+            self.chat_log.remove(chat_name)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'chats': len(self._histories),
+                'indexes': len(self._indexes),
+                'bytes': self.total_bytes,
+                'pending': self._pending_count,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'flushes': self.flushes,
+            }
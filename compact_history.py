@@ -0,0 +1,241 @@
+"""Compact in-memory chat history.
+
+A dict of message dicts stores the key strings, the chat id and the username of
+every message again and again, several hundred bytes per message. CompactHistory
+keeps the same ordered message_id -> message data mapping in columns: arrays of
+ids and token counts, usernames interned in a table and all texts in one UTF-8
+buffer with offsets. Message dicts are made only when they are read.
+
+The dates of the messages are kept in send order in their own column, so the
+messages sent since a time are found by bisect, see position_since().
+"""
+import bisect
+from array import array
+
+
+# Stand for None in the id columns and for a missing token count
+NONE_VALUE = -2**63
+NO_TOKENS = -1
+# Message fields that have their own column, other fields are kept in a dict per message
+COLUMNS = ('chat_id', 'user_id', 'username', 'message_text', 'tokens', 'date')
+
+_to_column = lambda value: NONE_VALUE if value is None else value
+_from_column = lambda value: None if value == NONE_VALUE else value
+
+
+class CompactHistory:
+    """Ordered mapping of str(message_id) -> message data stored in columns.
+
+    Supports the read methods of a dict, setting a message by key, trimming the
+    oldest messages with trim_head() and cheap copies of the newest ones with tail().
+    Every message gets a sequence number that doesn't change when older messages
+    are trimmed, message_at_seq() reads a message by it.
+    """
+
+    def __init__(self, items=()):
+        self._ids = array('q')
+        self._chat_ids = array('q')
+        self._user_ids = array('q')
+        self._usernames = array('I')
+        self._tokens = array('i')
+        # Unix time of the messages, never decreasing, see _sorted_date
+        self._dates = array('q')
+        # Text of message i is _text[_offsets[i] - _text_base:_offsets[i + 1] - _text_base]
+        self._text = bytearray()
+        self._offsets = array('Q', [0])
+        self._text_base = 0
+        self._names = []
+        self._name_indexes = {}
+        # sequence number -> fields without a column
+        self._extra = {}
+        self.first_seq = 0
+        self._max_id = NONE_VALUE
+
+        for key, message_data in items:
+            self[key] = message_data
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return self.keys()
+
+    def __contains__(self, key):
+        return self._position(key) is not None
+
+    def __getitem__(self, key):
+        position = self._position(key)
+        if position is None:
+            raise KeyError(key)
+        return self.message(position)
+
+    def __setitem__(self, key, message_data):
+        position = self._position(key)
+        if position is None:
+            self._append(int(key), message_data)
+        else:
+            self._replace(position, message_data)
+
+    def get(self, key, default=None):
+        position = self._position(key)
+        return default if position is None else self.message(position)
+
+    def keys(self):
+        return (str(message_id) for message_id in self._ids)
+
+    def values(self):
+        return (self.message(position) for position in range(len(self._ids)))
+
+    def items(self):
+        return ((str(self._ids[position]), self.message(position)) for position in range(len(self._ids)))
+
+    def texts(self):
+        """Iterate (username, message text) of the messages without making the message dicts."""
+        for position in range(len(self._ids)):
+            yield self._names[self._usernames[position]], self._message_text(position)
+
+    @property
+    def nbytes(self):
+        """Memory of the columns without the username table."""
+        columns = (self._ids, self._chat_ids, self._user_ids, self._usernames, self._tokens, self._dates, self._offsets)
+        return sum(column.buffer_info()[1] * column.itemsize for column in columns) + len(self._text)
+
+    def _position(self, key):
+        try:
+            message_id = int(key)
+        except (TypeError, ValueError):
+            return None
+        # Message ids mostly grow, a new one needs no search
+        if message_id > self._max_id:
+            return None
+        try:
+            return self._ids.index(message_id)
+        except ValueError:
+            return None
+
+    def _name_index(self, username):
+        index = self._name_indexes.get(username)
+        if index is None:
+            index = self._name_indexes[username] = len(self._names)
+            self._names.append(username)
+        return index
+
+    def _message_text(self, position):
+        start = self._offsets[position] - self._text_base
+        end = self._offsets[position + 1] - self._text_base
+        return self._text[start:end].decode('utf-8')
+
+    def message(self, position):
+        """Return the message data at the position, negative positions count from the newest message."""
+        if position < 0:
+            position += len(self._ids)
+        message_data = {
+            'chat_id': _from_column(self._chat_ids[position]),
+            'user_id': _from_column(self._user_ids[position]),
+            'username': self._names[self._usernames[position]],
+            'message_text': self._message_text(position),
+        }
+        if self._tokens[position] != NO_TOKENS:
+            message_data['tokens'] = self._tokens[position]
+        if self._dates[position] != NONE_VALUE:
+            message_data['date'] = self._dates[position]
+        if self._extra:
+            message_data.update(self._extra.get(self.first_seq + position, ()))
+        return message_data
+
+    def message_at_seq(self, seq):
+        return self.message(seq - self.first_seq)
+
+    def position_since(self, timestamp):
+        """Return the position of the oldest message sent at the unix time or later, len() if there is none."""
+        return bisect.bisect_left(self._dates, timestamp)
+
+    def count_since(self, timestamp):
+        """Return the number of messages sent at the unix time or later."""
+        return len(self._ids) - self.position_since(timestamp)
+
+    def _sorted_date(self, position, date):
+        # A message without a date or dated before the previous one gets the date of the previous
+        # one, and a replaced message can't move past the next one, so the column stays sorted
+        previous = self._dates[position - 1] if position > 0 else NONE_VALUE
+        date = previous if date is None else max(int(date), previous)
+        if position + 1 < len(self._dates):
+            date = min(date, self._dates[position + 1])
+        return date
+
+    def _append(self, message_id, message_data):
+        self._ids.append(message_id)
+        self._max_id = max(self._max_id, message_id)
+        self._chat_ids.append(_to_column(message_data.get('chat_id')))
+        self._user_ids.append(_to_column(message_data.get('user_id')))
+        self._usernames.append(self._name_index(message_data.get('username')))
+        self._tokens.append(message_data.get('tokens', NO_TOKENS))
+        self._dates.append(self._sorted_date(len(self._dates), message_data.get('date')))
+        self._text += str(message_data.get('message_text', '')).encode('utf-8')
+        self._offsets.append(self._text_base + len(self._text))
+
+        extra = {name: value for name, value in message_data.items() if name not in COLUMNS}
+        if extra:
+            self._extra[self.first_seq + len(self._ids) - 1] = extra
+
+    def _replace(self, position, message_data):
+        self._chat_ids[position] = _to_column(message_data.get('chat_id'))
+        self._user_ids[position] = _to_column(message_data.get('user_id'))
+        self._usernames[position] = self._name_index(message_data.get('username'))
+        self._tokens[position] = message_data.get('tokens', NO_TOKENS)
+        self._dates[position] = self._sorted_date(position, message_data.get('date'))
+
+        text = str(message_data.get('message_text', '')).encode('utf-8')
+        start = self._offsets[position] - self._text_base
+        end = self._offsets[position + 1] - self._text_base
+        self._text[start:end] = text
+        shift = len(text) - (end - start)
+        if shift:
+            for index in range(position + 1, len(self._offsets)):
+                self._offsets[index] += shift
+
+        seq = self.first_seq + position
+        self._extra.pop(seq, None)
+        extra = {name: value for name, value in message_data.items() if name not in COLUMNS}
+        if extra:
+            self._extra[seq] = extra
+
+    def trim_head(self, count):
+        """Drop the count oldest messages."""
+        count = min(count, len(self._ids))
+        if count <= 0:
+            return
+        for column in (self._ids, self._chat_ids, self._user_ids, self._usernames, self._tokens, self._dates):
+            del column[:count]
+        # Deleting from the front of a bytearray doesn't move the rest of it
+        del self._text[:self._offsets[count] - self._text_base]
+        self._text_base = self._offsets[count]
+        del self._offsets[:count]
+
+        if self._extra:
+            for seq in [seq for seq in self._extra if seq < self.first_seq + count]:
+                del self._extra[seq]
+        self.first_seq += count
+
+    def tail(self, count):
+        """Return a CompactHistory with copies of the count newest messages, it's cheap to pickle.
+
+        Like [-count:] of a list, count 0 copies all messages.
+        """
+        first = max(0, len(self._ids) - count) if count > 0 else 0
+        tail = CompactHistory()
+        tail._ids = self._ids[first:]
+        tail._chat_ids = self._chat_ids[first:]
+        tail._user_ids = self._user_ids[first:]
+        tail._usernames = self._usernames[first:]
+        tail._tokens = self._tokens[first:]
+        tail._dates = self._dates[first:]
+        tail._text = self._text[self._offsets[first] - self._text_base:]
+        tail._offsets = self._offsets[first:]
+        tail._text_base = self._offsets[first]
+        tail._names = list(self._names)
+        tail._name_indexes = dict(self._name_indexes)
+        tail.first_seq = self.first_seq + first
+        tail._extra = {seq: extra for seq, extra in self._extra.items() if seq >= tail.first_seq}
+        tail._max_id = self._max_id
+        return tail
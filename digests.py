@@ -0,0 +1,97 @@
+"""Store of the scheduled chat digests.
+
+A digest is the summary of the messages a chat got in the last period (an hour
+or a day), computed by a JobQueue job ahead of time. /sum_up of a time range that
+matches a stored digest is answered from it without a completion.
+"""
+import json
+import os
+import threading
+import time
+
+from atomic_file import file_version, write_json_atomic
+
+
+DIGEST_PERIODS = {'hourly': 3600, 'daily': 86400}
+# Digests kept for every chat and period
+DIGESTS_PER_CHAT = 10
+# A digest answers a time range whose start and end are this fraction of the range away from its own
+DIGEST_SLACK = 0.1
+
+
+class DigestStore:
+    """Persistent per-chat list of the newest digests.
+
+    Every digest is a dict with the window 'since'..'until' (unix time), the 'period',
+    the message ids 'first_id'..'last_id', the number of 'messages', the 'summary'
+    and 'appended', the number of messages the chat had got when it was made, see
+    ChatHistoryCache.appended. A window without messages is kept with summary None,
+    so the next run sees that the chat didn't change.
+
+    The digests of a chat are made by the shard worker that owns it, but other workers
+    read them and remove them, so the copy in memory is read again when the file changed.
+    """
+
+    def __init__(self, path, max_per_chat=DIGESTS_PER_CHAT):
+        self.path = path
+        self.max_per_chat = max_per_chat
+        # chat name -> (file version, digests)
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def _file(self, chat_name):
+        return os.path.join(self.path, str(chat_name) + '.json')
+
+    def _get_digests(self, chat_name):
+        version = file_version(self._file(chat_name))
+        cached = self._digests.get(chat_name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        digests = []
+        try:
+            with open(self._file(chat_name), 'r') as f:
+                digests = json.load(f)
+        except FileNotFoundError:
+            version = None
+        self._digests[chat_name] = version, digests
+        return digests
+
+    def last(self, chat_name, period):
+        """Return the newest digest of the chat for the period or None."""
+        with self._lock:
+            for digest in reversed(self._get_digests(chat_name)):
+                if digest['period'] == period:
+                    return digest
+        return None
+
+    def put(self, chat_name, digest):
+        """Add the digest and write the digests of the chat to the disk."""
+        with self._lock:
+            digests = self._get_digests(chat_name)
+            digests.append(dict(digest, created=time.time()))
+            same_period = [index for index, old in enumerate(digests) if old['period'] == digest['period']]
+            for index in reversed(same_period[:-self.max_per_chat]):
+                del digests[index]
+            os.makedirs(self.path, exist_ok=True)
+            write_json_atomic(self._file(chat_name), digests)
+            self._digests[chat_name] = file_version(self._file(chat_name)), digests
+
+    def find(self, chat_name, since, until, slack=DIGEST_SLACK):
+        """Find the newest digest with a summary whose window is close to since..until.
+        Returns:
+            dict: The digest or None.
+        """
+        margin = (until - since) * slack
+        with self._lock:
+            for digest in reversed(self._get_digests(chat_name)):
+                if (digest['summary'] is not None and abs(digest['since'] - since) <= margin
+                        and abs(digest['until'] - until) <= margin):
+                    return digest
+        return None
+
+    def remove(self, chat_name):
+        """Delete the digests of the chat."""
+        with self._lock:
+            self._digests.pop(chat_name, None)
+            if os.path.isfile(self._file(chat_name)):
+                os.remove(self._file(chat_name))
@@ -0,0 +1,75 @@
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+
+IO_THREADS = 4
+CPU_PROCESSES = os.cpu_count() or 1
+LOOP_LAG_THRESHOLD = 0.1
+LOOP_LAG_INTERVAL = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+class Executors:
+    """Thread pool for blocking disk I/O and process pool for CPU-bound work like tokenization.
+
+    With cpu_workers=0 the CPU-bound functions run in the I/O threads instead.
+    A forked child process, like a shard worker, starts new pools of its own.
+    """
+
+    def __init__(self, io_workers=IO_THREADS, cpu_workers=CPU_PROCESSES):
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers
+        self._io_pool = None
+        self._cpu_pool = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._forget_pools)
+
+    def _forget_pools(self):
+        # The child has copies of the pools without their threads and processes, tasks sent to them never run
+        self._io_pool = None
+        self._cpu_pool = None
+
+    @property
+    def io_pool(self):
+        if self._io_pool is None:
+            self._io_pool = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix='bot-io')
+        return self._io_pool
+
+    @property
+    def cpu_pool(self):
+        if not self.cpu_workers:
+            return self.io_pool
+        if self._cpu_pool is None:
+            self._cpu_pool = ProcessPoolExecutor(max_workers=self.cpu_workers)
+        return self._cpu_pool
+
+    async def run_io(self, func, *args, **kwargs):
+        """Run a blocking I/O function in the thread pool."""
+        return await asyncio.get_running_loop().run_in_executor(self.io_pool, partial(func, *args, **kwargs))
+
+    async def run_cpu(self, func, *args, **kwargs):
+        """Run a CPU-bound module level function in the process pool."""
+        return await asyncio.get_running_loop().run_in_executor(self.cpu_pool, partial(func, *args, **kwargs))
+
+    def shutdown(self):
+        if self._io_pool is not None:
+            self._io_pool.shutdown(wait=True)
+            self._io_pool = None
+        if self._cpu_pool is not None:
+            self._cpu_pool.shutdown(wait=True)
+            self._cpu_pool = None
+
+
+async def monitor_loop_lag(threshold=LOOP_LAG_THRESHOLD, interval=LOOP_LAG_INTERVAL):
+    """Log a warning every time a callback blocks the event loop longer than threshold seconds."""
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = time.monotonic() - start - interval
+        if lag > threshold:
+            logger.warning('Event loop was blocked for %.3f s', lag)
@@ -0,0 +1,169 @@
+"""Local fake of the OpenAI chat completion HTTP API for benchmarks and load tests.
+
+Usage:
+    server = FakeOpenAIServer(latency=0.5)
+    await server.start()
+    openai.api_base = server.api_base
+"""
+import asyncio
+import collections
+import json
+import random
+import time
+
+
+class FakeOpenAIServer:
+    """Minimal HTTP server that answers POST /v1/chat/completions after a configurable latency.
+
+    The reply takes `latency` seconds to the first token and `token_delay` seconds for
+    every next word. Requests with "stream": true get the words as server-sent events.
+
+    Like the real API it answers 429 with Retry-After to requests over requests_per_minute
+    or tokens_per_minute (words of the prompt and max_tokens), the budgets are refilled
+    continuously over `period` seconds.
+    error_rate of the requests fail with a random 500 or 503, and all of them while `down`.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, reply='<answear>\nfake summary', token_delay=0.0,
+                 requests_per_minute=None, tokens_per_minute=None, period=60, error_rate=0.0, seed=1):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.reply = reply
+        self.token_delay = token_delay
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.period = period
+        self.error_rate = error_rate
+        self.down = False
+        self.requests = []
+        # HTTP status -> number of answers
+        self.statuses = collections.Counter()
+        self._random = random.Random(seed)
+        # Budgets left and the time they were refilled
+        self._requests_left = requests_per_minute
+        self._tokens_left = tokens_per_minute
+        self._refilled = time.monotonic()
+        self._server = None
+
+    @property
+    def api_base(self):
+        return f'http://{self.host}:{self.port}/v1'
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None, None, None
+        method, path, _ = request_line.decode().split(' ', 2)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            key, value = line.decode().split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+        return method, path, json.loads(body) if body else {}
+
+    def _write_json(self, writer, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        extra = ''.join(f'{name}: {value}\r\n' for name, value in (headers or {}).items())
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n{extra}'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+
+    async def _handle(self, reader, writer):
+        try:
+            method, path, payload = await self._read_request(reader)
+            if method is None:
+                return
+            self.requests.append((time.monotonic(), path, payload))
+
+            if not (method == 'POST' and path.endswith('/chat/completions')):
+                self._write_json(writer, '404 Not Found', {'error': {'message': 'not found', 'type': 'invalid_request_error'}})
+                return
+
+            error = self._error(payload)
+            if error is not None:
+                await asyncio.sleep(self.latency / 10)
+                self._write_json(writer, *error)
+                return
+
+            await asyncio.sleep(self.latency)
+            self.statuses[200] += 1
+            if payload.get('stream'):
+                await self._write_stream(writer, payload)
+            else:
+                await asyncio.sleep(self.token_delay * (len(self.tokens()) - 1))
+                self._write_json(writer, '200 OK', self.completion(payload))
+        finally:
+            await writer.drain()
+            writer.close()
+
+    def _error(self, payload):
+        """Return (status, error JSON, extra headers) of a failed answer or None."""
+        if self.down or self._random.random() < self.error_rate:
+            status = '503 Service Unavailable' if self.down or self._random.random() < 0.5 else '500 Internal Server Error'
+            self.statuses[int(status[:3])] += 1
+            return status, {'error': {'message': 'The server had an error', 'type': 'server_error'}}
+
+        now = time.monotonic()
+        elapsed, self._refilled = now - self._refilled, now
+        tokens = sum(len(str(message.get('content', '')).split()) for message in payload.get('messages', [])) + payload.get('max_tokens', 0)
+        retry_after = 0.0
+        if self.requests_per_minute is not None:
+            self._requests_left = min(self.requests_per_minute, self._requests_left + elapsed * self.requests_per_minute / self.period)
+            retry_after = max(retry_after, (1 - self._requests_left) * self.period / self.requests_per_minute)
+        if self.tokens_per_minute is not None:
+            self._tokens_left = min(self.tokens_per_minute, self._tokens_left + elapsed * self.tokens_per_minute / self.period)
+            retry_after = max(retry_after, (tokens - self._tokens_left) * self.period / self.tokens_per_minute)
+        if retry_after > 0:
+            self.statuses[429] += 1
+            return '429 Too Many Requests', {'error': {'message': 'Rate limit reached', 'type': 'requests'}}, {'Retry-After': f'{retry_after:.3f}'}
+
+        if self.requests_per_minute is not None:
+            self._requests_left -= 1
+        if self.tokens_per_minute is not None:
+            self._tokens_left -= tokens
+        return None
+
+    def tokens(self):
+        words = self.reply.split(' ')
+        return [word if number == 0 else ' ' + word for number, word in enumerate(words)]
+
+    async def _write_stream(self, writer, payload):
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nConnection: close\r\n\r\n')
+        for number, token in enumerate(self.tokens()):
+            if number:
+                await asyncio.sleep(self.token_delay)
+            chunk = {
+                'id': f'chatcmpl-{len(self.requests)}',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': payload.get('model', ''),
+                'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}],
+            }
+            writer.write(f'data: {json.dumps(chunk)}\n\n'.encode())
+            await writer.drain()
+        writer.write(b'data: [DONE]\n\n')
+
+    def completion(self, payload):
+        return {
+            'id': f'chatcmpl-{len(self.requests)}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': payload.get('model', ''),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': self.reply}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+        }
@@ -0,0 +1,71 @@
+"""Local fakes of the Telegram side of the bot for benchmarks and load tests.
+
+Usage:
+    bot = FakeBot(latency=0.01)
+    update = Update.de_json(group_message(1, -100, 'Group 1', 5, 'hello'), bot)
+    await text_message_parser(update, None)
+"""
+import asyncio
+import time
+import types
+
+
+class FakeBot:
+    """Telegram Bot stand-in that counts API calls and can answer with RetryAfter."""
+
+    def __init__(self, latency=0.01, retry_after_every=0):
+        self.latency = latency
+        self.retry_after_every = retry_after_every
+        self.calls = {'send_message': 0, 'edit_message_text': 0}
+        # (chat_id, message_id) -> text of the messages the bot sent
+        self.messages = {}
+        # chat_id -> last message id, the messages of the users and of the bot share one sequence like in Telegram
+        self.message_ids = {}
+
+    def next_message_id(self, chat_id):
+        message_id = self.message_ids[chat_id] = self.message_ids.get(chat_id, 0) + 1
+        return message_id
+
+    async def _call(self, name):
+        self.calls[name] += 1
+        await asyncio.sleep(self.latency)
+        if self.retry_after_every and sum(self.calls.values()) % self.retry_after_every == 0:
+            from telegram.error import RetryAfter
+            raise RetryAfter(1)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call('send_message')
+        message_id = self.next_message_id(chat_id)
+        self.messages[chat_id, message_id] = text
+        return types.SimpleNamespace(chat_id=chat_id, message_id=message_id, text=text)
+
+    async def edit_message_text(self, text, chat_id, message_id, **kwargs):
+        await self._call('edit_message_text')
+        self.messages[chat_id, message_id] = text
+        return True
+
+
+make_user = lambda user_id: {'id': user_id, 'is_bot': False, 'first_name': 'User', 'username': f'user_{user_id}'}
+
+def _message_update(update_id, message_id, chat, user_id, **fields):
+    return {
+        'update_id': update_id,
+        'message': {'message_id': message_id, 'date': int(time.time()), 'chat': chat, 'from': make_user(user_id), **fields},
+    }
+
+def private_message(update_id, message_id, user_id, text):
+    """Update JSON of a text or command message in the private chat with the user."""
+    chat = {'id': user_id, 'type': 'private', 'username': f'user_{user_id}', 'first_name': 'User'}
+    entities = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}] if text.startswith('/') else []
+    return _message_update(update_id, message_id, chat, user_id, text=text, entities=entities)
+
+def group_message(update_id, message_id, chat_id, title, user_id, text):
+    """Update JSON of a text message in a group chat."""
+    chat = {'id': chat_id, 'type': 'supergroup', 'title': title}
+    return _message_update(update_id, message_id, chat, user_id, text=text)
+
+def new_member_message(update_id, message_id, chat_id, title, user_id, member_username):
+    """Update JSON of the service message about a member that the user added to the group."""
+    chat = {'id': chat_id, 'type': 'supergroup', 'title': title}
+    member = {'id': hash(member_username) % 10**9, 'is_bot': True, 'first_name': member_username, 'username': member_username}
+    return _message_update(update_id, message_id, chat, user_id, new_chat_member=member, new_chat_members=[member])
@@ -0,0 +1,584 @@
+import asyncio
+import contextlib
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+import openai
+
+import metrics
+from atomic_file import write_json_atomic
+
+
+MAX_CONCURRENT_COMPLETIONS = 8
+MAX_COMPLETIONS_PER_USER = 1
+COMPLETION_TIMEOUT = 10
+COMPLETION_CACHE_TTL = 600
+COMPLETION_CACHE_SIZE = 1000
+# Budgets of the OpenAI account, requests and tokens (prompt and completion) per minute
+OPENAI_REQUESTS_PER_MINUTE = 3500
+OPENAI_TOKENS_PER_MINUTE = 90000
+# Completion tokens reserved for a request without max_tokens
+DEFAULT_COMPLETION_TOKENS = 256
+# Requests waiting for the budget are served by priority, lower first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SUM_UP = 1
+PRIORITY_DIGEST = 2
+# Retries of rate-limited, timed out and failed requests, the delays grow from the base and are jittered
+COMPLETION_RETRIES = 3
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8
+# Failed requests in a row that open the circuit, and seconds until one request may try again
+BREAKER_FAILURES = 5
+BREAKER_RESET_TIMEOUT = 30
+
+OPENAI_SECONDS = metrics.histogram('openai_request_seconds', 'Time of OpenAI chat completion requests.', ['mode'])
+OPENAI_TOKENS = metrics.counter('openai_tokens_total', 'Prompt (in) and completion (out) tokens of OpenAI requests.', ['direction'])
+OPENAI_ERRORS = metrics.counter('openai_errors_total', 'Failed OpenAI requests by error type.', ['error'])
+COMPLETION_REQUESTS = metrics.counter('completion_requests_total', 'Completions by where the answer came from.', ['source'])
+OPENAI_RETRIES = metrics.counter('openai_retries_total', 'Retried OpenAI requests by error type.', ['error'])
+OPENAI_WAIT_SECONDS = metrics.histogram('openai_rate_wait_seconds', 'Time requests waited for the rate limit budget.', ['priority'])
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(openai.error.OpenAIError):
+    """The API failed too often, requests fail at once until the circuit breaker lets one try again."""
+
+
+def is_retryable(error):
+    """Return True for errors that a later retry of the same request may not get."""
+    if isinstance(error, openai.error.APIError):
+        return error.http_status is None or error.http_status >= 500
+    return isinstance(error, (openai.error.RateLimitError, openai.error.Timeout, openai.error.APIConnectionError,
+                              openai.error.ServiceUnavailableError, openai.error.TryAgain, asyncio.TimeoutError))
+
+def retry_delay(error, attempt, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+    """Seconds to wait before the retry: the Retry-After of the answer or a random part of the exponential backoff."""
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        retry_after = float(headers.get('retry-after') or headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        retry_after = None
+    if retry_after is not None:
+        # Requests limited at the same time don't come back all at once
+        return retry_after + random.uniform(0, base_delay)
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+def estimate_tokens(messages, params, count_prompt_tokens=None):
+    """Return the tokens the request takes from the tokens per minute budget, prompt and completion."""
+    if count_prompt_tokens is not None:
+        prompt_tokens = count_prompt_tokens(messages)
+    else:
+        prompt_tokens = sum(len(str(message.get('content', ''))) for message in messages) // 4
+    return prompt_tokens + params.get('max_tokens', DEFAULT_COMPLETION_TOKENS)
+
+
+class RateLimiter:
+    """Token buckets of the requests and tokens per minute with a priority queue of the requests that wait.
+
+    acquire(tokens, priority) returns when both buckets have room for one request of that
+    many tokens. Waiting requests are served by priority and in arrival order inside one
+    priority, so interactive questions go ahead of queued /sum_up chunks, and a large
+    request isn't overtaken forever by smaller ones of the same priority. A bucket of None
+    doesn't limit. The budgets are for `period` seconds, one minute except in tests.
+    """
+
+    def __init__(self, requests_per_minute=OPENAI_REQUESTS_PER_MINUTE, tokens_per_minute=OPENAI_TOKENS_PER_MINUTE, period=60):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.period = period
+        self._requests = requests_per_minute or 0
+        self._tokens = tokens_per_minute or 0
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        # Heap of [priority, arrival number, tokens, future]
+        self._waiters = []
+        self._arrivals = itertools.count()
+        self._timer = None
+
+    def __len__(self):
+        """The number of waiting requests."""
+        return sum(not waiter[3].done() for waiter in self._waiters)
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed, self._updated = now - self._updated, now
+        if self.requests_per_minute is not None:
+            self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / self.period)
+        if self.tokens_per_minute is not None:
+            self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / self.period)
+
+    def _delay(self, tokens):
+        """Seconds until a request of that many tokens fits the budgets, 0 if it fits now."""
+        delay = self._paused_until - time.monotonic()
+        if self.requests_per_minute is not None:
+            delay = max(delay, (1 - self._requests) * self.period / self.requests_per_minute)
+        if self.tokens_per_minute is not None:
+            # A request larger than the whole budget waits for a full bucket
+            tokens = min(tokens, self.tokens_per_minute)
+            delay = max(delay, (tokens - self._tokens) * self.period / self.tokens_per_minute)
+        return max(0.0, delay)
+
+    def _take(self, tokens):
+        self._requests -= 1
+        self._tokens -= tokens if self.tokens_per_minute is None else min(tokens, self.tokens_per_minute)
+
+    async def acquire(self, tokens, priority=PRIORITY_INTERACTIVE):
+        """Wait until the request of that many tokens fits the budgets and take them."""
+        self._refill()
+        if not self._waiters and self._delay(tokens) == 0:
+            self._take(tokens)
+            return
+
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, [priority, next(self._arrivals), tokens, future])
+        self._wake_soon()
+        try:
+            await future
+        finally:
+            OPENAI_WAIT_SECONDS.observe(time.perf_counter() - start, priority=priority)
+
+    def _wake_soon(self):
+        # A new first waiter may need a shorter wait than the one the timer was set for
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_soon(self._wake)
+
+    def _wake(self):
+        self._timer = None
+        self._refill()
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():
+                # The waiting task was cancelled
+                heapq.heappop(self._waiters)
+                continue
+            delay = self._delay(tokens)
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._wake)
+                return
+            heapq.heappop(self._waiters)
+            self._take(tokens)
+            future.set_result(None)
+
+    def refund(self, tokens):
+        """Give back the tokens reserved above the real usage, or take more with a negative number."""
+        if self.tokens_per_minute is None:
+            return
+        self._refill()
+        self._tokens = min(self.tokens_per_minute, self._tokens + tokens)
+
+    def pause(self, seconds):
+        """Send no request for the seconds, after the API answered with a rate limit error."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class PrioritySemaphore:
+    """Semaphore that gives the freed slots to the waiters by priority, lower first, and in arrival order inside one priority."""
+
+    def __init__(self, value):
+        self._value = value
+        # Heap of (priority, arrival number, future)
+        self._waiters = []
+        self._arrivals = itertools.count()
+
+    def __len__(self):
+        """The number of waiting tasks."""
+        return sum(not waiter[2].done() for waiter in self._waiters)
+
+    async def acquire(self, priority=PRIORITY_INTERACTIVE):
+        # A free slot means nobody is waiting, release() hands the slots to the waiters first
+        if self._value > 0:
+            self._value -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._arrivals), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just before the task was cancelled
+                self.release()
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+    @contextlib.asynccontextmanager
+    async def hold(self, priority=PRIORITY_INTERACTIVE):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class CircuitBreaker:
+    """Fails requests at once after failure_threshold failures in a row.
+
+    When reset_timeout passed since the circuit opened one request is let through,
+    its success closes the circuit and its failure opens it for another reset_timeout.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_started = None
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'open' if time.monotonic() - self.opened_at < self.reset_timeout else 'half-open'
+
+    def before_request(self):
+        """Raise CircuitOpenError if the request must not be sent."""
+        if self.opened_at is None:
+            return
+        now = time.monotonic()
+        # A trial request that never came back, e.g. cancelled, doesn't block the circuit forever
+        trial_running = self._trial_started is not None and now - self._trial_started < self.reset_timeout
+        if now - self.opened_at < self.reset_timeout or trial_running:
+            raise CircuitOpenError(f'OpenAI API failed {self.failures} times in a row, requests are paused')
+        self._trial_started = now
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info('OpenAI API answers again, circuit closed')
+        self.failures = 0
+        self.opened_at = None
+        self._trial_started = None
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_started = None
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning('OpenAI API failed %s times in a row, circuit opened', self.failures)
+            self.opened_at = time.monotonic()
+
+
+def make_completion_key(model, messages, params):
+    """Return the hash of everything that defines the completion."""
+    payload = json.dumps([model, messages, params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class CompletionCache:
+    """Content-addressed cache of completion texts with TTL and LRU eviction.
+
+    With a path the entries are also kept as '<key>.json' files, so they live through restarts.
+    The methods then do blocking file I/O, CompletionClient calls them in an I/O thread.
+    """
+
+    def __init__(self, ttl=COMPLETION_CACHE_TTL, max_entries=COMPLETION_CACHE_SIZE, path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.json')
+
+    def _remove_file(self, key):
+        if self.path and os.path.isfile(self._file(key)):
+            os.remove(self._file(key))
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None and self.path and os.path.isfile(self._file(key)):
+            with open(self._file(key), 'r') as f:
+                entry = json.load(f)
+            self._entries[key] = entry
+
+        if entry is not None and time.time() - entry['created'] > self.ttl:
+            del self._entries[key]
+            self._remove_file(key)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        self._evict()
+        return entry['response']
+
+    def put(self, key, response):
+        entry = {'created': time.time(), 'response': response}
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            if self.path:
+                write_json_atomic(self._file(key), entry)
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            key, _ = self._entries.popitem(last=False)
+            self._remove_file(key)
+
+    def stats(self):
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class CompletionClient:
+    """Async OpenAI chat completion client with a bounded number of requests in flight.
+
+    Every user can hold at most max_per_user of the max_concurrency slots, so one user
+    with a queue of heavy /sum_up requests can't starve the other chats.
+
+    Requests wait for the requests and tokens per minute budgets in the rate limiter and
+    for the global slots by priority. Rate-limited, timed out and failed requests are retried after a jittered
+    backoff, and the circuit breaker fails requests at once while the API is down.
+
+    Answers are kept in the optional completion cache, and identical requests that
+    come while the first one is in flight wait for it instead of calling the API again.
+    When all handler tasks that wait for a request are cancelled, the HTTP request is
+    cancelled too.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENT_COMPLETIONS, max_per_user=MAX_COMPLETIONS_PER_USER, timeout=COMPLETION_TIMEOUT, cache=None,
+                 count_prompt_tokens=None, rate_limiter=None, circuit_breaker=None, retries=COMPLETION_RETRIES, run_io=None):
+        """
+        Args:
+            count_prompt_tokens (callable): Counts the tokens of the messages for the token budget
+                and for the metrics of streamed requests, the API reports the usage only without streaming.
+            rate_limiter (RateLimiter): The budgets of the account, the default ones if None.
+            circuit_breaker (CircuitBreaker): The default one if None.
+            retries (int): Retries of a failed request.
+            run_io (callable): Coroutine function that runs a blocking function in an I/O thread,
+                like Executors.run_io, for a completion cache on the disk. The default executor of the loop if None.
+        """
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self.timeout = timeout
+        self.cache = cache
+        self.count_prompt_tokens = count_prompt_tokens
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+        self.retries = retries
+        self.run_io = run_io
+        self.retried = 0
+        # completion key -> [task, number of waiting callers]
+        self._in_flight_requests = {}
+        self.coalesced = 0
+
+        self._semaphore = PrioritySemaphore(max_concurrency)
+        # user_id -> [semaphore, number of requests that use it]
+        self._user_semaphores = {}
+        self.in_flight = 0
+
+    def _acquire_user_semaphore(self, user_id):
+        entry = self._user_semaphores.setdefault(user_id, [asyncio.Semaphore(self.max_per_user), 0])
+        entry[1] += 1
+        return entry[0]
+
+    def _release_user_semaphore(self, user_id):
+        entry = self._user_semaphores[user_id]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._user_semaphores[user_id]
+
+    @contextlib.asynccontextmanager
+    async def user_slot(self, user_id):
+        """Hold a slot of the user for a job of many requests, like a map-reduce /sum_up.
+
+        The requests of the job are sent without user_id, so they share the global slots
+        and the job counts once against the limit of the user.
+        """
+        user_semaphore = self._acquire_user_semaphore(user_id)
+        try:
+            async with user_semaphore:
+                yield
+        finally:
+            self._release_user_semaphore(user_id)
+
+    async def _cache_call(self, method, *args):
+        # A cache with a path reads and writes files, which must not block the event loop
+        if self.cache.path is None:
+            return method(*args)
+        if self.run_io is not None:
+            return await self.run_io(method, *args)
+        return await asyncio.get_running_loop().run_in_executor(None, partial(method, *args))
+
+    async def _create(self, model, messages, **params):
+        return await openai.ChatCompletion.acreate(model=model, messages=messages, **params)
+
+    async def _limited(self, user_id, request, mode, tokens, priority, can_retry=lambda: True):
+        """Await request() holding a slot of the user, the rate limit budget and a global slot, retrying failures.
+        Args:
+            tokens (int): The estimated tokens of the request.
+            priority (int): PRIORITY_INTERACTIVE, PRIORITY_SUM_UP or PRIORITY_DIGEST.
+            can_retry (callable): Returns False when a failed request must not be sent again.
+        """
+        # Requests without a user share only the global slots
+        async with self.user_slot(user_id) if user_id is not None else contextlib.nullcontext():
+            for attempt in itertools.count():
+                self.circuit_breaker.before_request()
+                await self.rate_limiter.acquire(tokens, priority)
+                async with self._semaphore.hold(priority):
+                    self.in_flight += 1
+                    try:
+                        with OPENAI_SECONDS.time(mode=mode):
+                            response = await request()
+                    except (openai.error.OpenAIError, asyncio.TimeoutError) as error:
+                        OPENAI_ERRORS.inc(error=type(error).__name__)
+                        delay = retry_delay(error, attempt)
+                        if isinstance(error, openai.error.RateLimitError) or not is_retryable(error):
+                            # The API is up and answered, the budget is spent or the request is wrong
+                            self.circuit_breaker.record_success()
+                        else:
+                            self.circuit_breaker.record_failure()
+                        if not is_retryable(error):
+                            raise
+                        if isinstance(error, openai.error.RateLimitError):
+                            self.rate_limiter.pause(delay)
+                        if attempt >= self.retries or not can_retry() or self.circuit_breaker.state != 'closed':
+                            raise
+                        OPENAI_RETRIES.inc(error=type(error).__name__)
+                        self.retried += 1
+                    else:
+                        self.circuit_breaker.record_success()
+                        return response
+                    finally:
+                        self.in_flight -= 1
+                await asyncio.sleep(delay)
+
+    async def _request(self, messages, model, user_id, priority, **params):
+        tokens = estimate_tokens(messages, params, self.count_prompt_tokens)
+        response = await self._limited(user_id, lambda: asyncio.wait_for(self._create(model, messages, **params), self.timeout), 'complete',
+                                       tokens, priority)
+        usage = response.get('usage')
+        if usage:
+            OPENAI_TOKENS.inc(usage['prompt_tokens'], direction='in')
+            OPENAI_TOKENS.inc(usage['completion_tokens'], direction='out')
+            self.rate_limiter.refund(tokens - usage['total_tokens'])
+        return response.choices[0].message["content"]
+
+    async def _stream(self, messages, model, on_delta, tokens, **params):
+        chunks = await asyncio.wait_for(self._create(model, messages, stream=True, **params), self.timeout)
+        prompt_tokens = estimate_tokens(messages, {'max_tokens': 0}, self.count_prompt_tokens)
+        OPENAI_TOKENS.inc(prompt_tokens, direction='in')
+        text = ''
+        completion_tokens = 0
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+            except StopAsyncIteration:
+                self.rate_limiter.refund(tokens - prompt_tokens - completion_tokens)
+                return text
+            delta = chunk.choices[0].delta.get("content") if chunk.choices else None
+            if delta:
+                # Every streamed chunk carries one token
+                OPENAI_TOKENS.inc(direction='out')
+                completion_tokens += 1
+                text += delta
+                on_delta(text)
+
+    async def complete(self, messages, model, user_id=None, priority=PRIORITY_INTERACTIVE, **params):
+        """Request the completion and return the text of the first choice.
+        Args:
+            messages (list): The chat messages for the model.
+            model (str): The model name.
+            user_id (int): The user that waits for the answer, None for no per-user limit.
+            priority (int): The place in the queue for the rate limit budget, lower goes first.
+        Returns:
+            str: The completion text.
+        Raises:
+            openai.error.OpenAIError: When the request failed after the retries, CircuitOpenError when it wasn't sent.
+        """
+        key = make_completion_key(model, messages, params)
+        if self.cache is not None:
+            response = await self._cache_call(self.cache.get, key)
+            if response is not None:
+                COMPLETION_REQUESTS.inc(source='cache')
+                return response
+
+        request = self._in_flight_requests.get(key)
+        if request is None:
+            request = [asyncio.ensure_future(self._request(messages, model, user_id, priority, **params)), 0]
+            self._in_flight_requests[key] = request
+            COMPLETION_REQUESTS.inc(source='api')
+        else:
+            self.coalesced += 1
+            COMPLETION_REQUESTS.inc(source='coalesced')
+
+        task = request[0]
+        request[1] += 1
+        try:
+            response = await asyncio.shield(task)
+        finally:
+            request[1] -= 1
+            if request[1] == 0:
+                if self._in_flight_requests.get(key) is request:
+                    del self._in_flight_requests[key]
+                if not task.done():
+                    task.cancel()
+
+        if self.cache is not None:
+            await self._cache_call(self.cache.put, key, response)
+        return response
+
+    async def stream(self, messages, model, on_delta, user_id=None, priority=PRIORITY_INTERACTIVE, **params):
+        """Request the completion with stream=True and call on_delta(text so far) for every new piece.
+
+        A failed stream is retried only if no text came yet.
+        Args:
+            messages (list): The chat messages for the model.
+            model (str): The model name.
+            on_delta (callable): Called with the whole text received so far.
+            user_id (int): The user that waits for the answer, None for no per-user limit.
+            priority (int): The place in the queue for the rate limit budget, lower goes first.
+        Returns:
+            str: The completion text.
+        """
+        key = make_completion_key(model, messages, params)
+        if self.cache is not None:
+            response = await self._cache_call(self.cache.get, key)
+            if response is not None:
+                COMPLETION_REQUESTS.inc(source='cache')
+                on_delta(response)
+                return response
+
+        COMPLETION_REQUESTS.inc(source='api')
+        streamed = False
+
+        def on_stream_delta(text):
+            nonlocal streamed
+            streamed = True
+            on_delta(text)
+
+        tokens = estimate_tokens(messages, params, self.count_prompt_tokens)
+        response = await self._limited(user_id, lambda: self._stream(messages, model, on_stream_delta, tokens, **params), 'stream',
+                                       tokens, priority, can_retry=lambda: not streamed)
+
+        if self.cache is not None:
+            await self._cache_call(self.cache.put, key, response)
+        return response
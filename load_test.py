@@ -0,0 +1,283 @@
+"""Offline load test that replays synthetic traffic through the bot handlers.
+
+Run a profile with `python load_test.py default` or override its fields with
+`python load_test.py heavy --groups 500 --messages-per-second 300`.
+
+Telegram is replaced by FakeBot and OpenAI by a local FakeOpenAIServer, all bot
+data is written to a temporary directory. The report has the throughput, latency
+percentiles per kind of update, bytes written to the disk and the peak RSS.
+"""
+import argparse
+import asyncio
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import openai
+from telegram import Update
+
+import main_gpt
+from chat_storage import SegmentedChatLog, ChatHistoryCache
+from digests import DigestStore
+from fake_openai import FakeOpenAIServer
+from fake_telegram import FakeBot, private_message, group_message, new_member_message
+from llm_client import CompletionClient, CompletionCache
+from registry import Registry
+from send_queue import SendQueue
+from summarizer import SummaryCache
+
+
+GROUP_TEXTS = [
+    'good morning everyone',
+    'did anybody see the release notes for the new version?',
+    'I will be late for the meeting today, start without me',
+    'the build is broken again on the main branch',
+    'lol 😂',
+    'can someone review my pull request please, it is a small one',
+    'we should move the deadline to the next friday',
+    'ok',
+]
+
+
+class TrafficProfile:
+    """Shape of the synthetic traffic.
+
+    Every update is a group message, a private question to the bot or a /sum_up
+    of one of the groups of the user (the command and the answer with the group
+    name), picked at random by sum_up_share and question_share.
+    """
+
+    def __init__(self, groups=20, users=50, messages_per_second=20, duration=10, sum_up_share=0.05,
+                 question_share=0.05, history_depth=1000, sum_up_messages=100,
+                 openai_latency=0.5, openai_token_delay=0.005, bot_latency=0.01, seed=1):
+        self.groups = groups
+        self.users = users
+        self.messages_per_second = messages_per_second
+        self.duration = duration
+        self.sum_up_share = sum_up_share
+        self.question_share = question_share
+        self.history_depth = history_depth
+        self.sum_up_messages = sum_up_messages
+        self.openai_latency = openai_latency
+        self.openai_token_delay = openai_token_delay
+        self.bot_latency = bot_latency
+        self.seed = seed
+
+
+PROFILES = {
+    'smoke': TrafficProfile(groups=3, users=5, messages_per_second=10, duration=3, sum_up_share=0.2, question_share=0.2,
+                            history_depth=100, openai_latency=0.1),
+    'default': TrafficProfile(),
+    'heavy': TrafficProfile(groups=200, users=500, messages_per_second=200, duration=30, sum_up_share=0.02,
+                            question_share=0.02, history_depth=10000),
+}
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def written_bytes():
+    """Bytes passed to write() by the process so far, None where /proc isn't available."""
+    try:
+        with open('/proc/self/io', 'r') as f:
+            return int(dict(line.split(': ') for line in f.read().splitlines())['wchar'])
+    except (OSError, KeyError):
+        return None
+
+def peak_rss():
+    """Peak resident set size of the process in bytes."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class LoadTest:
+    """Points the state of main_gpt at a temporary directory and the fakes, and replays the profile."""
+
+    def __init__(self, profile, path):
+        self.profile = profile
+        self.path = path
+        self.random = random.Random(profile.seed)
+        self.bot = FakeBot(latency=profile.bot_latency)
+
+        self.update_id = 0
+        self.user_groups = {}
+        self.user_locks = {}
+        self.latencies = {}
+
+    def install(self):
+        for name in ('chat_history', 'summary_cache'):
+            os.makedirs(os.path.join(self.path, name), exist_ok=True)
+
+        main_gpt.chat_log = SegmentedChatLog(os.path.join(self.path, 'chat_history'), main_gpt.MAX_CHAT_HISTORY_LEN)
+        main_gpt.chat_history_cache = ChatHistoryCache(main_gpt.chat_log, classify=main_gpt.classify_message, index_text=main_gpt.index_text)
+        main_gpt.summary_cache = SummaryCache(os.path.join(self.path, 'summary_cache'))
+        main_gpt.digest_store = DigestStore(os.path.join(self.path, 'digests'))
+        main_gpt.registry = Registry(os.path.join(self.path, 'registry.sqlite3'))
+        main_gpt.completion_cache = CompletionCache(main_gpt.COMPLETION_CACHE_TTL, main_gpt.COMPLETION_CACHE_SIZE)
+        main_gpt.completion_client = CompletionClient(cache=main_gpt.completion_cache, run_io=main_gpt.executors.run_io)
+        main_gpt.send_queue = SendQueue(self.bot)
+
+    def make_update(self, make_json, chat_id, *args):
+        self.update_id += 1
+        message_id = self.bot.next_message_id(chat_id)
+        return Update.de_json(make_json(self.update_id, message_id, *args), self.bot)
+
+    def group(self, number):
+        return -1000 - number, f'Group {number}'
+
+    async def handle(self, kind, handlers):
+        """Run the handlers of one user action one after another and record the latency."""
+        start = time.perf_counter()
+        for handler, *update_args in handlers:
+            # The update gets its message id when it arrives, after the answers to the previous ones
+            await handler(self.make_update(*update_args), None)
+        self.latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    async def setup(self):
+        """Start every user, let the owners add the bot to the groups and fill the group histories."""
+        profile = self.profile
+        for user_id in range(1, profile.users + 1):
+            await main_gpt.start(self.make_update(private_message, user_id, user_id, '/start'), None)
+
+        text_tokens = {text: main_gpt.count_tokens(text) for text in GROUP_TEXTS}
+        for number in range(profile.groups):
+            chat_id, title = self.group(number)
+            owner = number % profile.users + 1
+            self.user_groups.setdefault(owner, []).append(title)
+
+            main_gpt.chat_log.append(title, ((message_id, {
+                'chat_id': chat_id, 'user_id': message_id % profile.users + 1,
+                'username': f'user_{message_id % profile.users + 1}',
+                'message_text': text, 'tokens': text_tokens[text],
+            }) for message_id, text in ((i, GROUP_TEXTS[i % len(GROUP_TEXTS)]) for i in range(profile.history_depth))))
+            self.bot.message_ids[chat_id] = profile.history_depth
+
+            update = self.make_update(new_member_message, chat_id, chat_id, title, owner, main_gpt.BOT_USERNAME)
+            await main_gpt.add_new_member(update, None)
+
+    def next_action(self):
+        profile = self.profile
+        choice = self.random.random()
+        if choice < profile.sum_up_share:
+            user_id = self.random.choice(list(self.user_groups))
+            title = self.random.choice(self.user_groups[user_id])
+            return 'sum_up', user_id, [
+                (main_gpt.sum_up, private_message, user_id, user_id, '/sum_up'),
+                (main_gpt.text_message_parser, private_message, user_id, user_id, f'{title}\n{profile.sum_up_messages}'),
+            ]
+        if choice < profile.sum_up_share + profile.question_share:
+            user_id = self.random.randint(1, profile.users)
+            return 'question', user_id, [
+                (main_gpt.text_message_parser, private_message, user_id, user_id, 'what can you do for me?'),
+            ]
+
+        chat_id, title = self.group(self.random.randrange(profile.groups))
+        user_id = self.random.randint(1, profile.users)
+        text = self.random.choice(GROUP_TEXTS)
+        return 'group_message', None, [
+            (main_gpt.text_message_parser, group_message, chat_id, chat_id, title, user_id, text),
+        ]
+
+    async def run_action(self, kind, user_id, handlers):
+        if user_id is None:
+            return await self.handle(kind, handlers)
+        # Private updates of one user depend on each other, like a user waiting for the answer
+        async with self.user_locks.setdefault(user_id, asyncio.Lock()):
+            await self.handle(kind, handlers)
+
+    async def flush_periodically(self):
+        while True:
+            await asyncio.sleep(main_gpt.HISTORY_FLUSH_INTERVAL)
+            await main_gpt.flush_chat_history(None)
+
+    async def run(self):
+        profile = self.profile
+        server = await FakeOpenAIServer(latency=profile.openai_latency, token_delay=profile.openai_token_delay).start()
+        openai.api_base = server.api_base
+        openai.api_key = 'fake'
+
+        self.install()
+        await self.setup()
+        await main_gpt.send_queue.join()
+        await main_gpt.flush_chat_history(None)
+        self.latencies.clear()
+        self.bot.calls = dict.fromkeys(self.bot.calls, 0)
+
+        disk_before, written_before = directory_size(self.path), written_bytes()
+        flusher = asyncio.create_task(self.flush_periodically())
+
+        tasks = []
+        actions = int(profile.messages_per_second * profile.duration)
+        start = time.perf_counter()
+        # Open loop: actions arrive on schedule whether or not the earlier ones are done
+        for number in range(actions):
+            delay = start + number / profile.messages_per_second - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(self.run_action(*self.next_action())))
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        elapsed = time.perf_counter() - start
+
+        flusher.cancel()
+        await main_gpt.send_queue.join()
+        await main_gpt.flush_chat_history(None)
+        written_after = written_bytes()
+        disk_after = directory_size(self.path)
+        await server.stop()
+        main_gpt.registry.close()
+
+        return {
+            'actions': actions,
+            'errors': [repr(result) for result in results if isinstance(result, Exception)],
+            'elapsed': elapsed,
+            'actions_per_second': actions / elapsed,
+            'latencies': {kind: (len(values), percentile(values, 0.5), percentile(values, 0.95), percentile(values, 0.99))
+                          for kind, values in self.latencies.items()},
+            'disk_bytes': disk_after - disk_before,
+            'written_bytes': None if written_before is None else written_after - written_before,
+            'peak_rss': peak_rss(),
+            'bot_calls': dict(self.bot.calls),
+            'openai_requests': len(server.requests),
+        }
+
+
+def run_load_test(profile):
+    """Replay the traffic profile through the handlers and return the report."""
+    with tempfile.TemporaryDirectory() as path:
+        return asyncio.run(LoadTest(profile, path).run())
+
+def print_report(report):
+    print(f"{report['actions']} actions in {report['elapsed']:.2f} s, {report['actions_per_second']:.1f} actions/s, "
+          f"{len(report['errors'])} errors")
+    print('kind          | count | p50, ms | p95, ms | p99, ms')
+    for kind, (count, p50, p95, p99) in sorted(report['latencies'].items()):
+        print(f'{kind:<13} | {count:>5} | {p50 * 1000:>7.1f} | {p95 * 1000:>7.1f} | {p99 * 1000:>7.1f}')
+    print(f"disk growth: {report['disk_bytes'] / 1024:.1f} KB, written by write(): "
+          + ('n/a' if report['written_bytes'] is None else f"{report['written_bytes'] / 1024:.1f} KB"))
+    print(f"peak RSS: {report['peak_rss'] / 2**20:.1f} MB")
+    print(f"telegram calls: {report['bot_calls']}, openai requests: {report['openai_requests']}")
+    for error in report['errors'][:5]:
+        print('error:', error)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('profile', nargs='?', default='default', choices=list(PROFILES))
+    for name, value in vars(TrafficProfile()).items():
+        parser.add_argument('--' + name.replace('_', '-'), type=type(value), default=None)
+    arguments = vars(parser.parse_args())
+
+    profile = PROFILES[arguments.pop('profile')]
+    for name, value in arguments.items():
+        if value is not None:
+            setattr(profile, name, value)
+
+    print_report(run_load_test(profile))
+    main_gpt.executors.shutdown()
@@ -1,10 +1,25 @@
 import logging
 import json
+import bisect
+import asyncio
+import datetime
+import time
 import openai
 import os
 import re
-import tiktoken
 import telegram
+import metrics
+from chat_storage import SegmentedChatLog, ChatHistoryCache
+from llm_client import CompletionClient, CompletionCache, PRIORITY_INTERACTIVE, PRIORITY_SUM_UP, PRIORITY_DIGEST
+from executors import Executors, monitor_loop_lag
+from summarizer import split_into_chunks, summarize_chunks, SummaryCache
+from digests import DigestStore, DIGEST_PERIODS
+from registry import Registry
+from webhook import WebhookServer, run_webhook
+from send_queue import SendQueue, split_text, GLOBAL_RATE, MAX_MESSAGE_LENGTH
+from sharding import ShardRouter
+from update_processor import ChatOrderedUpdateProcessor
+from tokenizer import Tokenizer
 from telegram import Update, Chat, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters
 
@@ -16,6 +31,12 @@ PATH = os.getcwd()
 PATH_CHAT_HISTORY = os.path.join(PATH, 'chat_history')
 PATH_KEYS_ACCESS = os.path.join(PATH, 'keys_access')
 PATH_CHAT_ACCESS = os.path.join(PATH, 'chat_access')
+PATH_SUMMARY_CACHE = os.path.join(PATH, 'summary_cache')
+PATH_COMPLETION_CACHE = os.path.join(PATH, 'completion_cache')
+PATH_DIGESTS = os.path.join(PATH, 'digests')
+PATH_REGISTRY = os.path.join(PATH, 'registry.sqlite3')
+# BPE files of tiktoken shipped with the bot, filled by `python tokenizer.py download tiktoken_cache`
+PATH_TOKENIZER_CACHE = os.path.join(PATH, 'tiktoken_cache')
 
 BOT_USERNAME = 'big_summarizer_bot'
 AI_MODEL_NAME = "gpt-3.5-turbo"
@@ -40,7 +61,58 @@ SYSTEM_MESSAGE = """
 
 MAX_CHAT_HISTORY_LEN = 10000
 MAX_CHAT_MEMORY_LEN = 100
+SUM_UP_DEFAULT_MESSAGES = 100
+# Seconds in the units of /sum_up durations like 30m, 3h or 1d12h
+DURATION_UNITS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+# Kinds of the history messages that make the dialog with the bot, other messages have no kind
+MESSAGE_QUESTION = 'question'
+MESSAGE_ANSWER = 'answer'
 MAX_TOKENS = 3000
+# Chat messages found by the search index for a question to the bot in a group
+# and the part of MAX_TOKENS they may take in the prompt
+RELATED_MESSAGES = 20
+RELATED_MAX_TOKENS = 1000
+RELATED_HEADER = 'Earlier messages of this chat that may be related to the question:\n'
+# Tokens added to every chat message around its content (<|start|>{role}\n{content}<|end|>\n)
+# and to the reply (<|start|>assistant<|message|>), see num_tokens_from_messages
+TOKENS_PER_CHAT_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+SUM_UP_MAP_REDUCE = True
+STREAM_COMPLETIONS = True
+# A streamed answer is edited into the message when this time passed or this many characters came
+STREAM_EDIT_INTERVAL = 1.0
+STREAM_EDIT_CHARS = 200
+SUM_UP_CONCURRENCY = 4
+# Tokens left free in every map-reduce chunk for merges across line borders
+CHUNK_TOKENS_MARGIN = 50
+HISTORY_FLUSH_INTERVAL = 5
+# Scheduled digests: seconds between the checks for due ones, digests made at once
+# and the local hours in which the digests of every period are made
+DIGEST_CHECK_INTERVAL = 300
+DIGEST_CONCURRENCY = 2
+DIGEST_HOURS = {DIGEST_PERIODS['hourly']: range(24), DIGEST_PERIODS['daily']: range(2, 6)}
+# Updates of different chats processed at once, the updates of one chat still go one by one
+CONCURRENT_UPDATES = 64
+# 'polling' or 'webhook', the webhook URL and secret token are read from keys.json
+RUN_MODE = os.environ.get('BOT_RUN_MODE', 'polling')
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/telegram'
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_WORKERS = 16
+# Worker processes that share the chats by chat id, more than 1 needs the webhook mode
+SHARD_WORKERS = int(os.environ.get('BOT_SHARD_WORKERS', '1'))
+COMPLETION_CACHE_TTL = 600
+COMPLETION_CACHE_SIZE = 1000
+COMPLETION_CACHE_ON_DISK = False
+IO_THREADS = 4
+CPU_PROCESSES = os.cpu_count() or 1
+LOOP_LAG_THRESHOLD = 0.1
+METRICS_ENABLED = True
+METRICS_HOST = '0.0.0.0'
+METRICS_PORT = 9090
+# Log the time spent in every step of every update, BOT_TRACE_UPDATES=1 to enable
+TRACE_UPDATES = os.environ.get('BOT_TRACE_UPDATES') == '1'
 
 make_prompt = lambda history_text: [{"role": "user", "content": f"""
                                             Your task is to generate a short summary 
@@ -57,8 +129,93 @@ make_prompt = lambda history_text: [{"role": "user", "content": f"""
 
                                             Conversation: ```{history_text}```"""}]
 
-make_access_file_name = lambda username, user_id: str(username) + '_' + str(user_id)
-get_message_from_history = lambda chat_history, number: chat_history[list(chat_history.keys())[number]] 
+make_reduce_prompt = lambda summaries_text: [{"role": "user", "content": f"""
+                                            Your task is to combine the summaries of consecutive parts
+                                            of one conversation into one short summary
+                                            which is accurate, concise, and informative.
+                                            The summarizing should be in language of the summaries.
+                                            The summarizing should give information about
+                                            the following:
+                                                1.The main topics of discussion
+                                                2.Retell this converstion in a very short infromative format up to 3 tense
+                                                3.Short version of a few main expressions from dialoge with username of sender up to 15 expressions
+                                                4.Any interesting or funny moments, if there is no such moments dont mention this point
+
+                                            Summaries of the parts in order of conversation: ```{summaries_text}```"""}]
+
+get_message_from_history = lambda chat_history, number: chat_history.message(number)
+
+def classify_message(message_data):
+    """Returns MESSAGE_ANSWER for the answers of the bot, MESSAGE_QUESTION for the questions to it or None."""
+    message_text = message_data["message_text"]
+    if message_data["username"] == BOT_USERNAME:
+        return MESSAGE_ANSWER if message_text.startswith(ANSWEAR_FLAG) else None
+    return MESSAGE_QUESTION if message_text.startswith((f'@{BOT_USERNAME}', ASK_START_FLAG)) else None
+
+def index_text(message_data):
+    """Returns the text of the message for the search index of the chat, None for the dialog with the bot."""
+    if message_data["username"] == BOT_USERNAME or classify_message(message_data) is not None:
+        return None
+    return f'{message_data["username"]} {message_data["message_text"]}'
+
+def parse_sum_up_range(text, now=None):
+    """Parses the range of messages to sum up.
+
+    Accepts a number of last messages (100), a duration (30m, 3h, 1d12h), a time of
+    the day (18:00, the last one that passed), 'today' or 'yesterday' with an optional
+    time, and a date with an optional time (2024-05-01 18:00). Times are in the local
+    time of the server.
+    Returns:
+        tuple: (number of messages, None) or (None, unix time of the range start), None for an unknown format
+            or a number below 1.
+    """
+    now = time.time() if now is None else now
+    text = ' '.join(text.lower().split())
+    if text.isdigit():
+        return (int(text), None) if int(text) > 0 else None
+
+    if re.fullmatch(r'(\d+ ?[mhdw] ?)+', text):
+        return None, now - sum(int(number) * DURATION_UNITS[unit] for number, unit in re.findall(r'(\d+) ?([mhdw])', text))
+
+    match = re.fullmatch(r'(today|yesterday|\d{4}-\d{2}-\d{2})? ?(\d{1,2}:\d{2})?', text)
+    if not text or match is None:
+        return None
+    day, clock = match.groups()
+    try:
+        if day in (None, 'today', 'yesterday'):
+            date = datetime.date.fromtimestamp(now) - datetime.timedelta(days=day == 'yesterday')
+        else:
+            date = datetime.date.fromisoformat(day)
+        start_time = datetime.time(*map(int, clock.split(':'))) if clock else datetime.time()
+    except ValueError:
+        return None
+
+    start = datetime.datetime.combine(date, start_time).timestamp()
+    if day is None and start > now:
+        start = datetime.datetime.combine(date - datetime.timedelta(days=1), start_time).timestamp()
+    return None, start
+
+tokenizer = Tokenizer(AI_MODEL_NAME, PATH_TOKENIZER_CACHE)
+chat_log = SegmentedChatLog(PATH_CHAT_HISTORY, MAX_CHAT_HISTORY_LEN)
+chat_history_cache = ChatHistoryCache(chat_log, classify=classify_message, index_text=index_text)
+completion_cache = CompletionCache(COMPLETION_CACHE_TTL, COMPLETION_CACHE_SIZE, PATH_COMPLETION_CACHE if COMPLETION_CACHE_ON_DISK else None)
+executors = Executors(io_workers=IO_THREADS, cpu_workers=CPU_PROCESSES)
+completion_client = CompletionClient(cache=completion_cache, count_prompt_tokens=lambda messages: num_tokens_from_messages(messages, AI_MODEL_NAME),
+                                     run_io=executors.run_io)
+summary_cache = SummaryCache(PATH_SUMMARY_CACHE)
+digest_store = DigestStore(PATH_DIGESTS)
+registry = Registry(PATH_REGISTRY)
+send_queue = SendQueue()
+# The sharding.Shard of this process in the multi-worker mode
+shard = None
+
+metrics.gauge('chat_history_cache_bytes', 'Estimated memory of the cached chat histories.', lambda: chat_history_cache.total_bytes)
+metrics.gauge('chat_history_cache_pending', 'Messages waiting to be written to the chat log.', lambda: chat_history_cache.stats()['pending'])
+metrics.gauge('summary_cache_saved_calls', 'Completion calls saved by reused summaries.', lambda: summary_cache.saved_calls)
+DIGESTS = metrics.counter('bot_digests_total', 'Scheduled digest runs by result.', ['result'])
+metrics.gauge('openai_rate_limit_waiting', 'Completion requests waiting for the rate limit budget.', lambda: len(completion_client.rate_limiter))
+metrics.gauge('openai_circuit_open', '1 while the circuit breaker fails OpenAI requests at once.', lambda: int(completion_client.circuit_breaker.state == 'open'))
+metrics.gauge('send_queue_queued', 'Outgoing messages waiting in the send queue.', lambda: send_queue.stats()['queued'])
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -66,7 +223,7 @@ logging.basicConfig(
 )
 
 # Define a function to check if a path exists
-def check_if_needed_path_exist(pathes=[PATH_CHAT_HISTORY, PATH_KEYS_ACCESS, PATH_CHAT_ACCESS]):
+def check_if_needed_path_exist(pathes=[PATH_CHAT_HISTORY, PATH_KEYS_ACCESS, PATH_CHAT_ACCESS, PATH_SUMMARY_CACHE, PATH_COMPLETION_CACHE, PATH_DIGESTS]):
     """Check if the needed paths exist.
     Args:
         pathes (list): The list of paths to check.
@@ -80,45 +237,42 @@ def check_if_needed_path_exist(pathes=[PATH_CHAT_HISTORY, PATH_KEYS_ACCESS, PATH
             print(f'Folder - "{full_path}" created')
 
 def num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
-    """Return the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model in {
-        "gpt-3.5-turbo-0613",
-        "gpt-3.5-turbo-16k-0613",
-        "gpt-4-0314",
-        "gpt-4-32k-0314",
-        "gpt-4-0613",
-        "gpt-4-32k-0613",
-        }:
-        tokens_per_message = 3
-        tokens_per_name = 1
-    elif model == "gpt-3.5-turbo-0301":
+    """Return the number of tokens used by a list of messages.
+
+    All supported models use the cl100k_base encoding of the tokenizer, the model
+    only decides the tokens added around every message.
+    """
+    if model == "gpt-3.5-turbo-0301":
         tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
         tokens_per_name = -1  # if there's a name, the role is omitted
-    elif "gpt-3.5-turbo" in model:
-        # print("Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613")
-    elif "gpt-4" in model:
-        # print("Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
-        return num_tokens_from_messages(messages, model="gpt-4-0613")
+    elif "gpt-3.5-turbo" in model or "gpt-4" in model:
+        # Newer and undated snapshots are counted like gpt-3.5-turbo-0613 and gpt-4-0613
+        tokens_per_message = 3
+        tokens_per_name = 1
     else:
         raise NotImplementedError(
             f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
         )
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
+    values = [value for message in messages for value in message.values()]
+    names = sum(1 for message in messages if "name" in message)
+    num_tokens = tokens_per_message * len(messages) + sum(tokenizer.count_batch(values, wait=False)) + tokens_per_name * names
     num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     return num_tokens
 
+def count_tokens(text):
+    """Return the number of tokens in the text, estimated while the tokenizer loads in the background.
+
+    It's called on the event loop, which must not wait for the tokenizer download of the warm-up thread.
+    """
+    return tokenizer.count(text, wait=False)
+
+def message_tokens(chat_element):
+    """Return the token count saved with the history message or count it for old records."""
+    tokens = chat_element.get('tokens')
+    if tokens is None:
+        tokens = count_tokens(chat_element['message_text'])
+    return tokens
+
 def load_json_file(file_name, path=PATH_CHAT_HISTORY):
     """Loads a JSON file as a dictionary."""
     file = os.path.join(path, str(file_name +'.json'))
@@ -133,101 +287,381 @@ def load_json_file(file_name, path=PATH_CHAT_HISTORY):
     
     return False
 
-def save_message(chat_name, chat_id, user_id, message_id, username, message_text, chat_path=PATH_CHAT_HISTORY):
-    message_data = { message_id:{
+@metrics.traced
+async def load_chat_history(chat_name, chat_id=None, last_n=None, since=None):
+    """Loads the chat history from the cache or from the segmented chat log in the I/O thread.
+
+    With last_n only the newest last_n messages are loaded, and for a chat that
+    isn't cached only the segments that hold them are read and decompressed. With
+    since (unix time) the same goes for the messages sent since then, the history
+    can start with a few older ones, see CompactHistory.count_since.
+    The history of a chat owned by another shard worker is read from the disk after
+    the owner flushed its pending messages, and it isn't cached here.
+    """
+    if shard is not None and chat_id is not None and not shard.owns(chat_id):
+        await shard.flush_remote(chat_id, chat_name)
+        return await executors.run_io(chat_log.load, chat_name, last_n, True, since)
+    if since is not None:
+        if chat_history_cache.is_cached(chat_name):
+            return chat_history_cache.get_since(chat_name, since)
+        return await executors.run_io(chat_history_cache.get_since, chat_name, since)
+    if last_n is not None:
+        if chat_history_cache.is_cached(chat_name):
+            return chat_history_cache.get_tail(chat_name, last_n)
+        return await executors.run_io(chat_history_cache.get_tail, chat_name, last_n)
+    if chat_history_cache.is_cached(chat_name):
+        return chat_history_cache.get(chat_name)
+    return await executors.run_io(chat_history_cache.get, chat_name)
+
+async def count_appended(chat_name, chat_id):
+    """Returns the number of messages ever appended to the chat, the chats of other shard workers are counted like in load_chat_history."""
+    if shard is not None and not shard.owns(chat_id):
+        await shard.flush_remote(chat_id, chat_name)
+        return await executors.run_io(chat_log.appended, chat_name, True)
+    return await executors.run_io(chat_history_cache.appended, chat_name)
+
+async def load_dialog_history(chat_name):
+    """Loads the last MAX_CHAT_MEMORY_LEN questions to the bot and answers of the chat from the dialog index."""
+    if chat_history_cache.is_cached(chat_name):
+        return chat_history_cache.get_dialog(chat_name, MAX_CHAT_MEMORY_LEN)
+    return await executors.run_io(chat_history_cache.get_dialog, chat_name, MAX_CHAT_MEMORY_LEN)
+
+async def find_related_messages(chat_name, question):
+    """Finds the RELATED_MESSAGES messages of the chat that match the question best with the search index of the chat."""
+    query = re.sub(f'@{BOT_USERNAME}', ' ', question)
+    if chat_history_cache.is_indexed(chat_name):
+        return chat_history_cache.search(chat_name, query, RELATED_MESSAGES)
+    # The first search of a chat builds its index from the whole history
+    return await executors.run_io(chat_history_cache.search, chat_name, query, RELATED_MESSAGES)
+
+@metrics.traced
+async def save_message(chat_name, chat_id, user_id, message_id, username, message_text, date=None):
+    """Appends the message to the chat history, date is the datetime the message was sent, now by default."""
+    message_data = {
         "chat_id": chat_id,
         "user_id": user_id,
         "username": username,
         "message_text": message_text,
+        "tokens": count_tokens(message_text),
+        "date": int(date.timestamp() if date is not None else time.time()),
     }
-    }
-
-    chat_history = load_json_file(chat_name)
 
-    if chat_history:
-        if len(chat_history) >= MAX_CHAT_HISTORY_LEN:
-            del chat_history[list(chat_history.keys())[0]]
+    if chat_history_cache.append(chat_name, message_id, message_data):
+        await executors.run_io(chat_history_cache.flush)
+
+async def flush_chat_history(context: ContextTypes.DEFAULT_TYPE):
+    """Writes pending messages of the history cache to the disk."""
+    await executors.run_io(chat_history_cache.flush)
+
+async def on_startup(application):
+    """Starts the event loop lag monitor and the metrics server and gives the bot to the send queue."""
+    send_queue.bot = application.bot
+    # The tokenizer loads in the background, the first update waits for it only if it comes earlier
+    application.bot_data['tokenizer_warmup'] = asyncio.ensure_future(executors.run_io(getattr, tokenizer, 'encoding'))
+    application.bot_data['loop_lag_monitor'] = asyncio.create_task(monitor_loop_lag(LOOP_LAG_THRESHOLD))
+    metrics.enable_tracing(TRACE_UPDATES)
+    if METRICS_ENABLED:
+        # Every shard worker gets the next port after the one of the router process
+        port = METRICS_PORT if shard is None else METRICS_PORT + 1 + shard.index
+        application.bot_data['metrics_server'] = await metrics.start_metrics_server(METRICS_HOST, port)
+
+async def on_stop(application):
+    """Sends the queued messages while the bot is still connected."""
+    await send_queue.join()
+    print('Send queue', send_queue.stats())
+
+async def on_shutdown(application):
+    """Flushes the history cache and stops the executors before the bot stops."""
+    loop_lag_monitor = application.bot_data.pop('loop_lag_monitor', None)
+    if loop_lag_monitor:
+        loop_lag_monitor.cancel()
+    metrics_server = application.bot_data.pop('metrics_server', None)
+    if metrics_server:
+        await metrics_server.cleanup()
+    tokenizer_warmup = application.bot_data.pop('tokenizer_warmup', None)
+    if tokenizer_warmup:
+        await tokenizer_warmup
+
+    chat_history_cache.flush()
+    executors.shutdown()
+    registry.close()
+    print('Chat history cache', chat_history_cache.stats())
+    print('Summary cache', summary_cache.stats())
+    print('Completion cache', completion_cache.stats(), 'coalesced', completion_client.coalesced)
+
+def format_chat_lines(chat_history, number_of_messages):
+    """Return the last messages as '@username : text' lines and the token count of every line."""
+    lines = [f"@{username} : {message_text}\n" for username, message_text in chat_history.tail(number_of_messages).texts()]
+    return lines, tokenizer.count_batch(lines)
 
-        chat_history.update(message_data)
-    else:
-        chat_history = message_data
+def format_chat_from_json2text(chat_history, number_of_messages):
+    lines, line_tokens = format_chat_lines(chat_history, number_of_messages)
 
-    with open(os.path.join(chat_path, chat_name +'.json'), "w") as file:
-        json.dump(chat_history, file)
+    # Every line is encoded once, then the largest suffix of whole messages
+    # that fits the budget is found by binary search over cumulative token counts
+    cumulative_tokens = [0]
+    for tokens in line_tokens:
+        cumulative_tokens.append(cumulative_tokens[-1] + tokens)
 
-    chat_history = load_json_file(chat_name)
-    return chat_history
+    budget = MAX_TOKENS - count_tokens(make_prompt('')[0]['content'])
+    first = bisect.bisect_left(cumulative_tokens, cumulative_tokens[-1] - budget)
 
-def format_chat_from_json2text(chat_history, number_of_messages):
-    list_history_slice = list(chat_history.keys())
-
-    if len(list_history_slice) > number_of_messages:
-        list_history_slice = list_history_slice[-number_of_messages:]
-    chat_text = ''
-
-    for key in list_history_slice:
-        chat_element = chat_history[key]
-        string = f"@{chat_element['username']} : {chat_element['message_text']}\n"
-        chat_text += string
-
-    prompt = make_prompt(chat_text)
-    tokens_number = len(token_encoder.encode(prompt[0]['content']))
-    print('Start tokens', tokens_number)
-    while tokens_number > MAX_TOKENS:
-        chat_text = chat_text[100:]
-        prompt = make_prompt(chat_text)
-        tokens_number = len(prompt[0]['content'])
-    print('End tokens', tokens_number)
+    # Tokens can merge across line borders, so check the final prompt exactly
+    chat_text = ''.join(lines[first:])
+    tokens_number = count_tokens(make_prompt(chat_text)[0]['content'])
+    while tokens_number > MAX_TOKENS and first < len(lines):
+        first += 1
+        chat_text = ''.join(lines[first:])
+        tokens_number = count_tokens(make_prompt(chat_text)[0]['content'])
 
     return chat_text
 
-def make_chatbot_history(chat_history):
+def make_related_message(related):
+    """Makes the system message with the chat messages related to the question.
+    Args:
+        related (list): (sequence number, message data) best first, see find_related_messages.
+    Returns:
+        tuple: The message with the best related messages that fit into RELATED_MAX_TOKENS in chat order
+            or None, and the tokens of its content.
+    """
+    tokens_number = count_tokens(RELATED_HEADER)
+    chosen = []
+    for seq, chat_element in related:
+        date = chat_element.get("date")
+        sent = time.strftime(' %Y-%m-%d %H:%M', time.localtime(date)) if date is not None else ''
+        line = f'@{chat_element["username"]}{sent} : {chat_element["message_text"]}\n'
+        line_tokens = count_tokens(line)
+        # A shorter message further down may still fit
+        if tokens_number + line_tokens <= RELATED_MAX_TOKENS:
+            chosen.append((seq, line))
+            tokens_number += line_tokens
+    if not chosen:
+        return None, 0
+
+    content = RELATED_HEADER + ''.join(line for _, line in sorted(chosen))
+    return {'role':'system', 'content': content}, count_tokens(content)
+
+def make_chatbot_history(dialog, related=()):
+    """Makes the chatbot messages from the dialog of the chat.
+    Args:
+        dialog (list): (kind, message data) of the questions and answers in chat order, see load_dialog_history.
+        related (list): (sequence number, message data) of the chat messages related to the question, see find_related_messages.
+    Returns:
+        list: The messages that fit into MAX_TOKENS.
+    """
     messages =  [{'role':'system', 'content':SYSTEM_MESSAGE}]
+    content_tokens = [count_tokens(SYSTEM_MESSAGE)]
 
-    chat_key_list = list(chat_history.keys())
-
-    for key in chat_key_list:
-        if chat_history[key]["username"] == BOT_USERNAME and re.match(f'^{ANSWEAR_FLAG}', chat_history[key]["message_text"]):
+    # Older messages would be cut off below anyway
+    for kind, chat_element in dialog[-MAX_CHAT_MEMORY_LEN:]:
+        if kind == MESSAGE_ANSWER:
             if messages[-1]['role'] == 'assistant':
                 messages.append({'role':'user', 'content': ' '})
-            messages.append({'role':'assistant', 'content': chat_history[key]["message_text"]})
-        elif chat_history[key]["username"] != BOT_USERNAME and re.match(f'@{BOT_USERNAME}|{ASK_START_FLAG}', chat_history[key]["message_text"]):
+                content_tokens.append(1)
+            messages.append({'role':'assistant', 'content': chat_element["message_text"]})
+            content_tokens.append(message_tokens(chat_element))
+        elif kind == MESSAGE_QUESTION:
             if messages[-1]['role'] == 'user':
                 messages.append({'role':'assistant', 'content': ' '})
-            messages.append({'role':'user', 'content': chat_history[key]["message_text"]})
+                content_tokens.append(1)
+            messages.append({'role':'user', 'content': chat_element["message_text"]})
+            content_tokens.append(message_tokens(chat_element))
     
     if len(messages) > MAX_CHAT_MEMORY_LEN:
         messages = messages[-MAX_CHAT_MEMORY_LEN:]
+        content_tokens = content_tokens[-MAX_CHAT_MEMORY_LEN:]
 
-    tokens_number = num_tokens_from_messages(messages, model=AI_MODEL_NAME)
-    print('Start tokens', tokens_number)
+    tokens_number = TOKENS_PER_REPLY + sum(content_tokens) + TOKENS_PER_CHAT_MESSAGE * len(messages)
+    related_message, related_tokens = make_related_message(related)
+    if related_message is not None:
+        tokens_number += related_tokens + TOKENS_PER_CHAT_MESSAGE
+
+    # Drop the oldest messages in one pass, subtracting their cached token counts
+    start = 0
+    while tokens_number > MAX_TOKENS and start < len(messages):
+        tokens_number -= content_tokens[start] + TOKENS_PER_CHAT_MESSAGE
+        start += 1
+    messages = messages[start:]
+
+    # The related messages go after the system message, ahead of the dialog
+    if related_message is not None:
+        messages.insert(1 if messages and messages[0]['role'] == 'system' else 0, related_message)
 
-    while tokens_number > MAX_TOKENS:
-        del messages[0]
-        tokens_number = num_tokens_from_messages(messages, model=AI_MODEL_NAME)
-    
-    print('End tokens', tokens_number)
-        
     return messages
 
-def get_completion(messages, model=AI_MODEL_NAME):
+@metrics.traced
+async def get_completion(messages, model=AI_MODEL_NAME, user_id=None, on_delta=None, priority=PRIORITY_INTERACTIVE):
+    """Returns the completion text, with on_delta it's streamed and on_delta gets the text so far.
+
+    Questions to the bot go ahead of the /sum_up chunks in the queue for the rate limits by priority.
+    """
     try:
-        print('try open')
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            temperature=0,
-            max_tokens = 500,
-            timeout=10
-        )
-        response = response.choices[0].message["content"]
-    except openai.error.APIError:
-        print('except open')
+        params = dict(temperature=0, max_tokens = 500)
+        if on_delta is None:
+            response = await completion_client.complete(messages, model=model, user_id=user_id, priority=priority, **params)
+        else:
+            response = await completion_client.stream(messages, model=model, on_delta=on_delta, user_id=user_id, priority=priority, **params)
+    except (openai.error.OpenAIError, asyncio.TimeoutError) as error:
+        logging.warning('Completion failed: %r', error)
         response = "Sorry, something went wrong. 😒\n I can't do it or answear your question. 😅"
 
     return response
 
+@metrics.traced
+async def answer_in_message(chat_id, progress_message, messages, user_id):
+    """Gets the completion and puts it into the progress message, edited while the answer streams.
+    Returns:
+        tuple: The completion and the id of the message that holds it.
+    """
+    if not STREAM_COMPLETIONS:
+        send_queue.edit(chat_id, progress_message.message_id, ". .")
+        completion = re.sub(f'^{ANSWEAR_FLAG}', '', await get_completion(messages, user_id=user_id))
+        send_queue.edit(chat_id, progress_message.message_id, ". . .")
+        answer_message = await send_queue.send(chat_id, completion, merge=False)
+        return completion, answer_message.message_id
+
+    last_edit_time, last_edit_length = time.monotonic(), 0
+
+    def on_delta(text):
+        nonlocal last_edit_time, last_edit_length
+        if ANSWEAR_FLAG.startswith(text):
+            return
+        text = re.sub(f'^{ANSWEAR_FLAG}', '', text)
+        if text.strip() and (time.monotonic() - last_edit_time >= STREAM_EDIT_INTERVAL or len(text) - last_edit_length >= STREAM_EDIT_CHARS):
+            send_queue.edit(chat_id, progress_message.message_id, text[:MAX_MESSAGE_LENGTH])
+            last_edit_time, last_edit_length = time.monotonic(), len(text)
+
+    completion = re.sub(f'^{ANSWEAR_FLAG}', '', await get_completion(messages, user_id=user_id, on_delta=on_delta))
+
+    parts = split_text(completion)
+    sent = [send_queue.edit(chat_id, progress_message.message_id, parts[0])]
+    sent += [send_queue.send_nowait(chat_id, part, merge=False) for part in parts[1:]]
+    await asyncio.gather(*sent, return_exceptions=True)
+    return completion, progress_message.message_id
+
+
+async def summarize_chat(lines, line_tokens, priority=PRIORITY_SUM_UP):
+    """Map-reduce summary of the chat lines that don't fit one prompt.
 
+    Up to SUM_UP_CONCURRENCY chunks are summarized at once in the global completion slots.
+    Returns:
+        tuple: The summary and the number of completion calls it took.
+    """
+    calls = 0
+
+    async def complete(prompt):
+        nonlocal calls
+        calls += 1
+        completion = await get_completion(prompt, priority=priority)
+        return re.sub(f'^{ANSWEAR_FLAG}', '', completion)
+
+    budget = MAX_TOKENS - count_tokens(make_prompt('')[0]['content']) - CHUNK_TOKENS_MARGIN
+    chunks = split_into_chunks(lines, line_tokens, budget)
+
+    summary = await summarize_chunks(chunks, complete, make_prompt, make_reduce_prompt, count_tokens, budget, SUM_UP_CONCURRENCY)
+    return summary, calls
+
+@metrics.traced
+async def sum_up_chat(chat_name, chat_history, number_of_messages, priority=PRIORITY_SUM_UP):
+    """Summarize the last messages of the chat reusing the cached summary of an older part of them.
+
+    The user that waits for the summary holds a slot of completion_client.user_slot() around the call.
+    """
+    chat_history = chat_history.tail(number_of_messages)
+    message_ids = list(chat_history.keys())
+    with metrics.span('format_chat_lines'):
+        lines, line_tokens = await executors.run_cpu(format_chat_lines, chat_history, number_of_messages)
+
+    first_id, covered = message_ids[0], len(message_ids)
+    entry, first, last = await executors.run_io(summary_cache.find, chat_name, message_ids)
+    if entry is None:
+        summary, calls = await summarize_chat(lines, line_tokens, priority)
+    else:
+        if entry['first_id'] != str(message_ids[0]) and first == 0:
+            # The cached summary starts a few messages earlier, the new one covers them too
+            first_id, covered = entry['first_id'], covered + entry['messages'] - (last + 1)
+        parts, calls = [], 0
+        if first > 0:
+            older_summary, older_calls = await summarize_chat(lines[:first], line_tokens[:first], priority)
+            parts.append(older_summary)
+            calls += older_calls
+        parts.append(entry['summary'])
+        if last < len(lines) - 1:
+            delta_summary, delta_calls = await summarize_chat(lines[last + 1:], line_tokens[last + 1:], priority)
+            parts.append(delta_summary)
+            calls += delta_calls
+
+        if len(parts) == 1:
+            summary = entry['summary']
+        else:
+            summary = re.sub(f'^{ANSWEAR_FLAG}', '', await get_completion(make_reduce_prompt(''.join(f'Part {number}:\n{part}\n' for number, part in enumerate(parts, 1))),
+                                                          priority=priority))
+            calls += 1
+
+        summary_cache.record_saving(entry['tokens'], entry['calls'] - (len(parts) > 1))
+        calls += entry['calls']
+
+    await executors.run_io(summary_cache.put, chat_name, first_id, message_ids[-1], summary, sum(line_tokens), calls, covered)
+    return summary
+
+def check_digest(chat_name, period, now):
+    """Returns the number of messages the chat got if its digest for the period is due, None if it isn't due or the chat didn't change."""
+    last = digest_store.last(chat_name, period)
+    if last is not None and now - last['until'] < period - DIGEST_CHECK_INTERVAL:
+        return None
+    appended = chat_history_cache.appended(chat_name)
+    if last is not None and last['appended'] == appended:
+        DIGESTS.inc(result='unchanged')
+        return None
+    return appended
+
+async def make_digest(chat_id, chat_name, period, push_users, appended, now):
+    """Summarizes the messages of the last period of the chat into a digest and sends it to push_users."""
+    chat_history = await load_chat_history(chat_name, chat_id)
+    number = chat_history.count_since(now - period) if chat_history else 0
+    digest = {'period': period, 'since': now - period, 'until': now, 'appended': appended, 'messages': number,
+              'first_id': None, 'last_id': None, 'summary': None}
+    if number:
+        message_ids = list(chat_history.tail(number).keys())
+        digest['first_id'], digest['last_id'] = message_ids[0], message_ids[-1]
+        digest['summary'] = await sum_up_chat(chat_name, chat_history, number, PRIORITY_DIGEST)
+    # A window without messages is stored too, so the chat is skipped until it changes
+    await executors.run_io(digest_store.put, chat_name, digest)
+    DIGESTS.inc(result='made' if number else 'empty')
+
+    if number:
+        period_name = next((name for name, seconds in DIGEST_PERIODS.items() if seconds == period), f'{period} s')
+        for user_id in push_users:
+            send_queue.send_nowait(user_id, f"Your {period_name} digest of '{chat_name}' 🗞\n\n{digest['summary']}")
+
+def remove_unsubscribed_digests(chat_id, chat_name):
+    """Deletes the stored digests of the chat when nobody is subscribed to them anymore, so /sum_up doesn't answer from them."""
+    if not registry.has_digests(chat_id):
+        digest_store.remove(chat_name)
+
+async def run_digests(context: ContextTypes.DEFAULT_TYPE):
+    """Makes the due digests of the subscribed chats, at most DIGEST_CONCURRENCY at once."""
+    now = time.time()
+    hour = time.localtime(now).tm_hour
+    semaphore = asyncio.Semaphore(DIGEST_CONCURRENCY)
+
+    async def run(chat_id, chat_name, period, push_users):
+        try:
+            appended = await executors.run_io(check_digest, chat_name, period, now)
+            if appended is None:
+                return
+            async with semaphore:
+                await make_digest(chat_id, chat_name, period, push_users, appended, now)
+        except Exception:
+            DIGESTS.inc(result='error')
+            logging.exception('Digest of "%s" failed', chat_name)
+
+    chats = await executors.run_io(registry.digest_chats)
+    await asyncio.gather(*(run(*chat) for chat in chats
+                           if hour in DIGEST_HOURS.get(chat[2], range(24)) and (shard is None or shard.owns(chat[0]))))
+
+
+@metrics.instrument_handler
 async def helping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Print help instructions for user."""
     username = update.effective_user.username
@@ -235,59 +669,56 @@ async def helping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message_id = update.message.message_id
     chat_id = update.effective_chat.id
 
-    save_message(username, user_id,  user_id, message_id, username, message_text='/help')
+    await save_message(username, user_id,  user_id, message_id, username, message_text='/help')
 
-    await context.bot.send_message(chat_id=chat_id, text="""This bot can sum up the dialog from any group that was registered.\n
+    send_queue.send_nowait(chat_id=chat_id, text="""This bot can sum up the dialog from any group that was registered.\n
                                    To register croup for bot just add this bot to the group with 'Admin' privileges or if bot
                                    already in group and added him someone else then send '/start' message in this group.\n
                                    Bot can sum up dialog from group only in the your private chat.\n
-                                   Bot has four commands in your personal chat:
+                                   Bot has five commands in your personal chat:
                                    /sum_up - to sum up dialog
+                                   /digest - to sum up group every hour or day ahead of time
                                    /remove_chat - to remove chat from your own list, to remove him from group you need to do it by hand
                                    /show_chats - to show list of registered for you groups.
                                    /help - to show helping instruction\n
                                    """)
     
-    save_message(username, chat_id,  user_id, message_id+1, BOT_USERNAME, message_text= f"""{ANSWEAR_FLAG}This bot can sum up the dialog from any group that was registered.\n
+    await save_message(username, chat_id,  user_id, message_id+1, BOT_USERNAME, message_text= f"""{ANSWEAR_FLAG}This bot can sum up the dialog from any group that was registered.\n
                                    To register croup for bot just add this bot to the group with 'Admin' privileges or if bot
                                    already in group and added him someone else then send '/start' message in this group.\n
                                    Bot can sum up dialog from group only in the your private chat.\n
-                                   Bot has four commands in your personal chat:
+                                   Bot has five commands in your personal chat:
                                    /sum_up - to sum up dialog
+                                   /digest - to sum up group every hour or day ahead of time
                                    /remove_chat - to remove chat from your own list, to remove him from group you need to do it by hand
                                    /show_chats - to show list of registered for you groups.
                                    /help - to show helping instruction\n
                                    """)
 
 
+@metrics.instrument_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Saves a user to a JSON file."""
+    """Registers a user or a group chat for the user."""
     match update.message.chat.type:
         case Chat.PRIVATE:
 
             username = update.effective_user.username
             user_id = update.effective_user.id
             message_id = update.message.message_id
-            file_name = make_access_file_name(username, user_id)
 
-            save_message(username, user_id,  user_id, message_id, username, message_text='/start')
-            user_access = load_json_file(file_name, PATH_CHAT_ACCESS)
+            await save_message(username, user_id,  user_id, message_id, username, message_text='/start')
+            is_new_user = await executors.run_io(registry.add_user, user_id, username)
 
             buttons = [[KeyboardButton('/sum_up')], [KeyboardButton('/show_chats')],[KeyboardButton('/remove_chat')],[KeyboardButton('/help')]]
             keyboard = ReplyKeyboardMarkup(buttons, resize_keyboard=True)
 
             
-            if user_access:
-                await context.bot.send_message(chat_id=update.effective_chat.id, text="Hi, I think we met before 😑\nHow can I help you ?", reply_markup=keyboard)
-                save_message(username, user_id,  user_id, message_id+1, BOT_USERNAME, message_text='Hi, I think we met before 😑\nHow can I help you ?')
+            if not is_new_user:
+                send_queue.send_nowait(chat_id=update.effective_chat.id, text="Hi, I think we met before 😑\nHow can I help you ?", reply_markup=keyboard)
+                await save_message(username, user_id,  user_id, message_id+1, BOT_USERNAME, message_text='Hi, I think we met before 😑\nHow can I help you ?')
 
             else:
-                user_info = {}
-
-                with open(os.path.join(PATH_CHAT_ACCESS, file_name +'.json'), "w+") as file:
-                    json.dump(user_info, file)
-
-                await context.bot.send_message(chat_id=update.effective_chat.id, text="""Hello, I'm your best friend to sum up everything :)
+                send_queue.send_nowait(chat_id=update.effective_chat.id, text="""Hello, I'm your best friend to sum up everything :)
                                                                                         and I was created by <Comp-pot> group
                                                                                         If you want to talk with me or ask me something just 
                                                                                         write me message.
@@ -298,7 +729,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                                                                         I'm in if someone else added me before.\n
                                                                                         Sooo, how can I help you ?""", reply_markup=keyboard)
                 
-                save_message(username, user_id,  user_id, message_id+1, BOT_USERNAME, message_text= f"""{ANSWEAR_FLAG}Hello, I'm your best friend to sum up everything :)
+                await save_message(username, user_id,  user_id, message_id+1, BOT_USERNAME, message_text= f"""{ANSWEAR_FLAG}Hello, I'm your best friend to sum up everything :)
                                                                                         and I was created by <Comp-pot> group
                                                                                         If you want to talk with me or ask me something just 
                                                                                         write me message.
@@ -316,28 +747,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             chat_name = update.message.chat.title
             chat_id = update.effective_chat.id
 
-            file_name = make_access_file_name(username, user_id)
-
-            access_info = {chat_name: chat_id}
-
-            user_access = load_json_file(file_name, PATH_CHAT_ACCESS)
-
-            if user_access != False:
-                if chat_name in user_access:
-                    await context.bot.send_message(chat_id, text="This chat is already registered for you 😁")
+            if await executors.run_io(registry.user_exists, user_id):
+                if not await executors.run_io(registry.register_chat, user_id, chat_id, chat_name):
+                    send_queue.send_nowait(chat_id, text="This chat is already registered for you 😁")
 
                 else:
-                    user_access.update(access_info)
-
-                    with open(os.path.join(PATH_CHAT_ACCESS, file_name +'.json'), "w+") as file:
-                        json.dump(user_access, file)
-
-                    await context.bot.send_message(chat_id, text="I register this chat, as you wish 😄")
-                    await context.bot.send_message(user_id, text=f"I register the chat '{chat_name}' for you 😌")
+                    send_queue.send_nowait(chat_id, text="I register this chat, as you wish 😄")
+                    send_queue.send_nowait(user_id, text=f"I register the chat '{chat_name}' for you 😌")
             else:
-                await context.bot.send_message(chat_id, text="Sorry I don't remember you 😅\nbut if you want we could get to know each other :) \nhttps://t.me/big_summarizer_bot\nand press /start")
+                send_queue.send_nowait(chat_id, text="Sorry I don't remember you 😅\nbut if you want we could get to know each other :) \nhttps://t.me/big_summarizer_bot\nand press /start")
 
 
+@metrics.instrument_handler
 async def add_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_message.api_kwargs['new_chat_member']['username'] == BOT_USERNAME:
 
@@ -350,27 +771,16 @@ async def add_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         message_text = f'@{from_username} added @{to_username} to group {chat_name}'
 
-        save_message(chat_name, chat_id, from_user_id, message_id, from_username, message_text)
-
-        file_name = make_access_file_name(from_username, from_user_id)
-
-        access_info = {chat_name: chat_id}
+        await save_message(chat_name, chat_id, from_user_id, message_id, from_username, message_text)
 
-        user_access = load_json_file(file_name, PATH_CHAT_ACCESS)
-
-        if user_access != False:
-            if chat_name in user_access:
-                await context.bot.send_message(chat_id, text="This chat is already registered for you 😁")
+        if await executors.run_io(registry.user_exists, from_user_id):
+            if not await executors.run_io(registry.register_chat, from_user_id, chat_id, chat_name):
+                send_queue.send_nowait(chat_id, text="This chat is already registered for you 😁")
 
             else:
-                user_access.update(access_info)
-
-                with open(os.path.join(PATH_CHAT_ACCESS, file_name +'.json'), "w+") as file:
-                    json.dump(user_access, file)
-
-                await context.bot.send_message(from_user_id, text=f"I register the chat '{chat_name}' for you 😌")
+                send_queue.send_nowait(from_user_id, text=f"I register the chat '{chat_name}' for you 😌")
         else:
-            await context.bot.send_message(chat_id, text="Sorry I don't remember you 😅\nbut if you want we could get to know each other :) \nhttps://t.me/big_summarizer_bot\nand press /start")
+            send_queue.send_nowait(chat_id, text="Sorry I don't remember you 😅\nbut if you want we could get to know each other :) \nhttps://t.me/big_summarizer_bot\nand press /start")
 
     else:
         chat_id = update.effective_chat.id
@@ -382,8 +792,9 @@ async def add_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         message_text = f'@{from_username} added @{to_username} to group {chat_name}'
 
-        save_message(chat_name, chat_id, from_user_id, message_id, from_username, message_text)
+        await save_message(chat_name, chat_id, from_user_id, message_id, from_username, message_text)
 
+@metrics.instrument_handler
 async def text_message_parser(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Saves a message to a JSON file."""
     if update.edited_message:
@@ -401,120 +812,170 @@ async def text_message_parser(update: Update, context: ContextTypes.DEFAULT_TYPE
 
                 if message_text == 'x':
 
-                    chat_history = load_json_file(chat_name)
+                    chat_history = await load_chat_history(chat_name)
                     previous_message = get_message_from_history(chat_history, -1)
                 
-                    save_message(chat_name, chat_id, user_id, message_id, username, message_text)
+                    await save_message(chat_name, chat_id, user_id, message_id, username, message_text)
 
-                    if previous_message['message_text'] in ['/sum_up', '/remove_chat']:
-                        await context.bot.send_message(chat_id, f"Good, your command {previous_message['message_text']} canceled 😌")
-                        save_message(chat_name, chat_id, user_id, message_id+1, BOT_USERNAME, f"Good, your command {previous_message['message_text']} canceled 😌")
+                    if previous_message['message_text'] in ['/sum_up', '/remove_chat', '/digest']:
+                        send_queue.send_nowait(chat_id, f"Good, your command {previous_message['message_text']} canceled 😌")
+                        await save_message(chat_name, chat_id, user_id, message_id+1, BOT_USERNAME, f"Good, your command {previous_message['message_text']} canceled 😌")
                     else:
-                        await context.bot.send_message(chat_id, "Sorry, you don't have command to cancel 😅")
-                        save_message(chat_name, chat_id, user_id, message_id+1, BOT_USERNAME, "Sorry, you don't have command to cancel 😅")
+                        send_queue.send_nowait(chat_id, "Sorry, you don't have command to cancel 😅")
+                        await save_message(chat_name, chat_id, user_id, message_id+1, BOT_USERNAME, "Sorry, you don't have command to cancel 😅")
                     
                 else:
 
-                    access_dict = load_json_file(make_access_file_name(username, user_id), path=PATH_CHAT_ACCESS)
-                    chat_history = load_json_file(chat_name)
+                    chat_history = await load_chat_history(chat_name)
                     last_message = get_message_from_history(chat_history, -1)
-                    access_list_upper = [key.upper() for key in list(access_dict.keys())]
 
                     match last_message['message_text']:
                         case '/sum_up':
-                            save_message(chat_name, chat_id, user_id, message_id, username, message_text)
+                            await save_message(chat_name, chat_id, user_id, message_id, username, message_text)
 
                             not_in_format = False
                             splited_message = message_text.split('\n')
                             parser_chat_name = splited_message[0]
                             
+                            sum_up_range = None
                             match len(splited_message):
                                 case 1:
-                                    parser_number = '100'
+                                    sum_up_range = SUM_UP_DEFAULT_MESSAGES, None
                                 case 2:
-                                    parser_number = splited_message[1]
+                                    sum_up_range = parse_sum_up_range(splited_message[1])
                                 case _:
                                     not_in_format = True
 
-                            if not(parser_chat_name.upper() in access_list_upper):
-                                await context.bot.send_message(chat_id, "Sorry you enter chat name that I don't see, try again using /sum_up command 😅")
+                            registered_chat = await executors.run_io(registry.find_user_chat, user_id, parser_chat_name)
+
+                            if registered_chat is None:
+                                send_queue.send_nowait(chat_id, "Sorry you enter chat name that I don't see, try again using /sum_up command 😅")
                             elif not_in_format:
-                                await context.bot.send_message(chat_id, "Sorry your instruction isn't in correct format, try again using /sum_up command 😅")
-                            elif not parser_number.isdigit():
-                                await context.bot.send_message(chat_id, "Sorry you write number in incorect format, try again using /sum_up command 😅")
+                                send_queue.send_nowait(chat_id, "Sorry your instruction isn't in correct format, try again using /sum_up command 😅")
+                            elif sum_up_range is None:
+                                send_queue.send_nowait(chat_id, "Sorry you write number or time in incorect format, try again using /sum_up command 😅")
                             else:
-                                await context.bot.send_message(chat_id, ".")
-
-                                parsing_history = load_json_file(list(access_dict.keys())[access_list_upper.index(parser_chat_name.upper())])
-                                history_text = format_chat_from_json2text(parsing_history, int(parser_number))
+                                parsing_chat_name = registered_chat[0]
+                                parser_number, since = sum_up_range
+                                ready_digest = None
+                                if since is None:
+                                    parsing_history = await load_chat_history(parsing_chat_name, registered_chat[1], parser_number)
+                                else:
+                                    ready_digest = await executors.run_io(digest_store.find, parsing_chat_name, since, time.time())
+                                    if ready_digest is not None and ready_digest['appended'] != await count_appended(parsing_chat_name, registered_chat[1]):
+                                        # The messages sent after the digest would be missing, sum_up_chat
+                                        # reuses the cached summary of the digest and adds them
+                                        ready_digest = None
+                                    if ready_digest is None:
+                                        # Only the segments of the time range are read, and its span is found
+                                        # by bisect in the date column of the history
+                                        parsing_history = await load_chat_history(parsing_chat_name, registered_chat[1], since=since)
+                                        parser_number = parsing_history.count_since(since) if parsing_history else 0
+
+                                if since is not None and ready_digest is None and parser_number == 0:
+                                    since_text = time.strftime('%Y-%m-%d %H:%M', time.localtime(since))
+                                    send_queue.send_nowait(chat_id, f"Sorry, there are no messages in this chat since {since_text} 😅")
+                                elif ready_digest is not None:
+                                    # The scheduled digest of this window is ready, no progress to show
+                                    completion = ready_digest['summary']
+                                    try:
+                                        answer_message = await send_queue.send(chat_id, completion, merge=False)
+                                    except telegram.error.BadRequest:
+                                        send_queue.send_nowait(chat_id, "Sory, something went wrong try again 😅")
+                                    else:
+                                        await save_message(chat_name, chat_id, user_id, answer_message.message_id, BOT_USERNAME, ANSWEAR_FLAG+completion)
+                                else:
+                                    progress_message = await send_queue.send(chat_id, ".", merge=False)
+
+                                    # The whole /sum_up counts once against the completion limit of the user,
+                                    # its chunks run in parallel in the global slots
+                                    async with completion_client.user_slot(user_id):
+                                        if SUM_UP_MAP_REDUCE:
+                                            send_queue.edit(chat_id, progress_message.message_id, ". .")
+
+                                            completion = await sum_up_chat(parsing_chat_name, parsing_history, parser_number)
+                                        else:
+                                            history_text = await executors.run_cpu(format_chat_from_json2text, parsing_history.tail(parser_number), parser_number)
+
+                                            send_queue.edit(chat_id, progress_message.message_id, ". .")
+
+                                            prompt = make_prompt(history_text)
+                                            completion = await get_completion(prompt, priority=PRIORITY_SUM_UP)
+                                    completion = re.sub(f'^{ANSWEAR_FLAG}', '', completion)
+
+                                    send_queue.edit(chat_id, progress_message.message_id, ". . .")
+
+                                    try:
+                                        answer_message = await send_queue.send(chat_id, completion, merge=False)
+                                    except telegram.error.BadRequest:
+                                        send_queue.send_nowait(chat_id, "Sory, something went wrong try again 😅")
+                                    else:
+                                        await save_message(chat_name, chat_id, user_id, answer_message.message_id, BOT_USERNAME, ANSWEAR_FLAG+completion)
+
+                        case '/digest':
+                            await save_message(chat_name, chat_id, user_id, message_id, username, message_text)
 
+                            splited_message = message_text.split('\n')
+                            options = splited_message[1].lower().split() if len(splited_message) == 2 else []
+                            period_name = options[0] if options else None
 
-                                await context.bot.edit_message_text(". .", chat_id, message_id+1)
-
-                                prompt = make_prompt(history_text)
-                                completion = get_completion(prompt)
-                                completion = re.sub(f'^{ANSWEAR_FLAG}', '', completion)
-
-                                save_message(chat_name, chat_id, user_id, message_id+2, BOT_USERNAME, ANSWEAR_FLAG+completion)
+                            if (period_name not in DIGEST_PERIODS and period_name != 'off') or options[1:] not in ([], ['push']):
+                                send_queue.send_nowait(chat_id, "Sorry your instruction isn't in correct format, try again using /digest command 😅")
+                            else:
+                                push = options[1:] == ['push']
+                                digest_chat = await executors.run_io(registry.set_digest, user_id, splited_message[0], DIGEST_PERIODS.get(period_name), push)
+                                if digest_chat is None:
+                                    send_queue.send_nowait(chat_id, "Sorry you enter chat name that I don't see, try again using /digest command 😅")
+                                elif period_name == 'off':
+                                    await executors.run_io(remove_unsubscribed_digests, digest_chat[1], digest_chat[0])
+                                    send_queue.send_nowait(chat_id, f"Good, digests of '{digest_chat[0]}' turned off 😌")
+                                else:
+                                    send_queue.send_nowait(chat_id, f"Good, I'll make {period_name} digests of '{digest_chat[0]}'" + (" and send them to you 😄" if push else " 😄"))
 
-                                await context.bot.edit_message_text(". . .", chat_id, message_id+1)
+                        case '/remove_chat':
+                            await save_message(chat_name, chat_id, user_id, message_id, username, message_text)
 
-                                try:
-                                    await context.bot.send_message(chat_id, completion)
-                                except telegram.error.BadRequest:
-                                    await context.bot.send_message(chat_id, "Sory, something went wrong try again 😅")
+                            removed_chat = await executors.run_io(registry.remove_user_chat, user_id, message_text)
 
-                        case '/remove_chat':
-                            save_message(chat_name, chat_id, user_id, message_id, username, message_text)
-
-                            if message_text.upper() in access_list_upper:
-                                file_name = make_access_file_name(username, user_id)
-                                del access_dict[list(access_dict.keys())[access_list_upper.index(message_text.upper())]]
-                                with open(os.path.join(PATH_CHAT_ACCESS, file_name +'.json'), "w+") as file:
-                                    json.dump(access_dict, file)
-                                await context.bot.send_message(chat_id, f"Good, chat '{message_text}' deleted from your list 😄")
+                            if removed_chat is not None:
+                                await executors.run_io(summary_cache.remove, removed_chat[0])
+                                await executors.run_io(remove_unsubscribed_digests, removed_chat[1], removed_chat[0])
+                                send_queue.send_nowait(chat_id, f"Good, chat '{message_text}' deleted from your list 😄")
                             else:
-                                await context.bot.send_message(chat_id, "Sorry you enter chat name that I don't see, try again using /remove_chat command 😅")
+                                send_queue.send_nowait(chat_id, "Sorry you enter chat name that I don't see, try again using /remove_chat command 😅")
                         case _:
-                            await context.bot.send_message(chat_id, ".")
+                            progress_message = await send_queue.send(chat_id, ".", merge=False)
 
-                            save_message(chat_name, chat_id, user_id, message_id, username, ASK_START_FLAG+message_text)
-                            chat_history = load_json_file(chat_name)
+                            await save_message(chat_name, chat_id, user_id, message_id, username, ASK_START_FLAG+message_text)
+                            dialog = await load_dialog_history(chat_name)
 
                             message_text = re.sub(f'^{ASK_START_FLAG}', '', message_text)
-                            
-                            await context.bot.edit_message_text(". .", chat_id, message_id+1)
 
-                            chatbot_messages = make_chatbot_history(chat_history)
-                            completion = get_completion(chatbot_messages)
-                            completion = re.sub(f'^{ANSWEAR_FLAG}', '', completion)
+                            with metrics.span('make_chatbot_history'):
+                                chatbot_messages = make_chatbot_history(dialog)
+                            completion, answer_id = await answer_in_message(chat_id, progress_message, chatbot_messages, user_id)
 
-                            save_message(chat_name, chat_id, user_id, message_id+2, BOT_USERNAME, ANSWEAR_FLAG+completion)
-
-                            await context.bot.edit_message_text(". . .", chat_id, message_id+1)
-                            await context.bot.send_message(chat_id, completion)
+                            await save_message(chat_name, chat_id, user_id, answer_id, BOT_USERNAME, ANSWEAR_FLAG+completion)
                                     
             case Chat.GROUP | Chat.SUPERGROUP:
                 chat_name = update.message.chat.title
-                save_message(chat_name, chat_id, user_id, message_id, username, message_text)
+                await save_message(chat_name, chat_id, user_id, message_id, username, message_text, update.message.date)
 
                 if re.match(f'@{BOT_USERNAME}', message_text):
-                    await context.bot.send_message(chat_id, ".")
+                    progress_message = await send_queue.send(chat_id, ".", merge=False)
 
-                    chat_history = load_json_file(chat_name)
+                    dialog = await load_dialog_history(chat_name)
+                    with metrics.span('find_related_messages'):
+                        related = await find_related_messages(chat_name, message_text)
 
-                    await context.bot.edit_message_text(". .", chat_id, message_id+1)
-                    
-                    chatbot_messages = make_chatbot_history(chat_history)
-                    completion = get_completion(chatbot_messages)
-                    completion = re.sub(f'^{ANSWEAR_FLAG}', '', completion)
+                    with metrics.span('make_chatbot_history'):
+                        chatbot_messages = make_chatbot_history(dialog, related)
+                    completion, answer_id = await answer_in_message(chat_id, progress_message, chatbot_messages, user_id)
 
-                    save_message(chat_name, chat_id, user_id, message_id+2, BOT_USERNAME, ANSWEAR_FLAG+completion)
-                    await context.bot.edit_message_text(". . .", chat_id, message_id+1)
-
-                    await context.bot.send_message(chat_id, completion)
+                    await save_message(chat_name, chat_id, user_id, answer_id, BOT_USERNAME, ANSWEAR_FLAG+completion)
 
 
+@metrics.instrument_handler
 async def show_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     match update.message.chat.type:
         case Chat.PRIVATE:
@@ -524,19 +985,18 @@ async def show_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
             message_id = update.message.message_id
 
             message_text = '/show_chats'
-            save_message(username, chat_id, user_id, message_id, username, message_text)
+            await save_message(username, chat_id, user_id, message_id, username, message_text)
 
-            file_name = make_access_file_name(username, user_id)
-            user_access = load_json_file(file_name, PATH_CHAT_ACCESS)
+            user_access = await executors.run_io(registry.get_user_chats, user_id)
 
-            if user_access == False:
-                await context.bot.send_message(chat_id, "Sorry I don't remember you 😅\nbut if you want we could get to know each other :) \nhttps://t.me/big_summarizer_bot\nand press /start")
+            if user_access is None:
+                send_queue.send_nowait(chat_id, "Sorry I don't remember you 😅\nbut if you want we could get to know each other :) \nhttps://t.me/big_summarizer_bot\nand press /start")
             
             else:
                 keys = user_access.keys()
-                await context.bot.send_message(chat_id, "Chat that you registered:\n")
+                send_queue.send_nowait(chat_id, "Chat that you registered:\n")
                 for key in keys:
-                    await context.bot.send_message(chat_id, f"{key}\n")
+                    send_queue.send_nowait(chat_id, f"{key}\n")
 
         case Chat.GROUP | Chat.SUPERGROUP:
             chat_name = update.message.chat.title
@@ -546,11 +1006,12 @@ async def show_chats(update: Update, context: ContextTypes.DEFAULT_TYPE):
             username = update.effective_user.username
             
             message_text = '/show_chats'
-            save_message(chat_name, chat_id, user_id, message_id, username, message_text)
+            await save_message(chat_name, chat_id, user_id, message_id, username, message_text)
 
-            await context.bot.send_message(chat_id, "Sory, I can't show your saved chats in group 😅")
+            send_queue.send_nowait(chat_id, "Sory, I can't show your saved chats in group 😅")
 
 
+@metrics.instrument_handler
 async def remove_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     match update.message.chat.type:
         case Chat.PRIVATE:
@@ -560,20 +1021,19 @@ async def remove_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
             message_id = update.message.message_id
 
             message_text = '/remove_chat'
-            save_message(username, chat_id, user_id, message_id, username, message_text)
+            await save_message(username, chat_id, user_id, message_id, username, message_text)
 
-            file_name = make_access_file_name(username, user_id)
-            user_access = load_json_file(file_name, PATH_CHAT_ACCESS)
+            user_access = await executors.run_io(registry.get_user_chats, user_id)
 
-            if user_access == False:
-                await context.bot.send_message(chat_id, "Sorry I don't remember you 😅\nbut if you want we could get to know each other :) \nhttps://t.me/big_summarizer_bot\nand press /start")
+            if user_access is None:
+                send_queue.send_nowait(chat_id, "Sorry I don't remember you 😅\nbut if you want we could get to know each other :) \nhttps://t.me/big_summarizer_bot\nand press /start")
             
             else:
                 keys = user_access.keys()
-                await context.bot.send_message(chat_id, "Chat that you registered:\n")
+                send_queue.send_nowait(chat_id, "Chat that you registered:\n")
                 for key in keys:
-                    await context.bot.send_message(chat_id, f"{key}\n")
-                await context.bot.send_message(chat_id, "\n\nPlease send me the name of chat that you wanna remove:\n")
+                    send_queue.send_nowait(chat_id, f"{key}\n")
+                send_queue.send_nowait(chat_id, "\n\nPlease send me the name of chat that you wanna remove:\n")
 
         case Chat.GROUP | Chat.SUPERGROUP:
             chat_name = update.message.chat.title
@@ -583,11 +1043,12 @@ async def remove_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
             message_id = update.message.message_id
 
             message_text = '/remove_chat'
-            save_message(chat_name, chat_id, user_id, message_id, username, message_text)
+            await save_message(chat_name, chat_id, user_id, message_id, username, message_text)
 
-            await context.bot.send_message(chat_id, "Sory, I can't remove chat from group 😅")
+            send_queue.send_nowait(chat_id, "Sory, I can't remove chat from group 😅")
 
 
+@metrics.instrument_handler
 async def sum_up(update: Update, context: ContextTypes.DEFAULT_TYPE):
     match update.message.chat.type:
         case Chat.PRIVATE:
@@ -597,20 +1058,19 @@ async def sum_up(update: Update, context: ContextTypes.DEFAULT_TYPE):
             message_id = update.message.message_id
 
             message_text = '/sum_up'
-            save_message(username, chat_id, user_id, message_id, username, message_text)
+            await save_message(username, chat_id, user_id, message_id, username, message_text)
 
-            file_name = make_access_file_name(username, user_id)
-            user_access = load_json_file(file_name, PATH_CHAT_ACCESS)
+            user_access = await executors.run_io(registry.get_user_chats, user_id)
 
-            if user_access == False:
-                await context.bot.send_message(chat_id, "Sorry I don't remember you 😅\nbut if you want we could get to know each other :) \nhttps://t.me/big_summarizer_bot\nand press /start")
+            if user_access is None:
+                send_queue.send_nowait(chat_id, "Sorry I don't remember you 😅\nbut if you want we could get to know each other :) \nhttps://t.me/big_summarizer_bot\nand press /start")
             
             else:
                 keys = user_access.keys()
-                await context.bot.send_message(chat_id, "Chat that you registered:\n")
+                send_queue.send_nowait(chat_id, "Chat that you registered:\n")
                 for key in keys:
-                    await context.bot.send_message(chat_id, f"{key}\n")
-                await context.bot.send_message(chat_id, "\nTell me the name of chat from list and how many last messages you want to sum up\n(optionaly, from 1 to 1000, default=100)\nin format:\n\ntest_bot\n100")
+                    send_queue.send_nowait(chat_id, f"{key}\n")
+                send_queue.send_nowait(chat_id, "\nTell me the name of chat from list and how many last messages you want to sum up\n(optionaly, from 1 to 10000, default=100)\nor since when: 3h, 1d12h, 18:00, yesterday 18:00, 2024-05-01 18:00\nin format:\n\ntest_bot\n100")
 
         case Chat.GROUP | Chat.SUPERGROUP:
             chat_name = update.message.chat.title
@@ -620,26 +1080,70 @@ async def sum_up(update: Update, context: ContextTypes.DEFAULT_TYPE):
             username = update.effective_user.username
             
             message_text = '/sum_up'
-            save_message(chat_name, chat_id, user_id, message_id, username, message_text)
+            await save_message(chat_name, chat_id, user_id, message_id, username, message_text)
 
-            await context.bot.send_message(chat_id, "Sory, I can't do it in group 😅")
+            send_queue.send_nowait(chat_id, "Sory, I can't do it in group 😅")
 
 
-if __name__ == '__main__':
-    # Check if the needed paths exist.
-    check_if_needed_path_exist()
+@metrics.instrument_handler
+async def digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    match update.message.chat.type:
+        case Chat.PRIVATE:
+            username = update.effective_user.username
+            user_id = update.effective_user.id
+            chat_id = update.effective_chat.id
+            message_id = update.message.message_id
 
-    keys_dict = load_json_file('keys', PATH_KEYS_ACCESS)
-    token_encoder = tiktoken.encoding_for_model(AI_MODEL_NAME)
+            message_text = '/digest'
+            await save_message(username, chat_id, user_id, message_id, username, message_text)
+
+            user_access = await executors.run_io(registry.get_user_chats, user_id)
+
+            if user_access is None:
+                send_queue.send_nowait(chat_id, "Sorry I don't remember you 😅\nbut if you want we could get to know each other :) \nhttps://t.me/big_summarizer_bot\nand press /start")
+
+            else:
+                keys = user_access.keys()
+                send_queue.send_nowait(chat_id, "Chat that you registered:\n")
+                for key in keys:
+                    send_queue.send_nowait(chat_id, f"{key}\n")
+                send_queue.send_nowait(chat_id, "\nTell me the name of chat from list and how often to sum it up ahead of time\n(hourly, daily or off, add push to get every digest)\nin format:\n\ntest_bot\ndaily push")
+
+        case Chat.GROUP | Chat.SUPERGROUP:
+            chat_name = update.message.chat.title
+            chat_id = update.effective_chat.id
+            user_id = update.effective_user.id
+            message_id = update.message.message_id
+            username = update.effective_user.username
+
+            message_text = '/digest'
+            await save_message(chat_name, chat_id, user_id, message_id, username, message_text)
+
+            send_queue.send_nowait(chat_id, "Sory, I can't do it in group 😅")
+
+
+def build_application(token, jobs=True):
+    """Build the bot application with all handlers, the history flush job and the digest job.
+
+    The router process of the multi-worker mode passes jobs=False, the shard workers own the chats and run the jobs.
+    """
+    application = (ApplicationBuilder().token(token)
+                   .concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES))
+                   .post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown).build())
+
+    if jobs:
+        if application.job_queue is None:
+            # Without the jobs pending messages wait for the flush threshold and digests are never made
+            raise RuntimeError('The history flush and digest jobs need the JobQueue, install python-telegram-bot[job-queue]')
+        application.job_queue.run_repeating(flush_chat_history, interval=HISTORY_FLUSH_INTERVAL)
+        application.job_queue.run_repeating(run_digests, interval=DIGEST_CHECK_INTERVAL, first=DIGEST_CHECK_INTERVAL)
 
-    openai.api_key = keys_dict['openai']
-    application = ApplicationBuilder().token(keys_dict['telegram']).build()
-    
     start_handler = CommandHandler('start', start)
     help_handler = CommandHandler('help', helping)
     sum_up_handler = CommandHandler('sum_up', sum_up)
     show_chats_handler = CommandHandler('show_chats', show_chats)
     remove_chat_handler = CommandHandler('remove_chat', remove_chat)
+    digest_handler = CommandHandler('digest', digest)
     new_user_handler = MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, add_new_member)
     message_handler = MessageHandler(filters.TEXT, text_message_parser)
 
@@ -648,7 +1152,87 @@ if __name__ == '__main__':
     application.add_handler(show_chats_handler)
     application.add_handler(remove_chat_handler)
     application.add_handler(sum_up_handler)
+    application.add_handler(digest_handler)
     application.add_handler(new_user_handler)
     application.add_handler(message_handler)
-    
-    application.run_polling()
\ No newline at end of file
+    return application
+
+
+class ShardHandler:
+    """Runs the bot application in a shard worker process, see sharding.worker_main."""
+
+    def __init__(self, worker_shard):
+        global shard, send_queue
+        shard = worker_shard
+        # The workers send with one bot token, so they share the global limit of Telegram
+        send_queue = SendQueue(global_rate=GLOBAL_RATE / len(worker_shard.inboxes))
+        self.application = None
+
+    async def start(self):
+        keys_dict = load_json_file('keys', PATH_KEYS_ACCESS)
+        openai.api_key = keys_dict['openai']
+        self.application = build_application(keys_dict['telegram'])
+        await self.application.initialize()
+        await on_startup(self.application)
+        await self.application.start()
+
+    async def process_update(self, data):
+        await self.application.process_update(Update.de_json(data, self.application.bot))
+
+    async def flush(self, chat_name):
+        await executors.run_io(chat_history_cache.flush, chat_name)
+
+    async def stop(self):
+        await self.application.stop()
+        await on_stop(self.application)
+        await self.application.shutdown()
+        await on_shutdown(self.application)
+        return chat_history_cache.stats()
+
+
+if __name__ == '__main__':
+    # Check if the needed paths exist.
+    check_if_needed_path_exist()
+    chat_log.migrate_json_histories()
+    chat_log.compress_cold_segments()
+    registry.migrate_json_access(PATH_CHAT_ACCESS)
+    # The shard workers are forked below, they must not share this SQLite connection
+    registry.close()
+
+    keys_dict = load_json_file('keys', PATH_KEYS_ACCESS)
+
+    openai.api_key = keys_dict['openai']
+
+    if SHARD_WORKERS > 1:
+        # Updates come by webhook to this process and go to the shard workers by chat id
+        router = ShardRouter(SHARD_WORKERS, ShardHandler).start()
+        webhook_server = WebhookServer(
+            router.process_update,
+            host=WEBHOOK_HOST,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            secret_token=keys_dict.get('webhook_secret'),
+            queue_size=WEBHOOK_QUEUE_SIZE,
+            workers=1,
+        )
+        try:
+            # The router owns no chats, it would make every digest a second time from stale histories
+            asyncio.run(run_webhook(build_application(keys_dict['telegram'], jobs=False), webhook_server, keys_dict.get('webhook_url')))
+        finally:
+            print('Shards', router.stop())
+    else:
+        application = build_application(keys_dict['telegram'])
+
+        if RUN_MODE == 'webhook':
+            webhook_server = WebhookServer(
+                lambda data: application.process_update(Update.de_json(data, application.bot)),
+                host=WEBHOOK_HOST,
+                port=WEBHOOK_PORT,
+                path=WEBHOOK_PATH,
+                secret_token=keys_dict.get('webhook_secret'),
+                queue_size=WEBHOOK_QUEUE_SIZE,
+                workers=WEBHOOK_WORKERS,
+            )
+            asyncio.run(run_webhook(application, webhook_server, keys_dict.get('webhook_url')))
+        else:
+            application.run_polling()
@@ -0,0 +1,245 @@
+"""In-process metrics in the Prometheus text format and optional per-update traces.
+
+Modules declare their metrics at import time:
+    SEND_CALLS = metrics.counter('telegram_api_calls_total', 'Telegram Bot API calls.', ['method'])
+    SEND_CALLS.inc(method='send_message')
+
+and start_metrics_server() serves all of them on GET /metrics.
+"""
+import bisect
+import contextlib
+import contextvars
+import functools
+import logging
+import threading
+import time
+
+from aiohttp import web
+
+
+METRICS_HOST = '0.0.0.0'
+METRICS_PORT = 9090
+# Seconds, from fast in-memory calls up to slow OpenAI completions
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+logger = logging.getLogger(__name__)
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_tracing = False
+
+
+def _format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.label_names)
+
+    def samples(self):
+        """Return (suffix, label values, extra labels, value) tuples of the metric."""
+        with self._lock:
+            return [('', key, (), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for suffix, key, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.label_names, key, extra)} {value}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """Gauge that is set directly or read from a function at scrape time."""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, label_names=(), function=None):
+        super().__init__(name, documentation, label_names)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self.function is not None:
+            return [('', (), (), self.function())]
+        return super().samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [per-bucket counts with +Inf last, sum]
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    samples.append(('_bucket', key, (('le', '+Inf' if bound == float('inf') else bound),), cumulative))
+                samples.append(('_sum', key, (), total))
+                samples.append(('_count', key, (), cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add the metric, a metric with the same name is replaced."""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+counter = lambda name, documentation, label_names=(): REGISTRY.register(Counter(name, documentation, label_names))
+gauge = lambda name, documentation, function=None: REGISTRY.register(Gauge(name, documentation, function=function))
+histogram = lambda name, documentation, label_names=(), buckets=DEFAULT_BUCKETS: REGISTRY.register(Histogram(name, documentation, label_names, buckets))
+
+HANDLER_SECONDS = histogram('bot_handler_seconds', 'Time to process an update by handler.', ['handler'])
+HANDLER_ERRORS = counter('bot_handler_errors_total', 'Updates whose handler raised an exception.', ['handler'])
+SPAN_SECONDS = histogram('bot_span_seconds', 'Time spent in the traced steps of update processing.', ['span'])
+
+
+class Trace:
+    """Time spent in every named step of processing one update."""
+
+    def __init__(self, name, update_id=None):
+        self.name = name
+        self.update_id = update_id
+        self.start = time.perf_counter()
+        # span name -> [calls, seconds]
+        self.spans = {}
+
+    def add(self, name, seconds):
+        entry = self.spans.setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+    def format(self):
+        total = time.perf_counter() - self.start
+        spans = ', '.join(f'{name} {seconds * 1000:.1f} ms' + (f' x{calls}' if calls > 1 else '')
+                          for name, (calls, seconds) in self.spans.items())
+        return f'update {self.update_id} {self.name} {total * 1000:.1f} ms: {spans}'
+
+
+def enable_tracing(enabled=True):
+    """Log the trace of every update processed by an instrumented handler."""
+    global _tracing
+    _tracing = enabled
+
+@contextlib.contextmanager
+def span(name):
+    """Time the block into bot_span_seconds and into the trace of the current update."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        SPAN_SECONDS.observe(elapsed, span=name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, elapsed)
+
+def traced(function):
+    """Decorator that runs the coroutine function in a span named after it."""
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        with span(function.__name__):
+            return await function(*args, **kwargs)
+    return wrapper
+
+def instrument_handler(handler):
+    """Decorator of update handlers that records latency, errors and the optional trace."""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        trace = Trace(name, getattr(update, 'update_id', None)) if _tracing else None
+        token = _current_trace.set(trace)
+        start = time.perf_counter()
+        try:
+            return await handler(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, handler=name)
+            _current_trace.reset(token)
+            if trace is not None:
+                logger.info('Trace %s', trace.format())
+    return wrapper
+
+
+async def handle_metrics(request):
+    return web.Response(body=REGISTRY.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serve GET /metrics, returns the aiohttp runner to clean up on shutdown."""
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,212 @@
+import json
+import os
+import sqlite3
+import threading
+
+
+MIGRATED_EXT = '.migrated'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT
+);
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    title_upper TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS registrations (
+    user_id INTEGER NOT NULL REFERENCES users(user_id),
+    chat_id INTEGER NOT NULL REFERENCES chats(chat_id),
+    PRIMARY KEY (user_id, chat_id)
+);
+CREATE TABLE IF NOT EXISTS digests (
+    user_id INTEGER NOT NULL REFERENCES users(user_id),
+    chat_id INTEGER NOT NULL REFERENCES chats(chat_id),
+    period INTEGER NOT NULL,
+    push INTEGER NOT NULL,
+    PRIMARY KEY (user_id, chat_id)
+);
+CREATE INDEX IF NOT EXISTS chats_title_upper ON chats(title_upper);
+CREATE INDEX IF NOT EXISTS registrations_chat_id ON registrations(chat_id);
+"""
+
+
+class Registry:
+    """SQLite store of users, chats and the chats every user registered to sum up.
+
+    Chat titles are matched case-insensitively through an indexed upper-case copy.
+    Every method runs in its own transaction and may be called from I/O threads.
+    A forked child process, like a shard worker, opens a connection of its own.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._db = None
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._forget_connection)
+
+    def _forget_connection(self):
+        # SQLite connections must not be used across fork(), and closing the copy could touch the parent's
+        # database state, so it's only dropped. The lock may have been held by a thread that the child doesn't have
+        self._db = None
+        self._lock = threading.Lock()
+
+    @property
+    def _connection(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def _execute(self, query, parameters=()):
+        with self._lock, self._connection:
+            return self._connection.execute(query, parameters).fetchall()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def add_user(self, user_id, username):
+        """Add the user or update the username.
+        Returns:
+            bool: True if the user is new.
+        """
+        with self._lock, self._connection:
+            is_new = self._connection.execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,)).fetchone() is None
+            self._connection.execute('INSERT INTO users (user_id, username) VALUES (?, ?) '
+                                     'ON CONFLICT(user_id) DO UPDATE SET username = excluded.username', (user_id, username))
+        return is_new
+
+    def user_exists(self, user_id):
+        return bool(self._execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,)))
+
+    def register_chat(self, user_id, chat_id, title):
+        """Register the chat for the user, the user must exist.
+        Returns:
+            bool: True if the chat wasn't registered for the user before.
+        """
+        with self._lock, self._connection:
+            self._connection.execute('INSERT INTO chats (chat_id, title, title_upper) VALUES (?, ?, ?) '
+                                     'ON CONFLICT(chat_id) DO UPDATE SET title = excluded.title, title_upper = excluded.title_upper',
+                                     (chat_id, title, title.upper()))
+            cursor = self._connection.execute('INSERT OR IGNORE INTO registrations (user_id, chat_id) VALUES (?, ?)', (user_id, chat_id))
+        return cursor.rowcount > 0
+
+    def get_user_chats(self, user_id):
+        """Return the chats of the user as title -> chat_id in registration order, or None for unknown user."""
+        if not self.user_exists(user_id):
+            return None
+        rows = self._execute('SELECT chats.title, chats.chat_id FROM registrations '
+                             'JOIN chats ON chats.chat_id = registrations.chat_id '
+                             'WHERE registrations.user_id = ? ORDER BY registrations.rowid', (user_id,))
+        return dict(rows)
+
+    def find_user_chat(self, user_id, title):
+        """Find the chat registered for the user by case-insensitive title.
+        Returns:
+            tuple: (title, chat_id) or None.
+        """
+        rows = self._execute('SELECT chats.title, chats.chat_id FROM chats '
+                             'JOIN registrations ON registrations.chat_id = chats.chat_id '
+                             'WHERE chats.title_upper = ? AND registrations.user_id = ? LIMIT 1', (title.upper(), user_id))
+        return rows[0] if rows else None
+
+    def remove_user_chat(self, user_id, title):
+        """Remove the chat from the list of the user.
+        Returns:
+            tuple: The removed (title, chat_id) or None.
+        """
+        with self._lock, self._connection:
+            row = self._connection.execute('SELECT chats.title, chats.chat_id FROM chats '
+                                           'JOIN registrations ON registrations.chat_id = chats.chat_id '
+                                           'WHERE chats.title_upper = ? AND registrations.user_id = ? LIMIT 1',
+                                           (title.upper(), user_id)).fetchone()
+            if row:
+                self._connection.execute('DELETE FROM registrations WHERE user_id = ? AND chat_id = ?', (user_id, row[1]))
+                self._connection.execute('DELETE FROM digests WHERE user_id = ? AND chat_id = ?', (user_id, row[1]))
+        return row
+
+    def set_digest(self, user_id, title, period, push):
+        """Subscribe the user to digests of a registered chat, period None unsubscribes.
+        Args:
+            period (int): Seconds between the digests.
+            push (bool): Send every digest to the user.
+        Returns:
+            tuple: (title, chat_id) or None if the user has no such chat.
+        """
+        with self._lock, self._connection:
+            row = self._connection.execute('SELECT chats.title, chats.chat_id FROM chats '
+                                           'JOIN registrations ON registrations.chat_id = chats.chat_id '
+                                           'WHERE chats.title_upper = ? AND registrations.user_id = ? LIMIT 1',
+                                           (title.upper(), user_id)).fetchone()
+            if row and period is None:
+                self._connection.execute('DELETE FROM digests WHERE user_id = ? AND chat_id = ?', (user_id, row[1]))
+            elif row:
+                self._connection.execute('INSERT INTO digests (user_id, chat_id, period, push) VALUES (?, ?, ?, ?) '
+                                         'ON CONFLICT(user_id, chat_id) DO UPDATE SET period = excluded.period, push = excluded.push',
+                                         (user_id, row[1], period, int(push)))
+        return row
+
+    def has_digests(self, chat_id):
+        """Return True if any user is subscribed to digests of the chat."""
+        return bool(self._execute('SELECT 1 FROM digests WHERE chat_id = ? LIMIT 1', (chat_id,)))
+
+    def digest_chats(self):
+        """Return (chat_id, title, period, ids of users to push to) for every chat and digest period with subscribers."""
+        chats = {}
+        for chat_id, title, period, user_id, push in self._execute(
+                'SELECT chats.chat_id, chats.title, digests.period, digests.user_id, digests.push FROM digests '
+                'JOIN chats ON chats.chat_id = digests.chat_id ORDER BY digests.rowid'):
+            chat = chats.setdefault((chat_id, period), (chat_id, title, period, []))
+            if push:
+                chat[3].append(user_id)
+        return list(chats.values())
+
+    def chat_users(self, chat_id):
+        """Return the ids of users that have access to the chat."""
+        return [user_id for user_id, in self._execute('SELECT user_id FROM registrations WHERE chat_id = ?', (chat_id,))]
+
+    def migrate_json_access(self, path):
+        """Import legacy '<username>_<user_id>.json' access files of chat title -> chat_id.
+
+        Every imported file is renamed to '<name>.json.migrated'.
+        Returns:
+            int: The number of imported users.
+        """
+        if not os.path.isdir(path):
+            return 0
+
+        files, users, chats, registrations = [], [], [], []
+        for file_name in sorted(os.listdir(path)):
+            file = os.path.join(path, file_name)
+            if not (file_name.endswith('.json') and os.path.isfile(file)):
+                continue
+
+            username, _, user_id = file_name[:-len('.json')].rpartition('_')
+            with open(file, 'r') as f:
+                user_access = json.load(f)
+
+            files.append(file)
+            users.append((int(user_id), username))
+            for title, chat_id in user_access.items():
+                chats.append((chat_id, title, title.upper()))
+                registrations.append((int(user_id), chat_id))
+
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)', users)
+            self._connection.executemany('INSERT OR IGNORE INTO chats (chat_id, title, title_upper) VALUES (?, ?, ?)', chats)
+            self._connection.executemany('INSERT OR IGNORE INTO registrations (user_id, chat_id) VALUES (?, ?)', registrations)
+
+        for file in files:
+            os.rename(file, file + MIGRATED_EXT)
+
+        if files:
+            print(f'{len(files)} chat access files migrated to "{self.db_path}"')
+        return len(files)
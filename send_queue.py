@@ -0,0 +1,231 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from telegram.error import BadRequest, RetryAfter
+
+import metrics
+
+
+MAX_MESSAGE_LENGTH = 4096
+GLOBAL_RATE = 30
+PRIVATE_CHAT_RATE = 1
+GROUP_CHAT_RATE = 20 / 60
+CHAT_BURST = 3
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_CALLS = metrics.counter('telegram_api_calls_total', 'Telegram Bot API calls by method.', ['method'])
+TELEGRAM_RETRIES = metrics.counter('telegram_retry_after_total', 'Telegram Bot API calls answered with RetryAfter.')
+TELEGRAM_ERRORS = metrics.counter('telegram_errors_total', 'Outgoing messages that failed by error type.', ['error'])
+
+
+class TokenBucket:
+    """Token bucket rate limiter: `rate` tokens per second up to `capacity` tokens."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def pause(self, seconds):
+        """Take all tokens away for `seconds`, e.g. after a RetryAfter error."""
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    async def acquire(self, amount=1):
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+
+def split_text(text, max_length=MAX_MESSAGE_LENGTH):
+    """Split the text into parts of at most max_length characters, at line breaks where possible."""
+    parts = []
+    while len(text) > max_length:
+        cut = text.rfind('\n', 0, max_length)
+        if cut <= 0:
+            cut = max_length
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    if text or not parts:
+        parts.append(text)
+    return parts
+
+
+class OutgoingMessage:
+    __slots__ = ('kind', 'chat_id', 'message_id', 'text', 'kwargs', 'mergeable', 'futures')
+
+    def __init__(self, kind, chat_id, text, message_id=None, kwargs=None, mergeable=False):
+        self.kind = kind
+        self.mergeable = mergeable and not kwargs
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.kwargs = kwargs or {}
+        self.futures = [asyncio.get_running_loop().create_future()]
+
+
+class SendQueue:
+    """Outbound scheduler of Telegram messages with coalescing and flood control.
+
+    Every chat has its own queue drained by one task. Consecutive plain messages to the
+    same chat are merged into one message and split again at MAX_MESSAGE_LENGTH. A newer
+    edit of a message replaces a pending older one. Sends wait for a per-chat and a
+    global token bucket and wait out RetryAfter errors.
+    """
+
+    def __init__(self, bot=None, global_rate=GLOBAL_RATE, private_chat_rate=PRIVATE_CHAT_RATE,
+                 group_chat_rate=GROUP_CHAT_RATE, chat_burst=CHAT_BURST, max_length=MAX_MESSAGE_LENGTH):
+        self.bot = bot
+        self.private_chat_rate = private_chat_rate
+        self.group_chat_rate = group_chat_rate
+        self.chat_burst = chat_burst
+        self.max_length = max_length
+        self._global_bucket = None
+        self._global_rate = global_rate
+
+        self._chat_buckets = {}
+        self._queues = {}
+        self._tasks = {}
+
+        self.api_calls = 0
+        self.merged = 0
+        self.superseded = 0
+        self.retries = 0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Negative ids are groups and channels, they have a lower limit
+            rate = self.group_chat_rate if int(chat_id) < 0 else self.private_chat_rate
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def _enqueue(self, item):
+        queue = self._queues.setdefault(item.chat_id, deque())
+
+        if item.kind == 'edit':
+            for pending in queue:
+                if pending.kind == 'edit' and pending.message_id == item.message_id:
+                    pending.text = item.text
+                    pending.futures.extend(item.futures)
+                    self.superseded += 1
+                    return item.futures[0]
+
+        queue.append(item)
+        if item.chat_id not in self._tasks:
+            self._tasks[item.chat_id] = asyncio.create_task(self._drain(item.chat_id))
+        return item.futures[0]
+
+    def send_nowait(self, chat_id, text, merge=True, **kwargs):
+        """Queue the message and return a future of the last sent telegram Message.
+        Args:
+            chat_id (int): The chat to send to.
+            text (str): The message text.
+            merge (bool): Allow merging with the neighbouring plain messages.
+        """
+        future = self._enqueue(OutgoingMessage('send', chat_id, text, kwargs=kwargs, mergeable=merge))
+        future.add_done_callback(_log_exception)
+        return future
+
+    async def send(self, chat_id, text, merge=True, **kwargs):
+        """Queue the message and wait until it's sent."""
+        with metrics.span('send_message'):
+            return await self._enqueue(OutgoingMessage('send', chat_id, text, kwargs=kwargs, mergeable=merge))
+
+    def edit(self, chat_id, message_id, text, **kwargs):
+        """Queue an edit of the message text, a pending edit of the same message is dropped."""
+        future = self._enqueue(OutgoingMessage('edit', chat_id, text, message_id=message_id, kwargs=kwargs))
+        future.add_done_callback(_log_exception)
+        return future
+
+    def _take_batch(self, queue):
+        item = queue.popleft()
+        if item.kind == 'send' and item.mergeable:
+            while queue and queue[0].kind == 'send' and queue[0].mergeable:
+                following = queue.popleft()
+                item.text = item.text.rstrip('\n') + '\n' + following.text
+                item.futures.extend(following.futures)
+                self.merged += 1
+        return item
+
+    async def _call(self, chat_id, method, *args, **kwargs):
+        while True:
+            await self._chat_bucket(chat_id).acquire()
+            if self._global_bucket is None:
+                self._global_bucket = TokenBucket(self._global_rate, self._global_rate)
+            await self._global_bucket.acquire()
+            try:
+                self.api_calls += 1
+                TELEGRAM_CALLS.inc(method=method.__name__)
+                return await method(*args, **kwargs)
+            except RetryAfter as error:
+                self.retries += 1
+                TELEGRAM_RETRIES.inc()
+                retry_after = error.retry_after
+                # A timedelta in newer python-telegram-bot versions, seconds in older ones
+                if hasattr(retry_after, 'total_seconds'):
+                    retry_after = retry_after.total_seconds()
+                self._chat_bucket(chat_id).pause(retry_after)
+
+    async def _drain(self, chat_id):
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                item = self._take_batch(queue)
+                try:
+                    if item.kind == 'edit':
+                        try:
+                            result = await self._call(chat_id, self.bot.edit_message_text, item.text, chat_id, item.message_id, **item.kwargs)
+                        except BadRequest:
+                            # Edits that don't change the text are rejected, they aren't worth a failure
+                            result = None
+                    else:
+                        for part in split_text(item.text, self.max_length):
+                            result = await self._call(chat_id, self.bot.send_message, chat_id, part, **item.kwargs)
+                except Exception as error:
+                    TELEGRAM_ERRORS.inc(error=type(error).__name__)
+                    for future in item.futures:
+                        if not future.done():
+                            future.set_exception(error)
+                else:
+                    for future in item.futures:
+                        if not future.done():
+                            future.set_result(result)
+        finally:
+            del self._tasks[chat_id]
+            if not queue:
+                del self._queues[chat_id]
+            else:
+                self._tasks[chat_id] = asyncio.create_task(self._drain(chat_id))
+
+    async def join(self):
+        """Wait until all queued messages are sent."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks.values()), return_exceptions=True)
+
+    def stats(self):
+        return {
+            'api_calls': self.api_calls,
+            'merged': self.merged,
+            'superseded': self.superseded,
+            'retries': self.retries,
+            'queued': sum(len(queue) for queue in self._queues.values()),
+        }
+
+
+def _log_exception(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning('Outgoing message failed: %s', future.exception())
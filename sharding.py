@@ -0,0 +1,229 @@
+"""Multi-process mode: updates are routed to worker processes by consistent hashing of the chat id.
+
+All updates of a chat go to the same worker, so only that worker writes the chat
+history. A worker that has to read the history of a chat owned by another worker
+asks the owner to flush the pending messages of the chat first, see Shard.flush_remote.
+"""
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import queue
+import time
+
+from update_processor import ChatLocks
+from webhook import WebhookServer
+
+
+SHARD_WORKERS = 4
+SHARD_VIRTUAL_NODES = 100
+# Updates processed at once by one worker
+SHARD_CONCURRENCY = 64
+SHARD_FLUSH_TIMEOUT = 5
+
+logger = logging.getLogger(__name__)
+
+
+class HashRing:
+    """Consistent hash ring, adding a node moves only about 1/n of the keys."""
+
+    def __init__(self, nodes, virtual_nodes=SHARD_VIRTUAL_NODES):
+        self._ring = sorted((self._hash(f'{node}:{replica}'), node) for node in nodes for replica in range(virtual_nodes))
+        self._hashes = [point for point, _ in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+    def node_for(self, key):
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._ring)
+        return self._ring[index][1]
+
+
+class Shard:
+    """The view of one worker process on the other shards."""
+
+    def __init__(self, index, inboxes, virtual_nodes=SHARD_VIRTUAL_NODES):
+        self.index = index
+        self.inboxes = inboxes
+        self.ring = HashRing(range(len(inboxes)), virtual_nodes)
+        self._requests = {}
+        self._request_id = 0
+
+    def owner(self, chat_id):
+        return self.ring.node_for(chat_id)
+
+    def owns(self, chat_id):
+        return self.owner(chat_id) == self.index
+
+    async def flush_remote(self, chat_id, chat_name, timeout=SHARD_FLUSH_TIMEOUT):
+        """Ask the worker that owns the chat to write its pending messages to the disk and wait for it.
+        Returns:
+            bool: False if the owner didn't answer in time.
+        """
+        self._request_id += 1
+        request_id = self._request_id
+        future = self._requests[request_id] = asyncio.get_running_loop().create_future()
+        self.inboxes[self.owner(chat_id)].put(('flush', chat_name, self.index, request_id))
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning('Shard %s did not flush "%s" in %s s', self.owner(chat_id), chat_name, timeout)
+            return False
+        finally:
+            self._requests.pop(request_id, None)
+
+    def _flushed(self, request_id):
+        future = self._requests.get(request_id)
+        if future is not None and not future.done():
+            future.set_result(True)
+
+
+def _next_messages(inbox):
+    """Block for the next inbox message and take the ones already waiting after it."""
+    messages = [inbox.get()]
+    try:
+        while len(messages) < 1000:
+            messages.append(inbox.get_nowait())
+    except queue.Empty:
+        pass
+    return messages
+
+async def _run_worker(index, inboxes, results, handler_factory, concurrency):
+    shard = Shard(index, inboxes)
+    handler = handler_factory(shard)
+    await handler.start()
+    results.put(('ready', index, None))
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    chat_locks = ChatLocks()
+    tasks = set()
+    processed = errors = 0
+
+    async def process(chat_key, data):
+        nonlocal processed, errors
+        try:
+            # The lock is taken in arrival order, so the updates of a chat keep their order
+            async with chat_locks.hold(chat_key), semaphore:
+                await handler.process_update(data)
+                processed += 1
+        except Exception:
+            errors += 1
+            logger.exception('Update processing failed in shard %s', index)
+
+    async def flush(chat_name, reply_to, request_id):
+        try:
+            await handler.flush(chat_name)
+        finally:
+            inboxes[reply_to].put(('flushed', request_id))
+
+    def spawn(coroutine):
+        task = asyncio.create_task(coroutine)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def drain():
+        # Other workers may still ask for flushes, so the inbox is served until 'stop'
+        while len(tasks) > 1:
+            await asyncio.gather(*[task for task in tasks if task is not asyncio.current_task()], return_exceptions=True)
+        results.put(('drained', index, None))
+
+    running = True
+    while running:
+        for message in await loop.run_in_executor(None, _next_messages, inboxes[index]):
+            kind = message[0]
+            if kind == 'update':
+                spawn(process(message[1], message[2]))
+            elif kind == 'flush':
+                spawn(flush(*message[1:]))
+            elif kind == 'flushed':
+                shard._flushed(message[1])
+            elif kind == 'drain':
+                spawn(drain())
+            elif kind == 'stop':
+                running = False
+
+    while tasks:
+        await asyncio.gather(*list(tasks), return_exceptions=True)
+    stats = await handler.stop()
+    results.put(('stopped', index, dict(stats or {}, processed=processed, errors=errors)))
+
+def worker_main(index, inboxes, results, handler_factory, concurrency=SHARD_CONCURRENCY):
+    """Entry point of a worker process.
+
+    handler_factory(shard) returns the object that processes the updates with the
+    coroutine methods start(), process_update(data), flush(chat_name) and stop() -> stats.
+    """
+    asyncio.run(_run_worker(index, inboxes, results, handler_factory, concurrency))
+
+
+class ShardRouter:
+    """Starts the worker processes and routes update JSON to them by chat id."""
+
+    def __init__(self, workers, handler_factory, concurrency=SHARD_CONCURRENCY, virtual_nodes=SHARD_VIRTUAL_NODES):
+        self.workers = workers
+        self.handler_factory = handler_factory
+        self.concurrency = concurrency
+        self.ring = HashRing(range(workers), virtual_nodes)
+
+        context = multiprocessing.get_context()
+        self.inboxes = [context.Queue() for _ in range(workers)]
+        self.results = context.Queue()
+        self._processes = [context.Process(target=worker_main, name=f'bot-shard-{index}', daemon=True,
+                                           args=(index, self.inboxes, self.results, handler_factory, concurrency))
+                           for index in range(workers)]
+        self.dispatched = [0] * workers
+
+    def _wait_results(self, kind, timeout):
+        """Wait for the result message of every worker, return worker index -> value."""
+        values = {}
+        deadline = time.monotonic() + timeout
+        while len(values) < self.workers:
+            try:
+                result_kind, index, value = self.results.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if result_kind == kind:
+                values[index] = value
+        return values
+
+    def start(self, wait=False, timeout=60):
+        """Start the worker processes, with wait=True wait until they are ready for updates."""
+        for process in self._processes:
+            process.start()
+        if wait:
+            self._wait_results('ready', timeout)
+        return self
+
+    def dispatch(self, data):
+        """Send the update JSON to the worker that owns its chat."""
+        chat_key = WebhookServer.chat_key(data)
+        index = self.ring.node_for(chat_key)
+        self.inboxes[index].put(('update', chat_key, data))
+        self.dispatched[index] += 1
+
+    async def process_update(self, data):
+        self.dispatch(data)
+
+    def stop(self, timeout=30):
+        """Let the workers process the queued updates and stop.
+        Returns:
+            dict: worker index -> the stats of the worker.
+        """
+        deadline = time.monotonic() + timeout
+        # A worker can only stop when no other one waits for it to flush a chat
+        for inbox in self.inboxes:
+            inbox.put(('drain',))
+        self._wait_results('drained', timeout)
+        for inbox in self.inboxes:
+            inbox.put(('stop',))
+
+        stats = self._wait_results('stopped', max(0.0, deadline - time.monotonic()))
+        for process in self._processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+        return stats
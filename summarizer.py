@@ -0,0 +1,213 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from atomic_file import file_version, write_json_atomic
+
+
+SUM_UP_CONCURRENCY = 4
+SUMMARY_CACHE_ENTRIES = 5
+SUMMARY_CACHE_CHATS = 1000
+# A cached summary that starts before the requested messages is reused while the older messages
+# it covers are at most this share of the request, so a sliding "last 100" window keeps hitting
+SUMMARY_OVERLAP_SLACK = 0.2
+
+
+def split_into_chunks(lines, line_tokens, max_tokens):
+    """Split the lines into consecutive chunks of whole lines with at most max_tokens tokens.
+    Args:
+        lines (list): The formatted chat messages.
+        line_tokens (list): The token count of every line.
+        max_tokens (int): The token budget of one chunk.
+    Returns:
+        list: The list of chunk texts.
+    """
+    chunks = []
+    chunk, chunk_tokens = [], 0
+
+    for line, tokens in zip(lines, line_tokens):
+        if chunk and chunk_tokens + tokens > max_tokens:
+            chunks.append(''.join(chunk))
+            chunk, chunk_tokens = [], 0
+        chunk.append(line)
+        chunk_tokens += tokens
+
+    if chunk:
+        chunks.append(''.join(chunk))
+
+    return chunks
+
+
+async def summarize_chunks(chunks, complete, make_prompt, make_reduce_prompt, count_tokens, max_tokens, concurrency=SUM_UP_CONCURRENCY):
+    """Map-reduce summary of the chunks.
+
+    Every chunk is summarized with make_prompt, at most `concurrency` at once, then the
+    partial summaries are joined with make_reduce_prompt. If the partial summaries don't
+    fit max_tokens together, they are reduced again in chunks until they do.
+    Args:
+        chunks (list): The chunk texts, every one fits max_tokens.
+        complete (coroutine function): Takes prompt messages and returns the completion text.
+        make_prompt (callable): Builds the summary prompt of one chunk.
+        make_reduce_prompt (callable): Builds the prompt that joins partial summaries.
+        count_tokens (callable): Returns the number of tokens in a text.
+        max_tokens (int): The token budget of the text inside one prompt.
+        concurrency (int): The maximum number of completions in flight.
+    Returns:
+        str: The summary.
+    """
+    if not chunks:
+        return await complete(make_prompt(''))
+    if len(chunks) == 1:
+        return await complete(make_prompt(chunks[0]))
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def summarize(prompt):
+        async with semaphore:
+            return await complete(prompt)
+
+    partials = await asyncio.gather(*(summarize(make_prompt(chunk)) for chunk in chunks))
+
+    while True:
+        partials = [f'Part {number}:\n{partial}\n' for number, partial in enumerate(partials, 1)]
+        partial_tokens = [count_tokens(partial) for partial in partials]
+        if sum(partial_tokens) <= max_tokens or len(partials) == 1:
+            return await complete(make_reduce_prompt(''.join(partials)))
+
+        groups = split_into_chunks(partials, partial_tokens, max_tokens)
+        if len(groups) == len(partials):
+            # Every partial summary alone takes the whole budget, reduce them in pairs
+            groups = [''.join(partials[i:i + 2]) for i in range(0, len(partials), 2)]
+        partials = await asyncio.gather(*(summarize(make_reduce_prompt(group)) for group in groups))
+
+
+class SummaryCache:
+    """Persistent per-chat cache of summaries keyed by the message id range they cover.
+
+    Every entry keeps the summary of messages first_id..last_id, the number of messages,
+    input tokens and completion calls it cost. find() returns the largest cached range that
+    lies inside the requested messages, so only the messages around it have to be summarized
+    again. A range that starts a few messages before the requested ones is used too, see
+    SUMMARY_OVERLAP_SLACK.
+
+    Any shard worker can summarize any chat, so the entries in memory are read again when
+    another process replaced the file. Two processes that put entries of one chat at the
+    same moment can still lose one of them, which only costs a cache miss.
+    """
+
+    def __init__(self, path, max_entries_per_chat=SUMMARY_CACHE_ENTRIES, max_chats=SUMMARY_CACHE_CHATS):
+        self.path = path
+        self.max_entries_per_chat = max_entries_per_chat
+        self.max_chats = max_chats
+
+        # chat name -> (file version, entries)
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self.saved_calls = 0
+
+    def _file(self, chat_name):
+        return os.path.join(self.path, str(chat_name) + '.json')
+
+    def _get_entries(self, chat_name):
+        version = file_version(self._file(chat_name))
+        if chat_name in self._entries and self._entries[chat_name][0] == version:
+            self._entries.move_to_end(chat_name)
+            return self._entries[chat_name][1]
+
+        entries = []
+        try:
+            with open(self._file(chat_name), 'r') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            version = None
+
+        self._entries[chat_name] = version, entries
+        self._entries.move_to_end(chat_name)
+        while len(self._entries) > self.max_chats:
+            self._entries.popitem(last=False)
+        return entries
+
+    def find(self, chat_name, message_ids, slack=SUMMARY_OVERLAP_SLACK):
+        """Find the cached summary of the largest range inside message_ids.
+
+        A range that starts before message_ids and ends inside them is found too, if the
+        older messages it covers are at most slack of the requested ones. Its first
+        position is 0 and its first_id isn't message_ids[0].
+        Args:
+            chat_name (str): The chat name.
+            message_ids (list): The ordered message ids of the requested range.
+        Returns:
+            tuple: (entry, first position, last position) or (None, None, None).
+        """
+        positions = {str(message_id): position for position, message_id in enumerate(message_ids)}
+
+        with self._lock:
+            best, best_range = None, (None, None)
+            for entry in self._get_entries(chat_name):
+                first = positions.get(entry['first_id'])
+                last = positions.get(entry['last_id'])
+                if first is None and last is not None and entry.get('messages') is not None:
+                    # The entry covers the messages up to last and some older ones
+                    if 0 < entry['messages'] - (last + 1) <= slack * len(message_ids):
+                        first = 0
+                if first is None or last is None or last < first:
+                    continue
+                if best is None or last - first > best_range[1] - best_range[0]:
+                    best, best_range = entry, (first, last)
+
+            if best is None:
+                self.misses += 1
+                return None, None, None
+
+            self.hits += 1
+            best['used'] = time.time()
+            return best, best_range[0], best_range[1]
+
+    def record_saving(self, tokens, calls):
+        with self._lock:
+            self.saved_tokens += tokens
+            self.saved_calls += calls
+
+    def put(self, chat_name, first_id, last_id, summary, tokens, calls, messages):
+        """Add the summary of the messages first_id..last_id and write the chat entries to the disk."""
+        with self._lock:
+            entries = self._get_entries(chat_name)
+            entries[:] = [entry for entry in entries if not (entry['first_id'] == str(first_id) and entry['last_id'] == str(last_id))]
+            entries.append({
+                'first_id': str(first_id),
+                'last_id': str(last_id),
+                'summary': summary,
+                'messages': messages,
+                'tokens': tokens,
+                'calls': calls,
+                'used': time.time(),
+            })
+            # Keep the most recently used entries
+            entries.sort(key=lambda entry: entry['used'])
+            del entries[:-self.max_entries_per_chat]
+
+            write_json_atomic(self._file(chat_name), entries)
+            self._entries[chat_name] = file_version(self._file(chat_name)), entries
+
+    def remove(self, chat_name):
+        """Invalidate all summaries of the chat."""
+        with self._lock:
+            self._entries.pop(chat_name, None)
+            if os.path.isfile(self._file(chat_name)):
+                os.remove(self._file(chat_name))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'saved_tokens': self.saved_tokens,
+                'saved_calls': self.saved_calls,
+            }
@@ -0,0 +1,136 @@
+"""BM25 full-text index of the messages of a chat.
+
+A question to the bot in a group is often about something said earlier in the
+chat. TextIndex keeps an inverted index of the messages by their sequence number
+(see CompactHistory) that is updated with every new message and trimmed with the
+history, so the messages most relevant to a question are found in milliseconds
+without reading the whole history.
+"""
+import heapq
+import math
+import re
+from array import array
+from bisect import bisect_left
+from collections import Counter
+
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Shorter words aren't indexed
+MIN_TERM_LEN = 2
+# Query terms found in more than this share of the messages are skipped while the query has rarer ones,
+# their weight is close to 0 and their postings are the longest
+COMMON_TERM_SHARE = 0.5
+
+TERM_PATTERN = re.compile(r'\w+')
+
+
+def split_terms(text):
+    """Return the lower case words of the text that are indexed."""
+    return [term for term in TERM_PATTERN.findall(text.casefold()) if len(term) >= MIN_TERM_LEN]
+
+
+class TextIndex:
+    """Inverted index of texts by growing sequence numbers with BM25 ranking.
+
+    Texts are added in sequence order, numbers without a text are simply skipped.
+    trim() drops the texts before a sequence number, their postings are removed
+    in bulk once the trimmed texts outnumber the live ones.
+    """
+
+    def __init__(self, first_seq=0):
+        # term -> (sequence numbers, counts of the term), the sequence numbers grow
+        self._postings = {}
+        # Number of terms of the text first_seq + i, 0 if there is none
+        self._lengths = array('I')
+        self.first_seq = first_seq
+        self.documents = 0
+        self.total_length = 0
+        self._trimmed = 0
+
+    def __len__(self):
+        return self.documents
+
+    @property
+    def next_seq(self):
+        """The smallest sequence number the next text can have."""
+        return self.first_seq + len(self._lengths)
+
+    def add(self, seq, text):
+        """Index the text under the sequence number, it must be larger than the ones added before."""
+        if seq < self.next_seq:
+            raise ValueError(f'Sequence number {seq} is already indexed')
+        self._lengths.extend([0] * (seq - self.next_seq))
+
+        counts = Counter(split_terms(text))
+        for term, count in counts.items():
+            posting = self._postings.get(term)
+            if posting is None:
+                posting = self._postings[term] = (array('q'), array('I'))
+            posting[0].append(seq)
+            posting[1].append(count)
+
+        length = sum(counts.values())
+        self._lengths.append(length)
+        if length:
+            self.documents += 1
+            self.total_length += length
+
+    def trim(self, first_seq):
+        """Drop the texts with sequence numbers before first_seq."""
+        count = min(first_seq, self.next_seq) - self.first_seq
+        if count <= 0:
+            return
+        for length in self._lengths[:count]:
+            if length:
+                self.documents -= 1
+                self.total_length -= length
+                self._trimmed += 1
+        del self._lengths[:count]
+        self.first_seq += count
+
+        if self._trimmed > self.documents:
+            self._compact()
+
+    def _compact(self):
+        for term in list(self._postings):
+            seqs, counts = self._postings[term]
+            start = bisect_left(seqs, self.first_seq)
+            if start == len(seqs):
+                del self._postings[term]
+            elif start:
+                del seqs[:start]
+                del counts[:start]
+        self._trimmed = 0
+
+    def search(self, query, k):
+        """Return the k texts that match the query best.
+        Returns:
+            list: (sequence number, BM25 score), best first.
+        """
+        if not self.documents:
+            return []
+
+        matched = []
+        for term in set(split_terms(query)):
+            posting = self._postings.get(term)
+            if posting is not None:
+                start = bisect_left(posting[0], self.first_seq)
+                if start < len(posting[0]):
+                    matched.append((posting, start, len(posting[0]) - start))
+        rare = [match for match in matched if match[2] <= self.documents * COMMON_TERM_SHARE]
+
+        scores = {}
+        lengths = self._lengths
+        first_seq = self.first_seq
+        # Per text: k1 * (1 - b + b * length / average length) is a + c * length
+        a = BM25_K1 * (1 - BM25_B)
+        c = BM25_K1 * BM25_B * self.documents / self.total_length
+        for (seqs, counts), start, documents in rare or matched:
+            weight = math.log(1 + (self.documents - documents + 0.5) / (documents + 0.5)) * (BM25_K1 + 1)
+            for position in range(start, len(seqs)):
+                seq = seqs[position]
+                count = counts[position]
+                scores[seq] = scores.get(seq, 0.0) + weight * count / (count + a + c * lengths[seq - first_seq])
+
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
@@ -0,0 +1,112 @@
+"""Token counting with a tiktoken encoding that is loaded once, on first use.
+
+tiktoken downloads the BPE ranks of an encoding the first time it's used and
+keeps them in TIKTOKEN_CACHE_DIR. A cache directory filled at build time with
+`python tokenizer.py download <cache_dir>` and shipped with the deployment lets
+the bot start without network access.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+
+import tiktoken
+
+
+DEFAULT_ENCODING = 'cl100k_base'
+# Shorter batches are encoded in the calling thread, tiktoken starts a thread pool for every batch
+TOKENIZER_BATCH_MIN = 64
+TOKENIZER_THREADS = 4
+# UTF-8 bytes per token of the estimate used when the encoding can't be loaded
+FALLBACK_BYTES_PER_TOKEN = 3
+
+logger = logging.getLogger(__name__)
+
+
+class Tokenizer:
+    """Counts the tokens of texts for the model, the encoding is loaded on the first count."""
+
+    def __init__(self, model, cache_dir=None):
+        self.model = model
+        self.cache_dir = cache_dir
+        self.load_seconds = None
+        self._encoding = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._forget_loading)
+
+    def _forget_loading(self):
+        # A thread of the parent may have held the lock while loading, the child doesn't have that thread
+        # and would wait for the lock forever. An unfinished load starts over in the child
+        self._lock = threading.Lock()
+        if not self._loaded:
+            self._encoding = None
+
+    @property
+    def encoding(self):
+        """The tiktoken encoding or None if it couldn't be loaded."""
+        return self._get_encoding(True)
+
+    def _get_encoding(self, wait):
+        if not self._loaded:
+            if not self._lock.acquire(blocking=wait):
+                # Another thread is loading the encoding, tiktoken may be downloading it
+                return None
+            try:
+                if not self._loaded:
+                    self._encoding = self._load()
+                    self._loaded = True
+            finally:
+                self._lock.release()
+        return self._encoding
+
+    def _load(self):
+        if self.cache_dir is not None:
+            # An explicit TIKTOKEN_CACHE_DIR of the environment wins
+            os.environ.setdefault('TIKTOKEN_CACHE_DIR', self.cache_dir)
+
+        start = time.perf_counter()
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model(self.model)
+            except KeyError:
+                print(f'Warning: model {self.model} not found. Using {DEFAULT_ENCODING} encoding.')
+                encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+        except Exception as error:
+            logger.warning('Tokenizer of %s is not available (%r), token counts are estimated. '
+                           'Fill %s with `python tokenizer.py download`.',
+                           self.model, error, os.environ.get('TIKTOKEN_CACHE_DIR'))
+            return None
+        self.load_seconds = time.perf_counter() - start
+        return encoding
+
+    def count(self, text, wait=True):
+        """Return the number of tokens in the text, special tokens count as plain text.
+
+        With wait=False the count is estimated while another thread loads the encoding,
+        so callers on the event loop don't wait for a download.
+        """
+        encoding = self._get_encoding(wait)
+        if encoding is None:
+            return -(-len(text.encode('utf-8')) // FALLBACK_BYTES_PER_TOKEN)
+        return len(encoding.encode_ordinary(text))
+
+    def count_batch(self, texts, wait=True):
+        """Return the number of tokens of every text, long batches are encoded in parallel threads, see count() for wait."""
+        encoding = self._get_encoding(wait)
+        if encoding is None or len(texts) < TOKENIZER_BATCH_MIN:
+            return [self.count(text, wait) for text in texts]
+        return [len(tokens) for tokens in encoding.encode_ordinary_batch(texts, num_threads=TOKENIZER_THREADS)]
+
+
+if __name__ == '__main__':
+    # python tokenizer.py download <cache_dir> [model]: fill the cache directory to ship with the bot
+    if len(sys.argv) < 3 or sys.argv[1] != 'download':
+        sys.exit(__doc__)
+    os.environ['TIKTOKEN_CACHE_DIR'] = sys.argv[2]
+    tokenizer = Tokenizer(sys.argv[3] if len(sys.argv) > 3 else 'gpt-3.5-turbo')
+    if tokenizer.encoding is None:
+        sys.exit('Download failed')
+    print(f'{tokenizer.encoding.name} saved to {sys.argv[2]} in {tokenizer.load_seconds:.2f} s')
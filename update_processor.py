@@ -0,0 +1,70 @@
+import asyncio
+import contextlib
+
+from telegram.ext import BaseUpdateProcessor
+
+
+MAX_CONCURRENT_UPDATES = 64
+# Updates taken from the update queue at once, the ones of busy chats wait for their turn
+MAX_WAITING_UPDATES = 4096
+
+
+class ChatLocks:
+    """Async locks by chat that are dropped when no task holds or waits for them.
+
+    asyncio.Lock wakes the waiters in the order they came, so tasks that take the lock
+    of a chat in the order of the updates process the updates of the chat in that order.
+    """
+
+    def __init__(self):
+        # chat key -> [lock, number of tasks that hold or wait for it]
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, chat_key):
+        entry = self._locks.setdefault(chat_key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[chat_key]
+
+
+def update_chat_key(update):
+    """Return the chat id of the update, or the update id for updates without a chat."""
+    chat = getattr(update, 'effective_chat', None)
+    if chat is not None:
+        return chat.id
+    return getattr(update, 'update_id', id(update))
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Update processor for concurrent_updates that keeps the order of updates inside a chat.
+
+    Updates of different chats run in parallel, at most max_concurrent_updates at once.
+    The updates of one chat run one after another, and a chat that waits for its
+    previous update doesn't take one of the running slots.
+    """
+
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES, max_waiting_updates=MAX_WAITING_UPDATES):
+        super().__init__(max(max_concurrent_updates, max_waiting_updates))
+        self.max_running_updates = max_concurrent_updates
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self.chat_locks = ChatLocks()
+
+    async def do_process_update(self, update, coroutine):
+        async with self.chat_locks.hold(update_chat_key(update)):
+            async with self._running:
+                await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
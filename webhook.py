@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import signal
+import time
+
+from aiohttp import web
+
+import metrics
+
+
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_WORKERS = 16
+WEBHOOK_STATS_INTERVAL = 60
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_UPDATES = metrics.counter('webhook_updates_total', 'Webhook updates by outcome.', ['result'])
+
+
+class WebhookServer:
+    """HTTP server that takes Telegram updates by webhook and processes them concurrently.
+
+    Updates are spread over worker queues by chat id, so the updates of one chat are
+    processed in order while different chats run in parallel. When the queue of a
+    worker is full the update is rejected with 503 and Telegram delivers it again later.
+    """
+
+    def __init__(self, process_update, host='0.0.0.0', port=8443, path='/telegram', secret_token=None,
+                 queue_size=WEBHOOK_QUEUE_SIZE, workers=WEBHOOK_WORKERS):
+        """
+        Args:
+            process_update (coroutine function): Takes the update JSON and processes it.
+            host (str): The interface to listen on.
+            port (int): The port to listen on, 0 for any free port.
+            path (str): The URL path of the webhook.
+            secret_token (str): The X-Telegram-Bot-Api-Secret-Token value to accept, None to accept all.
+            queue_size (int): The total number of updates waiting for processing.
+            workers (int): The number of updates processed at once.
+        """
+        self.process_update = process_update
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.queues = [asyncio.Queue(maxsize=max(1, queue_size // workers)) for _ in range(workers)]
+
+        self.received = 0
+        self.processed = 0
+        self.shed = 0
+        self.errors = 0
+        self.started = time.monotonic()
+
+        self._runner = None
+        self._tasks = []
+
+    def queue_depth(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return {
+            'received': self.received,
+            'processed': self.processed,
+            'shed': self.shed,
+            'errors': self.errors,
+            'queue_depth': self.queue_depth(),
+            'updates_per_second': round(self.processed / elapsed, 2),
+        }
+
+    @staticmethod
+    def chat_key(data):
+        """Return the chat id of the update JSON, or the update id for updates without a chat."""
+        for value in data.values():
+            if isinstance(value, dict) and isinstance(value.get('chat'), dict):
+                return value['chat'].get('id', 0)
+        return data.get('update_id', 0)
+
+    async def handle_update(self, request):
+        if self.secret_token and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        self.received += 1
+        queue = self.queues[hash(self.chat_key(data)) % len(self.queues)]
+        try:
+            queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self.shed += 1
+            WEBHOOK_UPDATES.inc(result='shed')
+            return web.Response(status=503)
+
+        return web.Response()
+
+    async def handle_stats(self, request):
+        return web.json_response(self.stats())
+
+    async def _worker(self, queue):
+        while True:
+            data = await queue.get()
+            try:
+                await self.process_update(data)
+                self.processed += 1
+                WEBHOOK_UPDATES.inc(result='processed')
+            except Exception:
+                self.errors += 1
+                WEBHOOK_UPDATES.inc(result='error')
+                logger.exception('Update processing failed')
+            finally:
+                queue.task_done()
+
+    async def _report_stats(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            logger.info('Webhook %s', self.stats())
+
+    async def start(self, stats_interval=WEBHOOK_STATS_INTERVAL):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get('/stats', self.handle_stats)
+
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        if self.port == 0:
+            self.port = self._runner.addresses[0][1]
+
+        self.started = time.monotonic()
+        metrics.gauge('webhook_queue_depth', 'Updates waiting in the webhook worker queues.', self.queue_depth)
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self.queues]
+        if stats_interval:
+            self._tasks.append(asyncio.create_task(self._report_stats(stats_interval)))
+        return self
+
+    async def stop(self):
+        """Stop taking updates, process the queued ones and stop the workers."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        for queue in self.queues:
+            await queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+async def run_webhook(application, server, webhook_url=None):
+    """Run the PTB application with updates from the webhook server until SIGINT or SIGTERM."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stop_event.set)
+
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    if webhook_url:
+        await application.bot.set_webhook(webhook_url, secret_token=server.secret_token)
+    await application.start()
+    await server.start()
+    print(f'Webhook server listens on {server.host}:{server.port}{server.path}')
+
+    try:
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)